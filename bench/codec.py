@@ -0,0 +1,68 @@
+''' Compare the cost of encoding and decoding rpc messages with the JSON
+codec (the original wire format) against the binary codec.
+
+    python -m bench.codec [iterations]
+'''
+import sys
+import time
+import random
+
+from network.codec import JsonCodec, BinaryCodec
+
+def random_contact():
+    return ('10.%d.%d.%d' % (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)),
+            random.randint(49152, 2**16 - 1), random.randint(0, 2**160 - 1))
+
+def sample_messages():
+    ''' sample_messages returns one message of each type, shaped like the
+    messages built by Rpc_Client '''
+    def message(m_type, data):
+        return {
+            'source' : list(random_contact()),
+            'xid'    : random.getrandbits(64),
+            'type'   : m_type,
+            'data'   : data
+        }
+
+    contacts = [random_contact() for i in xrange(20)]
+    key_hash = random.randint(0, 2**160 - 1)
+    return [
+        message('PING', {}),
+        message('FIND_NODE', random.randint(0, 2**160 - 1)),
+        message('RETURN_NODE', contacts),
+        message('FIND_VALUE', { 'key' : 'some key', 'key_hash' : key_hash }),
+        message('RETURN_VALUE', { 'value' : 'v' * 64, 'found' : True }),
+        message('RETURN_VALUE', { 'nodes' : contacts, 'found' : False }),
+        message('STORE', { 'key' : 'some key', 'key_hash' : key_hash, 'value' : 'v' * 64 })
+    ]
+
+def measure(codec, message, iterations):
+    ''' returns (encoded size, encode+decode round trips per second) '''
+    encode = codec.encode
+    decode = codec.decode
+    start = time.time()
+    for i in xrange(iterations):
+        decode(encode(message))
+    elapsed = time.time() - start
+    return len(encode(message)), iterations / elapsed
+
+def main(iterations=20000):
+    random.seed(0)
+    # contacts repeat from message to message so the binary codec caches
+    # their packed form, 'cold' shows the cost with every contact unseen
+    codecs = [('json', JsonCodec()), ('binary', BinaryCodec()),
+              ('cold', BinaryCodec(contact_cache_size=0))]
+    print "%-20s %-7s %8s %12s" % ('type', 'codec', 'bytes', 'msgs/sec')
+    for message in sample_messages():
+        name = message['type']
+        if message['type'] == 'RETURN_VALUE' and not message['data']['found']:
+            name += '(nodes)'
+        for codec_name, codec in codecs:
+            size, rate = measure(codec, message, iterations)
+            print "%-20s %-7s %8d %12.0f" % (name, codec_name, size, rate)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
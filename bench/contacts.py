@@ -0,0 +1,49 @@
+''' Measure the memory used per contact: the Node object on its own, and a
+Node held in a routing table bucket. Sizes are measured both with
+sys.getsizeof and as the growth in resident memory while creating many
+contacts.
+
+    python -m bench.contacts [contacts]
+'''
+import sys
+import random
+
+from routing import Node, Kbucket
+
+def rss():
+    ''' resident memory of this process in bytes (linux only) '''
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * 4096
+
+def object_size(node):
+    size = sys.getsizeof(node) + sys.getsizeof(node.id)
+    if hasattr(node, '__dict__'):
+        size += sys.getsizeof(node.__dict__)
+    return size
+
+def main(count=200000):
+    random.seed(0)
+    ids = [random.randint(0, 2**160 - 1) for i in xrange(count)]
+
+    print "getsizeof per Node (object + id): %d bytes" % object_size(Node('10.0.0.1', 50000, ids[0]))
+
+    before = rss()
+    nodes = [Node('10.0.0.1', 50000, i) for i in ids]
+    after = rss()
+    print "resident memory per Node: %.0f bytes" % (float(after - before) / count)
+
+    before = rss()
+    buckets = []
+    for i in xrange(0, count, 20):
+        bucket = Kbucket(20, 0, 2**160 - 1, 5, 160)
+        for node in nodes[i:i + 20]:
+            bucket.addNode(node, updateSeen=False)
+        buckets.append(bucket)
+    after = rss()
+    print "resident memory per bucket entry: %.0f bytes" % (float(after - before) / count)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,66 @@
+''' Measure the disk datastore: how fast values are stored, how long a
+store takes to open with its index and when the index has to be rebuilt
+from the log, and how long a retrieve of a random key takes.
+
+    python -m bench.disk [values] [value size]
+'''
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+from datastore.disk import disk
+from bench.contacts import rss
+
+def main(count=200000, size=100):
+    random.seed(0)
+    path = tempfile.mkdtemp()
+    try:
+        keys = [random.getrandbits(160) for i in xrange(count)]
+        value = 'x' * size
+
+        store = disk(path=path)
+        start = time.time()
+        for k in keys:
+            store.store(str(k), k, value)
+        store.flush()
+        elapsed = time.time() - start
+        store.close()
+        print "store:             %8.0f values/sec (%d values, %d MB log)" % (
+            count / elapsed, count, os.path.getsize(store.log_path) / 2**20)
+
+        before = rss()
+        start = time.time()
+        store = disk(path=path)
+        print "open with index:   %8.1f ms, %.1f MB resident" % (
+            (time.time() - start) * 1000, (rss() - before) / 2.0**20)
+
+        samples = []
+        for k in random.sample(keys, min(count, 10000)):
+            start = time.time()
+            store.retrieve(k)
+            samples.append(time.time() - start)
+        samples.sort()
+        print "retrieve:          %8.1f us mean, %.1f us p99" % (
+            sum(samples) / len(samples) * 1e6, samples[len(samples) * 99 // 100] * 1e6)
+        store.close()
+
+        os.remove(store.index_path)
+        start = time.time()
+        store = disk(path=path)
+        print "open, no index:    %8.1f ms (log replayed)" % ((time.time() - start) * 1000)
+
+        for k in keys[::2]:
+            store.remove(k)
+        start = time.time()
+        store.compact().join()
+        print "compact half:      %8.1f ms" % ((time.time() - start) * 1000)
+        store.close()
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    main(*args)
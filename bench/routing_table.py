@@ -0,0 +1,56 @@
+''' Compare the list based RoutingTree with the TrieRoutingTree. Each tree
+is offered a number of random contacts and then asked for the closest
+nodes to random targets.
+
+With the default b=5 most contacts are turned away once the far buckets
+are full; a large b (e.g. 160) keeps every contact, as a well connected
+node's routing table would, and shows the cost of many buckets.
+
+    python -m bench.routing_table [contacts ...] [--b B]
+'''
+import sys
+import time
+import random
+
+from routing import Node, RoutingTree
+from trie import TrieRoutingTree
+
+def measure(cls, this, contacts, targets, b):
+    tree = cls(Node(None, None, this), b=b)
+
+    start = time.time()
+    for n in contacts:
+        tree.addNode(n)
+    insert = time.time() - start
+
+    start = time.time()
+    for n in targets:
+        tree.findClosestNodes(n)
+    find = time.time() - start
+
+    stats = tree.returnStats()
+    return insert / len(contacts), find / len(targets), stats
+
+def main(sizes, b):
+    print "%-10s %-6s %9s %9s %12s %12s" % (
+        'contacts', 'tree', 'buckets', 'stored', 'insert us', 'closest us')
+    for size in sizes:
+        random.seed(size)
+        this = random.randint(0, 2**160 - 1)
+        contacts = [Node(None, None, random.randint(0, 2**160 - 1)) for i in xrange(size)]
+        targets = [Node(None, None, random.randint(0, 2**160 - 1)) for i in xrange(2000)]
+        for name, cls in (('list', RoutingTree), ('trie', TrieRoutingTree)):
+            insert, find, stats = measure(cls, this, contacts, targets, b)
+            print "%-10d %-6s %9d %9d %12.2f %12.2f" % (
+                size, name, stats['buckets'], stats['total_nodes'], insert * 1e6, find * 1e6)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    b = 5
+    if '--b' in args:
+        i = args.index('--b')
+        b = int(args[i + 1])
+        del args[i:i + 2]
+
+    sizes = [int(a) for a in args] or [10000, 100000, 1000000]
+    main(sizes, b)
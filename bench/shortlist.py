@@ -0,0 +1,124 @@
+''' Measure the CPU time spent in the bookkeeping of an iterative lookup,
+comparing the original list based lookup with the Shortlist capped at
+different multiples of k.
+
+The network is simulated without any messages: every node answers a query
+with the k nodes closest to the target out of a fixed random sample of the
+network, standing in for its routing table. Answers are computed once
+before timing so only the lookup itself is measured. 'closest' is the
+fraction of the true k closest nodes which the lookup returned.
+
+    python -m bench.shortlist [network size] [lookups]
+'''
+import sys
+import time
+import random
+from collections import deque
+
+from routing import Node
+from lookup import Shortlist
+
+K = 20
+ALPHA = 3
+
+class Network:
+    def __init__(self, size, table=200):
+        self.nodes = [Node(None, None, random.getrandbits(160)) for i in xrange(size)]
+        self.tables = {}
+        for n in self.nodes:
+            self.tables[n.id] = random.sample(self.nodes, table)
+        self.answers = {}
+
+    def respond(self, node, target):
+        key = (node.id, target)
+        if key not in self.answers:
+            table = sorted(self.tables[node.id], key=lambda n: n.id ^ target)
+            self.answers[key] = table[:K]
+        return self.answers[key]
+
+def list_lookup(network, target, start):
+    ''' the original lookup, re-sorting a list on every response '''
+    nodes_all = list(start)
+    nodes_queried = []
+    inflight = deque()
+    while True:
+        nodes_all.sort(lambda a, b, num=target: cmp(num ^ a.id, num ^ b.id))
+        if len(nodes_queried) > K:
+            if all(n in nodes_queried for n in nodes_all[:K]):
+                break
+        while len(inflight) < ALPHA:
+            for n in nodes_all:
+                if n not in nodes_queried:
+                    nodes_queried.append(n)
+                    inflight.append(n)
+                    break
+            else:
+                break
+        if not inflight:
+            break
+        for n in network.respond(inflight.popleft(), target):
+            if n not in nodes_all:
+                nodes_all.append(n)
+    nodes_all.sort(lambda a, b, num=target: cmp(num ^ a.id, num ^ b.id))
+    return nodes_all[:K], len(nodes_queried)
+
+def shortlist_lookup(network, target, start, size):
+    shortlist = Shortlist(target, K, size)
+    shortlist.add(start)
+    inflight = deque()
+    queries = 0
+    while not shortlist.complete():
+        while len(inflight) < ALPHA:
+            n = shortlist.next()
+            if n is None:
+                break
+            shortlist.query(n)
+            inflight.append(n)
+            queries += 1
+        if not inflight:
+            break
+        n = inflight.popleft()
+        shortlist.respond(n)
+        shortlist.add(network.respond(n, target))
+    return shortlist.closest(), queries
+
+def measure(network, lookups, run):
+    elapsed = 0.0
+    queries = 0
+    closest = 0
+    # warm the answers so that only the lookup is timed
+    for target, start in lookups:
+        run(network, target, start)
+    for target, start in lookups:
+        t = time.clock()
+        nodes, q = run(network, target, start)
+        elapsed += time.clock() - t
+        queries += q
+        best = sorted(network.nodes, key=lambda n: n.id ^ target)[:K]
+        closest += len(set(best) & set(nodes))
+    count = len(lookups)
+    return elapsed / count, float(queries) / count, float(closest) / (count * K)
+
+def main(size=5000, count=50):
+    random.seed(0)
+    network = Network(size)
+    lookups = []
+    for i in xrange(count):
+        target = random.getrandbits(160)
+        lookups.append((target, network.respond(random.choice(network.nodes), target)))
+
+    runs = [('list', list_lookup)]
+    for factor in (1, 2, 3, 5, 10):
+        runs.append(('shortlist %sk' % factor,
+                     lambda n, t, s, size=factor * K: shortlist_lookup(n, t, s, size)))
+    runs.append(('shortlist uncapped',
+                 lambda n, t, s: shortlist_lookup(n, t, s, size * 2)))
+
+    print "%-20s %12s %10s %10s" % ('lookup', 'cpu us', 'queries', 'closest')
+    for name, run in runs:
+        cpu, queries, closest = measure(network, lookups, run)
+        print "%-20s %12.1f %10.1f %10.3f" % (name, cpu * 1e6, queries, closest)
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    main(*args)
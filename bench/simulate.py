@@ -0,0 +1,45 @@
+''' Measure how many messages per second Simulate can deliver with each
+delivery mode: copying through the json or binary codec, sharing the
+message object, and sharing with the mutation check enabled.
+
+    python -m bench.simulate [messages]
+'''
+import sys
+import time
+import random
+
+from gevent.queue import Queue
+
+from network.simulate import Simulate
+from network.codec import JsonCodec
+from bench.codec import sample_messages
+
+def measure(network, messages, count):
+    queue = Queue()
+    addr, port = network.connect(queue)
+    start = time.time()
+    for i in xrange(count):
+        network.send(addr, port, messages[i % len(messages)])
+        if i % 1000 == 999:
+            while not queue.empty():
+                queue.get()
+    return count / (time.time() - start)
+
+def main(count=100000):
+    random.seed(0)
+    messages = sample_messages()
+    modes = [
+        ('copy (json)', Simulate(codec=JsonCodec())),
+        ('copy (binary)', Simulate()),
+        ('shared', Simulate(copy=False)),
+        ('shared, checked', Simulate(copy=False, check_shared=True))
+    ]
+    print "%-18s %12s" % ('delivery', 'msgs/sec')
+    for name, network in modes:
+        print "%-18s %12.0f" % (name, measure(network, messages, count))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
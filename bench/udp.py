@@ -0,0 +1,51 @@
+''' Measure datagram throughput of the UDP transport on loopback with many
+nodes hosted in one process. Every node sends PINGs to random other nodes
+and the number of datagrams delivered to the nodes' queues is counted.
+
+    python -m bench.udp [nodes] [messages per node]
+'''
+import sys
+import time
+import random
+
+import gevent
+from gevent.queue import Queue
+
+from network.udp import Udp
+
+def sender(network, source, peers, count):
+    m = {
+        'source' : [source[0], source[1], random.randint(0, 2**160 - 1)],
+        'xid'    : 0,
+        'type'   : 'PING',
+        'data'   : {}
+    }
+    for i in xrange(count):
+        addr, port = random.choice(peers)
+        m['xid'] = i
+        network.send(addr, port, m)
+        if i % 32 == 0:
+            gevent.sleep()
+
+def main(nodes=100, count=1000):
+    network = Udp(rcvbuf=4 * 1024 * 1024, sndbuf=4 * 1024 * 1024)
+    queues = [Queue() for i in xrange(nodes)]
+    peers = [network.connect(q) for q in queues]
+
+    start = time.time()
+    gevent.joinall([gevent.spawn(sender, network, peer, peers, count) for peer in peers])
+
+    # give the receivers a moment to drain their sockets
+    expected = nodes * count
+    deadline = time.time() + 5
+    while network.received < expected - network.dropped and time.time() < deadline:
+        gevent.sleep(0.01)
+    elapsed = time.time() - start
+
+    print "nodes: %d, sent: %d, received: %d, dropped: %d" % (
+        nodes, network.sent, network.received, network.dropped)
+    print "elapsed: %.2fs, %.0f datagrams/sec" % (elapsed, network.received / elapsed)
+    network.close()
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
@@ -1,36 +1,169 @@
-from gevent.queue import Queue
+from collections import deque
+
+from gevent.event import Event
+from gevent.queue import Empty, Full
+
+import clock
 
 class SelectQueue:
-    def __init__(self, channel, queue):
+    def __init__(self, chan, channel):
+        self.chan    = chan
         self.channel = channel
-        self.queue   = queue
 
-    def put(self, message, **kwargs):
+    def put(self, message, block=True):
         ''' send a message on the given channel name '''
-        m = { 'channel' : self.channel, 'message' : message }
-        self.queue.put(m, **kwargs)
+        self.chan.put(self.channel, message, block)
 
     def get(self):
         ''' You can only write to this queue '''
         raise NotImplementedError
 
+class Channel(object):
+    ''' Channel is the queue and counters for one channel of a SelectChan.
+
+    maxsize bounds the queue (None is unbounded). When the queue is full
+    the policy decides what happens to a new message:
+
+    * 'block'    - the sender waits for space (backpressure)
+    * 'drop_new' - the new message is dropped
+    * 'drop_old' - the oldest queued message is dropped to make room
+    '''
+    __slots__ = ('name', 'queue', 'maxsize', 'weight', 'policy', 'space',
+                 'received', 'dropped', 'max_depth')
+
+    policies = ('block', 'drop_new', 'drop_old')
+
+    def __init__(self, name, maxsize=None, weight=1, policy='block'):
+        if policy not in self.policies:
+            raise ValueError('unknown policy: %s' % policy)
+        if weight < 1:
+            raise ValueError('weight must be at least 1')
+
+        self.name      = name
+        self.queue     = deque()
+        self.maxsize   = maxsize
+        self.weight    = weight
+        self.policy    = policy
+        self.space     = Event()
+        self.received  = 0
+        self.dropped   = 0
+        self.max_depth = 0
+
+    def full(self):
+        return self.maxsize is not None and len(self.queue) >= self.maxsize
+
 class SelectChan:
-    ''' SelectChan is a basic multiplexing channel based on the eventlet Queue
-    class. All messages sent (put)on the queue are required to have a 'channel'
-    which they are sent on. When we recieve (get) a message the channel which
-    it was sent on is returned.
+    ''' SelectChan multiplexes a number of channels into a single receiver.
+    Each channel has its own (optionally bounded) queue. When we recieve
+    (get) a message the channel which it was sent on is returned.
+
+    Channels are served in weighted round robin, a channel with weight w
+    may have up to w messages taken before the next channel with messages
+    waiting gets a turn. A flood on one channel therefore can't delay the
+    others by more than the sum of their weights.
+
+    By default there are three channels:
+
+    * 'rpc'   - messages from the network, bounded, dropping the oldest
+      message when full as its sender has most likely given up on it
+    * 'int'   - commands from the Kad_Client, bounded, blocking the sender
+      when full
+    * 'timer' - timer actions, unbounded as timers can't wait
     '''
-    def __init__(self):
-        self.queue = Queue()
+    def __init__(self, channels=None):
+        if channels is None:
+            channels = [
+                Channel('rpc', maxsize=1024, policy='drop_old'),
+                Channel('int', maxsize=1024, policy='block'),
+                Channel('timer')
+            ]
+
+        self.channels = {}
+        self.order = []
+        for channel in channels:
+            self.channels[channel.name] = channel
+            self.order.append(channel)
+
+        self.ready = Event()
+        self.current = 0
+        self.credit = self.order[0].weight
+
+    def put(self, channel, message, block=True):
+        ''' put a message on a channel, what happens when the channel is
+        full depends on its policy. Full is raised if the channel blocks
+        and block is False. '''
+        ch = self.channels[channel]
+        while ch.full():
+            if ch.policy == 'drop_new':
+                ch.dropped += 1
+                return
+            elif ch.policy == 'drop_old':
+                ch.queue.popleft()
+                ch.dropped += 1
+            elif not block:
+                raise Full
+            else:
+                ch.space.clear()
+                ch.space.wait()
+
+        ch.queue.append(message)
+        ch.received += 1
+        if len(ch.queue) > ch.max_depth:
+            ch.max_depth = len(ch.queue)
+        self.ready.set()
+
+    def get_nowait(self):
+        ''' get a message without blocking, raises Empty if there are
+        no messages waiting '''
+        order = self.order
+        for i in xrange(len(order) + 1):
+            ch = order[self.current]
+            if ch.queue and self.credit > 0:
+                self.credit -= 1
+                message = ch.queue.popleft()
+                if ch.maxsize is not None and len(ch.queue) == ch.maxsize - 1:
+                    ch.space.set()
+                return ch.name, message
 
-    def get(self, *args, **kwargs):
-        m = self.queue.get(*args, **kwargs)
-        return m['channel'], m['message']
+            # next channel's turn
+            self.current = (self.current + 1) % len(order)
+            self.credit = order[self.current].weight
 
-    def put(self, channel, message):
-        m = { 'channel' : channel, 'message' : message }
-        self.queue.put(m)
+        raise Empty
+
+    def get(self, block=True, timeout=None):
+        ''' get a message, waiting upto timeout seconds (forever if None)
+        for one if block is True '''
+        if not block:
+            return self.get_nowait()
+
+        while True:
+            try:
+                return self.get_nowait()
+            except Empty:
+                pass
+
+            self.ready.clear()
+            if timeout is None:
+                self.ready.wait()
+            else:
+                with clock.timeout(timeout, Empty):
+                    self.ready.wait()
 
     def fetch_chan(self, channel):
-        q = SelectQueue(channel, self.queue)
+        q = SelectQueue(self, channel)
         return q
+
+    def depth(self, channel):
+        ''' the number of messages waiting on a channel '''
+        return len(self.channels[channel].queue)
+
+    def stats(self):
+        ''' returns the depth and counters of every channel '''
+        s = {}
+        for ch in self.order:
+            s[ch.name] = { 'depth'     : len(ch.queue),
+                           'max_depth' : ch.max_depth,
+                           'received'  : ch.received,
+                           'dropped'   : ch.dropped }
+        return s
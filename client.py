@@ -1,23 +1,64 @@
 from routing import Node, RoutingTree
+from lookup import Shortlist, LookupStats, LookupCache
+from rtt import RttEstimator
+from ratelimit import RateLimiter
+import internal
 from datastore.simple import simple
+from datastore.bounded import bounded
+import clock
+
+from weakref import WeakValueDictionary
+from functools import partial
+from heapq import heappush, heappop
+from itertools import izip_longest
 
 import random
-import time
 import hashlib
 import traceback
 
-import gevent
 from gevent.queue import Queue, Empty
+from gevent.event import AsyncResult
+from gevent.pool import Pool
+
+# the result of a shared lookup whose owner was killed before finishing
+_abandoned = object()
 
 class Kad_Client:
     ''' The Kad_Client class is responsible for performing primary kad
     actions which can involve multiple RPC requests and state which must be
     maintained across multiple requests '''
-    def __init__(self, pool, rpc_client, rpc_client_chan):
-        self.alpha = 3
+    def __init__(self, pool, rpc_client, rpc_client_chan, alpha_min=3, alpha_max=8):
+        self.alpha = alpha_min
+        self.alpha_min = alpha_min
+        self.alpha_max = alpha_max
+        self.alpha_slow = 0.1
         self.k     = 20
+        self.shortlist_factor = 3
+        self.path_cache = True
+        self.stats = LookupStats()
         self.pool = pool
         self.rpc_client = rpc_client
+
+        # results of recent lookups, dropped when one of their nodes fails
+        self.lookup_cache = LookupCache()
+        rpc_client.failure_listeners.append(self.lookup_cache.invalidate)
+
+        # lookups in progress, (is value lookup, target id, use_cache) => AsyncResult
+        self.lookups = {}
+
+        # how long to wait for a store to be acknowledged
+        self.store_timeout = 5.0
+
+        # limits of the batched rpcs sent by store_many and fetch_many
+        self.batch_keys = 64
+        self.batch_bytes = 32 * 1024
+        self.fetch_attempts = 2
+        self.fetch_inflight = 8
+
+        # STORE_MANY and FIND_VALUE_MANY batches are paced to half of what
+        # a node's rate limit lets us send it, leaving the rest for lookups
+        limit = rpc_client.rate_limits['STORE_MANY']
+        self.batch_pacer = RateLimiter(limit.rate / 2, limit.burst / 2)
         self.rpc_chan = rpc_client_chan
         self.node = self.rpc_client.return_node()
 
@@ -30,24 +71,14 @@ class Kad_Client:
         if self.debug:
             print "%s: %s" % (self.node, message)
 
-    def create_message(self, m_type, chan = None):
-
-        if not chan:
-            chan = Queue()
-
-        m = {
-            'type' : m_type,
-            'data' : {},
-            'chan' : chan
-        }
-        return m, chan
-
-    def blocking_send_message(self, message):
-        self.rpc_chan.put(message)
-        return message['chan'].get(block=True)
+    def blocking_send_message(self, command):
+        ''' send a command to the rpc client and wait for its reply '''
+        reply = command.expect_reply()
+        self.rpc_chan.put(command)
+        return reply.get()
 
-    def send_message(self, message):
-        self.rpc_chan.put(message)
+    def send_message(self, command):
+        self.rpc_chan.put(command)
 
     def join_network(self, nodes):
         self.pool.spawn(self._join_network, nodes)
@@ -58,41 +89,82 @@ class Kad_Client:
         '''
 
         # 1. add nodes to the network
-        m, chan = self.create_message('ADD_NODE')
-        m['data'] = nodes
-        self.blocking_send_message(m)
+        self.blocking_send_message(internal.AddNodes(nodes))
 
         # 2. perform a find node on ourselves
-        self._node_lookup(self.node)
+        self._node_lookup(self.node, use_cache=False)
 
         # 3. force refresh buckets
-        m, chan = self.create_message('REFRESH_BUCKETS')
-        self.blocking_send_message(m)
+        self.blocking_send_message(internal.RefreshBuckets())
         self.log('_join_network complete')
 
-    def store_value(self, key, value):
-        self.pool.spawn(self._store_value, key, value)
+    def store_value(self, key, value, w=None, timeout=None):
+        self.pool.spawn(self._store_value, key, value, w, timeout)
 
-    def _store_value(self, key, value):
+    def _store_value(self, key, value, w=None, timeout=None):
         ''' _store_value is a blocking method call that stores
         a value under a key within the kad network
 
-        nodes do not respond with an ack saying they
-
+        Without w the value is sent to each of the k closest nodes, which
+        do not respond with an ack saying they have stored it. With w the
+        value is only sent to the closest w nodes, asking them for an ack,
+        and a node which times out, stalls or doesn't store the value is
+        replaced by the next closest. Returns True once w nodes have acknowledged the value,
+        or False if that hasn't happened within timeout (default
+        store_timeout) seconds or there are no more nodes to try.
         '''
 
         key_hash = long(hashlib.sha1(key).hexdigest(), 16)
         nodes = self._node_lookup(Node(None, None, key_hash))
-        for node in nodes:
-            m, chan = self.create_message('STORE_VALUE')
-            m['data']['key'] = key
-            m['data']['key_hash'] = key_hash
-            m['data']['value'] = value
-            m['data']['node'] = node
-            self.send_message(m)
+        if w is None:
+            for node in nodes:
+                self.send_message(internal.StoreValue(node, key, value))
+            return
+
+        if timeout is None:
+            timeout = self.store_timeout
+        deadline = clock.time() + timeout
+        rtt = self.rpc_client.rtt
+        candidates = sorted(nodes, key=lambda n: n.id ^ key_hash)
+        inflight = {}       # node id => time the store is considered stalled
+        outstanding = 0     # stores without an ack or timeout
+        acked = set()
+        chan = Queue()
+
+        while len(acked) < w:
+            # keep enough stores going to reach w if they are all acked
+            while len(inflight) < w - len(acked) and candidates:
+                n = candidates.pop(0)
+                self.send_message(internal.StoreValue(n, key, value, chan=chan))
+                inflight[n.id] = clock.time() + rtt.stall_timeout(n)
+                outstanding += 1
+
+            now = clock.time()
+            if outstanding == 0 or now >= deadline:
+                break
+
+            wait = deadline - now
+            if inflight:
+                wait = min(wait, min(inflight.itervalues()) - now)
+            try:
+                with clock.timeout(max(wait, 0), Empty):
+                    m = chan.get()
+            except Empty:
+                now = clock.time()
+                for i, stalls in inflight.items():
+                    if stalls <= now:
+                        del inflight[i]
+                continue
+
+            outstanding -= 1
+            inflight.pop(m['node'].id, None)
+            if m.get('stored'):
+                acked.add(m['node'].id)
+
+        return len(acked) >= w
 
     def fetch_value(self, key):
-        self.pool.spawn(self._node_lookup, key)
+        self.pool.spawn(self._fetch_value, key)
 
     def _fetch_value(self, key):
         ''' _fetch_value is a blocking method call that returns
@@ -101,99 +173,345 @@ class Kad_Client:
         node = Node(None, None, key_hash)
         return self._node_lookup(node, key)
 
+    def store_many(self, items):
+        self.pool.spawn(self._store_many, items)
 
-    def _node_lookup(self, node, key = None):
-        ''' _node_lookup is a blocking call that finds k closest nodes
-        to a given node '''
-        nodes_all = []
-        nodes_queried = []
-        active_queries = 0
-        total_queries = 0
-        finished = False
+    def _store_many(self, items):
+        ''' _store_many is a blocking method call that stores a dict of
+        key => value within the kad network.
+
+        Each run of keys which can share a lookup (see _group_keys) is
+        sent to the nodes found for it, with each node receiving its
+        share in as few STORE_MANY rpcs as the batch limits allow. The
+        rpcs to each node are paced by batch_pacer, as a node drops those
+        which exceed its rate limit.
+        '''
+        sends = {}      # node id => (node, [batch])
+        for nodes, group in self._group_keys(self._hash_keys(items)):
+            batch = [(key, key_hash, items[key]) for key_hash, key in group]
+            for node in nodes:
+                sends.setdefault(node.id, (node, []))[1].extend(self._batches(batch))
+
+        senders = Pool()
+        for node, chunks in sends.itervalues():
+            senders.spawn(self._send_paced, node, chunks)
+        senders.join()
+
+    def _send_paced(self, node, chunks):
+        ''' _send_paced sends batches to a node in STORE_MANY rpcs '''
+        for chunk in chunks:
+            self._pace(node, chunk)
+            self.send_message(internal.StoreMany(node, chunk))
+
+    def _pace(self, node, chunk):
+        ''' _pace waits until batch_pacer allows a batch to be sent to a
+        node, a batch costs what the node's rate limit charges for it '''
+        wait = self.batch_pacer.reserve(node.id, 1 + len(chunk) // self.rpc_client.batch_cost)
+        if wait > 0:
+            clock.sleep(wait)
+
+    def fetch_many(self, keys):
+        self.pool.spawn(self._fetch_many, keys)
+
+    def _fetch_many(self, keys):
+        ''' _fetch_many is a blocking method call that returns a dict of
+        key => value (None if not found) for a number of keys.
+
+        Each key is asked of the closest node found for its group of keys
+        in FIND_VALUE_MANY rpcs, one per node and batch. Keys which aren't
+        found are asked of the next closest node, upto fetch_attempts
+        nodes, then looked up one at a time with _fetch_value.
+
+        The rpcs to each node are paced by batch_pacer, like those of
+        _store_many, and at most fetch_inflight are waiting for a reply.
+        '''
+        hashed = self._hash_keys(keys)
+        by_hash = dict(hashed)
+        values = dict.fromkeys(keys)
+        pending = {}        # key_hash => nodes, closest first
+
+        for nodes, group in self._group_keys(hashed):
+            for key_hash, key in group:
+                pending[key_hash] = sorted(nodes, key=lambda n: n.id ^ key_hash)
+
+        for attempt in xrange(self.fetch_attempts):
+            batches = {}    # node id => (node, [(key, key_hash)])
+            for key_hash, nodes in pending.iteritems():
+                if attempt < len(nodes):
+                    node = nodes[attempt]
+                    batches.setdefault(node.id, (node, []))[1].append((by_hash[key_hash], key_hash))
+            if not batches:
+                break
+
+            # take a batch from each node in turn, so that nodes whose
+            # batches are waiting for the pacer don't hold up the others
+            per_node = [[(node, chunk) for chunk in self._batches(batch)]
+                        for node, batch in batches.itervalues()]
+            requests = [r for turn in izip_longest(*per_node) for r in turn if r is not None]
+
+            # every query ends in a response or a timeout
+            queries = Pool(self.fetch_inflight)
+            for m in queries.imap_unordered(self._fetch_batch, requests):
+                if not m.get('timeout'):
+                    for key_hash, value in m['values'].iteritems():
+                        if key_hash in pending:
+                            del pending[key_hash]
+                            values[by_hash[key_hash]] = value
+
+        missing = [by_hash[key_hash] for key_hash in pending]
+        lookups = Pool(self.alpha_max)
+        for key, value in zip(missing, lookups.imap(self._fetch_value, missing)):
+            values[key] = value
+        return values
+
+    def _fetch_batch(self, request):
+        ''' _fetch_batch sends a (node, batch) request in a FIND_VALUE_MANY
+        rpc once it's paced and returns the reply '''
+        node, chunk = request
+        self._pace(node, chunk)
         chan = Queue()
+        self.send_message(internal.SendFindValueMany(node, chunk, chan))
+        return chan.get()
+
+    def _hash_keys(self, keys):
+        ''' _hash_keys returns a list of (key_hash, key) sorted by key_hash '''
+        return sorted((long(hashlib.sha1(key).hexdigest(), 16), key) for key in keys)
+
+    def _group_keys(self, hashed):
+        ''' _group_keys splits a sorted list of (key_hash, key) into runs of
+        keys which can share a node lookup, generating (nodes, run).
+
+        A lookup for the first key of a run finds k nodes, all of which
+        share the first p bits of the key, where the furthest differs from
+        it. Keys which also share those p bits are put in the same run,
+        sorting by hash puts them next to each other.
+
+        The grouping is approximate. The nodes found inside the subtree
+        the keys share are the closest to every key of the run, but those
+        in the sibling subtree are only the closest to the first key. A
+        key that isn't found on the nodes its run was sent to is left to
+        the _fetch_value lookups which _fetch_many falls back on.
+        '''
+        i = 0
+        while i < len(hashed):
+            target = hashed[i][0]
+            nodes = self._node_lookup(Node(None, None, target))
+            span = max([n.id ^ target for n in nodes] or [0]).bit_length()
+
+            j = i + 1
+            while j < len(hashed) and (hashed[j][0] ^ target).bit_length() < span:
+                j += 1
+            yield nodes, hashed[i:j]
+            i = j
+
+    def _batches(self, items):
+        ''' _batches splits a list of (key, key_hash[, value]) items into
+        lists of no more than batch_keys items or batch_bytes bytes of keys
+        and values, as each is to be sent in a single datagram '''
+        batch = []
+        size = 0
+        for item in items:
+            item_size = len(item[0]) + 20
+            if len(item) > 2:
+                item_size += len(item[2])
+            if batch and (len(batch) >= self.batch_keys or size + item_size > self.batch_bytes):
+                yield batch
+                batch = []
+                size = 0
+            batch.append(item)
+            size += item_size
+        if batch:
+            yield batch
+
+
+    def _node_lookup(self, node, key = None, stats = None, use_cache = True):
+        ''' _node_lookup is a blocking call that finds k closest nodes
+        to a given node, or the value stored under key.
 
-        if key == None:
-            message_type = 'SEND_FIND_NODE'
+        Only one lookup of each kind runs for a target at a time, a caller
+        asking for a target which is already being looked up waits for
+        that lookup and gets its result (or exception) rather than sending
+        queries of its own. This is counted as shared in stats. A lookup
+        made with use_cache False is only shared with others which are.
+        '''
+        flight = (key != None, node.id, use_cache)
+        result = self.lookups.get(flight)
+        if result is not None:
+            if stats is not None:
+                stats.shared += 1
+            self.stats.shared += 1
+            found = result.get()
+            if found is _abandoned:
+                return self._node_lookup(node, key, stats, use_cache)
+            if key == None:
+                return list(found)
+            return found
+
+        result = self.lookups[flight] = AsyncResult()
+        try:
+            found = self._iterative_lookup(node, key, stats, use_cache)
+        except Exception as e:
+            result.set_exception(e)
+            raise
+        except BaseException:
+            # killed or timed out by our caller, which doesn't mean the
+            # other callers should give up
+            result.set(_abandoned)
+            raise
         else:
-            message_type = 'SEND_FIND_VALUE'
+            result.set(found)
+            return found
+        finally:
+            del self.lookups[flight]
+
+    def _iterative_lookup(self, node, key = None, stats = None, use_cache = True):
+        ''' _iterative_lookup queries the network for the k closest nodes
+        to a given node, or the value stored under key.
+
+        Up to alpha queries are kept in progress. A query which hasn't been
+        answered within its node's stall timeout stops counting against
+        alpha, so another query is sent alongside it rather than waiting
+        for it to time out. What the lookup did is counted in stats (if
+        given) and in self.stats.
+
+        When a value is found it is cached (if path_cache is set) on the
+        closest node queried which didn't have it, as later lookups for the
+        key are likely to pass through that node.
+
+        The result of a node lookup is kept in the lookup cache, a repeated
+        node lookup returns the cached nodes without sending any queries
+        and a value lookup starts from them (unless use_cache is False).
+        '''
+        cached = None
+        if use_cache:
+            cached = self.lookup_cache.get(node.id)
+            if cached is not None and key == None:
+                return list(cached)
+
+        shortlist = Shortlist(node.id, self.k, self.shortlist_factor * self.k)
+        rtt = self.rpc_client.rtt
+        alpha = self.alpha
+        inflight = {}       # node id => time the query is considered stalled
+        outstanding = 0     # queries without a response, including stalled ones
+        hops = {}           # node id => hops taken to find the node
+        value = None
+        cache_node = None   # closest node which answered without the value
+        chan = Queue()
 
-        # load in closest nodes from our own routing table
-        for n in self._fetch_closest_nodes(node):
-            nodes_all.append(n)
-
-        while not finished:
-            # sort the nodes by proximity to the target node
-            nodes_all.sort(lambda a, b, num=node.id: cmp(num ^ a.id, num ^ b.id))
-
-            # if we have recieved responses from the k closest nodes we know
-            # about then finish searching
-            if len(nodes_queried) > self.k:
-                c = 0
-                search_complete = True
-                for n in nodes_all[:self.k]:
-                    c += 1
-                    if n not in nodes_queried:
-                        search_complete = False
-                        break
-
-                if search_complete:
-                    finished = True
-                    break
+        if stats is None:
+            stats = LookupStats()
+        stats.lookups += 1
+        stats.alpha += alpha
 
+        # load in closest nodes from our own routing table
+        nodes = self._fetch_closest_nodes(node)
+        if cached is not None:
+            nodes = cached + nodes
+        for n in nodes:
+            hops[n.id] = 1
+        shortlist.add(nodes)
+
+        # if we have recieved responses from the k closest nodes we know
+        # about then finish searching
+        while not shortlist.complete():
             # send queries
-            while active_queries < self.alpha:
-                sent_query = False
-                for n in nodes_all:
-                    if n not in nodes_queried:
-                        # send query
-                        m, chan = self.create_message(message_type, chan)
-                        m['data']['req_node'] = self.node
-                        m['data']['node']     = n
-                        m['data']['key']      = key
-                        active_queries += 1
-                        total_queries += 1
-                        nodes_queried.append(n)
-                        sent_query = True
-                        self.send_message(m)
-                        break
-
-                if not sent_query:
+            while len(inflight) < alpha:
+                n = shortlist.next()
+                if n is None:
                     # we've sent messages to all known nodes
                     break
+                if key == None:
+                    self.send_message(internal.SendFindNode(n, node, chan))
+                else:
+                    self.send_message(internal.SendFindValue(n, key, chan))
+                inflight[n.id] = clock.time() + rtt.stall_timeout(n)
+                outstanding += 1
+                stats.messages += 1
+                shortlist.query(n)
 
-            # wait for response, if the response contains unseen nodes
-            # then add them to our list of nodes
-            if active_queries > 0:
-                m = chan.get()
-                active_queries -= 1
-                if 'value' in m and key != None:
-                    return m['value']
-                if 'nodes' in m:
-                    for n in m['nodes']:
-                        if n not in nodes_all:
-                            nodes_all.append(n)
-            else:
+            if outstanding == 0:
                 # no more nodes to query
-                finished = True
+                break
 
-        # sort and return k nodes
+            # wait for a response, or until the next query stalls
+            try:
+                if inflight:
+                    wait = max(min(inflight.itervalues()) - clock.time(), 0)
+                    with clock.timeout(wait, Empty):
+                        m = chan.get()
+                else:
+                    m = chan.get()
+            except Empty:
+                now = clock.time()
+                for i, deadline in inflight.items():
+                    if deadline <= now:
+                        del inflight[i]
+                        stats.stalled += 1
+                continue
+
+            outstanding -= 1
+            n = m['node']
+            inflight.pop(n.id, None)
+            if m.get('timeout'):
+                # the node didn't respond, forget about it
+                stats.timeouts += 1
+                shortlist.remove(n)
+                continue
+
+            stats.responses += 1
+            stats.hops = max(stats.hops, hops[n.id])
+            shortlist.respond(n)
+            if 'value' in m and key != None:
+                value = m['value']
+                break
+
+            if key != None and (cache_node is None or
+                                n.id ^ node.id < cache_node.id ^ node.id):
+                cache_node = n
+
+            # if the response contains unseen nodes then add them to
+            # the shortlist
+            if 'nodes' in m:
+                for r in m['nodes']:
+                    if r.id not in hops:
+                        hops[r.id] = hops[n.id] + 1
+                shortlist.add(m['nodes'])
+
+        self.stats.add(stats)
+        self.adapt_alpha(stats)
+
+        if value is not None and cache_node is not None and self.path_cache:
+            self.send_message(internal.StoreValue(cache_node, key, value, cache=True))
+
+        if value is None and len(shortlist):
+            self.lookup_cache.put(node.id, shortlist.closest())
+
+        # return the k closest nodes
         if key == None:
-            nodes_all.sort(lambda a, b, num=node.id: cmp(num ^ a.id, num ^ b.id))
-            return nodes_all[:self.k]
+            return shortlist.closest()
         else:
-            return None
-
+            return value
+
+    def adapt_alpha(self, stats):
+        ''' adapt_alpha adjusts the concurrency of future lookups after a
+        lookup has finished. alpha is raised if more than alpha_slow of
+        the lookup's queries stalled or timed out, as more parallel queries
+        hide slow and lost ones, and lowered when none did. '''
+        slow = stats.stalled + stats.timeouts
+        if slow > stats.messages * self.alpha_slow:
+            self.alpha = min(self.alpha + 1, self.alpha_max)
+        elif slow == 0:
+            self.alpha = max(self.alpha - 1, self.alpha_min)
 
     def _fetch_closest_nodes(self, node):
-        m, chan = self.create_message('FIND_CLOSEST_NODES')
-        m['data'] = node
-        return self.blocking_send_message(m)
+        return self.rpc_client.find_closest_nodes(node)
 
 class Rpc_Client:
     ''' The Rpc_Client layer is responsible for communicating with other nodes
     on the network, responding to their RPC requests and starting new RPC
     requests on behalf of the Kad_Client class '''
-    def __init__(self, network, client_chan, node=None, alpha = 3):
+    def __init__(self, network, client_chan, node=None, alpha = 3, routing=RoutingTree,
+                 data_store=simple, cache_store=None):
         self.alpha = alpha       # concurrent network queries
         self.chan = client_chan  # channel for internal & network rpcs
         self.network = network   # interface to our network (nonblocking sends)
@@ -206,125 +524,248 @@ class Rpc_Client:
         node.port = self.port
 
         if node.id is None:
-            node.id = random.randint(1,2**160)
+            node.id = random.randint(1,2**160 - 1)
 
         self.node    = node
 
-        self.routing = RoutingTree(self.node)
+        # every contact we hold is interned by id, so that each id maps to
+        # a single Node however many times it is seen
+        self.contacts = WeakValueDictionary()
+        self.contacts[self.node.id] = self.node
+
+        # routing table class, RoutingTree or trie.TrieRoutingTree
+        self.routing = routing(self.node)
 
         self.rpc_actions = {
-            'PING'         : self.rpc_handle_ping,
-            'PONG'         : self.rpc_handle_pong,
-            'STORE'        : self.rpc_handle_store,
-            'FIND_VALUE'   : self.rpc_handle_find_value,
-            'FIND_NODE'    : self.rpc_handle_find_node,
-            'RETURN_NODE'  : self.rpc_handle_return_node,
-            'RETURN_VALUE' : self.rpc_handle_return_value
+            'PING'              : self.rpc_handle_ping,
+            'PONG'              : self.rpc_handle_pong,
+            'STORE'             : self.rpc_handle_store,
+            'FIND_VALUE'        : self.rpc_handle_find_value,
+            'FIND_NODE'         : self.rpc_handle_find_node,
+            'RETURN_NODE'       : self.rpc_handle_return_node,
+            'RETURN_VALUE'      : self.rpc_handle_return_value,
+            'STORE_MANY'        : self.rpc_handle_store_many,
+            'FIND_VALUE_MANY'   : self.rpc_handle_find_value_many,
+            'RETURN_VALUE_MANY' : self.rpc_handle_return_value_many,
+            'STORE_ACK'         : self.rpc_handle_store_ack
         }
 
         self.internal_actions = {
-            'ADD_NODE'           : self.int_add_node,
-            'FIND_CLOSEST_NODES' : self.int_find_closest_nodes,
-            'SEND_FIND_NODE'     : self.int_send_find_node,
-            'REFRESH_BUCKETS'    : self.int_refresh_buckets,
-            'STORE_VALUE'        : self.int_store_value,
-            'SEND_FIND_VALUE'    : self.int_send_find_value
+            internal.AddNodes          : self.int_add_nodes,
+            internal.SendFindNode      : self.int_send_find_node,
+            internal.RefreshBuckets    : self.int_refresh_buckets,
+            internal.StoreValue        : self.int_store_value,
+            internal.SendFindValue     : self.int_send_find_value,
+            internal.StoreMany         : self.int_store_many,
+            internal.SendFindValueMany : self.int_send_find_value_many
+        }
+
+        # called with each node which fails to respond in time
+        self.failure_listeners = []
+
+        # inbound requests per source, PING is cheap to answer while the
+        # others search the routing tree or the datastore
+        cheap = RateLimiter(rate=50, burst=100)
+        expensive = RateLimiter(rate=10, burst=40)
+
+        self.rate_limits = {
+            'PING'            : cheap,
+            'FIND_NODE'       : expensive,
+            'FIND_VALUE'      : expensive,
+            'STORE'           : expensive,
+            'FIND_VALUE_MANY' : expensive,
+            'STORE_MANY'      : expensive
+        }
+        # responses, which must match a transaction to be handled
+        self.responses = set(['PONG', 'RETURN_NODE', 'RETURN_VALUE',
+                              'RETURN_VALUE_MANY', 'STORE_ACK'])
+        # a batched request costs one more token for every batch_cost keys
+        self.batch_cost = 16
+        # upto this many bytes of values are returned for a batched request
+        self.max_reply_bytes = 60000
+
+        self.timer_actions = {
+            'TIMEOUTS' : self.timer_handle_timeouts,
+            'REFRESH'  : self.timer_handle_refresh,
+            'EXPIRE'   : self.timer_handle_expire
         }
 
-        self.data_store = simple()
+        # datastore class (or factory), called with our node, e.g.
+        # simple or functools.partial(bounded, max_bytes=...)
+        self.data_store = data_store(self.node)
+
+        # values cached for other nodes' lookups are kept apart from the
+        # values we are responsible for, so they can't crowd them out
+        if cache_store is None:
+            cache_store = partial(bounded, ttl=3600, max_bytes=4 * 1024 * 1024)
+        self.cache_store = cache_store(self.node)
         self.rpc_xids = {}
+        self.rpc_deadlines = []
+        self.timeout_timer = None
+        self.timeout_at = None
+        # counts timeout timers, each TIMEOUTS message carries the count
+        # of the timer which posted it
+        self.timeout_generation = 0
+        self.refresh_interval = 300
+        self.expire_interval = 60
+        self.shrink_ttl = True
+        self.min_ttl = 60
+        self.batch = 64
+        self.rtt = RttEstimator()
         self.debug = True
 
     def log(self, message):
         if self.debug:
             print "%s: %s" % (self.node, message)
 
-    def int_add_node(self, message):
-        ''' add a node to the routing tree '''
-        if 'data' in message:
-            if type(message['data']) == list:
-                for node in message['data']:
-                    self.routing.addNode(node)
-            else:
-                self.routing.addNode(message['data'])
-            message['chan'].put(True)
-        else:
-            message['chan'].put(False)
-
-    def int_find_closest_nodes(self, message):
-        ''' find the closest nodes to a given node from the routing tree '''
-        if 'data' in message:
-            nodes = self.routing.findClosestNodes(message['data'])
-            message['chan'].put(nodes)
-        else:
-            message['chan'].put([])
+    def int_add_nodes(self, command):
+        ''' add nodes to the routing tree '''
+        for node in command.nodes:
+            self.routing.addNode(self.intern_node(node.addr, node.port, node.id))
+        command.set_reply(True)
 
-    def int_send_find_node(self, message):
+    def int_send_find_node(self, command):
         ''' send find node message '''
-        if 'data' in message:
-            d = message['data']
-            self.rpc_perform_find_node(d['node'], d['req_node'], message['chan'])
+        self.rpc_perform_find_node(command.node, command.target, command.chan)
 
-    def int_refresh_buckets(self, message):
+    def int_refresh_buckets(self, command):
         ''' refresh buckets '''
         self.perform_refresh_buckets(True)
+        command.set_reply(True)
 
-        if 'chan' in message:
-            message['chan'].put(True)
-
-    def int_store_value(self, message):
+    def int_store_value(self, command):
         ''' store a value on the kad network '''
-        self.rpc_perform_store(message['data']['node'],
-                               message['data']['key'],
-                               message['data']['value'])
-
-    def int_send_find_value(self, message):
-        if 'data' in message:
-            d = message['data']
-            self.rpc_perform_find_value(d['node'], d['key'], message['chan'])
+        self.rpc_perform_store(command.node, command.key, command.value, command.cache,
+                               command.chan)
+
+    def int_send_find_value(self, command):
+        self.rpc_perform_find_value(command.node, command.key, command.chan)
+
+    def int_store_many(self, command):
+        ''' store a batch of values on a node '''
+        self.rpc_perform_store_many(command.node, command.items)
+
+    def int_send_find_value_many(self, command):
+        self.rpc_perform_find_value_many(command.node, command.keys, command.chan)
+
+    def find_closest_nodes(self, node, count=None):
+        ''' find the closest nodes to a given node from the routing tree.
+
+        This only reads the routing tree and doesn't yield, so unlike the
+        commands it may be called directly from other greenlets. '''
+        return self.routing.findClosestNodes(node, count)
+
+    def intern_node(self, addr, port, node_id, update=True):
+        ''' intern_node returns the Node for node_id, creating it if this
+        id hasn't been seen before. The address of a known node is updated
+        in place unless update is False, as it should be when the contact
+        was reported by a third party rather than seen directly. '''
+        node = self.contacts.get(node_id)
+        if node is None:
+            node = Node(addr, port, node_id)
+            self.contacts[node_id] = node
+        elif update and node is not self.node:
+            node.addr = addr
+            node.port = port
+        return node
 
     def return_node(self):
         ''' return a copy of our node '''
         return Node(self.node.addr, self.node.port, self.node.id)
 
     def rpc_handle_timeouts(self):
-        ''' look through our in progress rpc's and timeout any which
-        we haven't got a response from within the timeout period '''
-        now = time.time()
-        to_delete = []
-        for xid in self.rpc_xids:
-            transaction = self.rpc_xids[xid]
-            running = now - transaction['sent']
-            if running > transaction['timeout']:
-                if transaction['chan'] != None:
-                    pass
-                to_delete.append(xid)
-
-        for xid in to_delete:
+        ''' timeout any in progress rpc's which we haven't got a response
+        from within the timeout period.
+
+        Deadlines are kept in a heap so only expired transactions are
+        looked at. Transactions which have been answered are left in the
+        heap and skipped when their deadline comes round. The waiting chan
+        (if any) is sent a timeout result, the failure listeners are told
+        about the silent node and it is marked as having errored in the
+        routing tree (which removes it after too many errors).
+        '''
+        now = clock.time()
+        deadlines = self.rpc_deadlines
+        while deadlines and deadlines[0][0] <= now:
+            deadline, xid = heappop(deadlines)
+            transaction = self.rpc_xids.get(xid)
+            if transaction is None or transaction['deadline'] != deadline:
+                # already answered
+                continue
+
             del self.rpc_xids[xid]
+            node = transaction['dest']
+            self.rtt.backoff(node)
+            for listener in self.failure_listeners:
+                listener(node)
+            try:
+                self.routing.errorNode(node)
+            except ValueError:
+                # no longer in the routing tree
+                pass
+
+            if transaction['chan'] != None:
+                transaction['chan'].put({ 'timeout' : True, 'node' : node })
 
     def rpc_add_transaction(self, xid, m_type, dest_node, chan = None, timeout = None):
 
         if timeout is None:
-            #  TODO: config default timeout? or maybe timeout is required.
-            timeout = 2
+            timeout = self.rtt.timeout(dest_node)
 
+        now = clock.time()
         self.rpc_xids[xid] = {
-            'dest'    : dest_node,
-            'type'    : m_type,
-            'sent'    : time.time(),
-            'chan'    : chan,
-            'timeout' : timeout
+            'dest'     : dest_node,
+            'type'     : m_type,
+            'sent'     : now,
+            'chan'     : chan,
+            'timeout'  : timeout,
+            'deadline' : now + timeout
         }
+        heappush(self.rpc_deadlines, (now + timeout, xid))
+        self.rpc_schedule_timeouts()
+
+    def rpc_schedule_timeouts(self):
+        ''' rpc_schedule_timeouts makes sure the timeout timer will go off
+        at the earliest rpc deadline. Answered transactions at the front
+        of the deadline heap are dropped first so they don't wake us. '''
+        deadlines = self.rpc_deadlines
+        while deadlines:
+            transaction = self.rpc_xids.get(deadlines[0][1])
+            if transaction is not None and transaction['deadline'] == deadlines[0][0]:
+                break
+            heappop(deadlines)
+
+        if not deadlines:
+            return
+
+        deadline = deadlines[0][0]
+        if self.timeout_timer is not None:
+            if self.timeout_at <= deadline:
+                return
+            self.timeout_timer.cancel()
+        self.timeout_at = deadline
+        self.timeout_generation += 1
+        self.timeout_timer = self.start_timer(deadline - clock.time(), 'TIMEOUTS',
+                                              self.timeout_generation)
+
+    def rpc_end_transaction(self, message):
+        ''' rpc_end_transaction removes and returns the transaction a
+        response belongs to, or None if there isn't one (e.g. it has
+        already timed out). The round trip time is sampled for the node
+        the request was sent to. '''
+        transaction = self.rpc_xids.pop(message.get('xid'), None)
+        if transaction is not None:
+            self.rtt.sample(transaction['dest'], clock.time() - transaction['sent'])
+        return transaction
 
     def rpc_create_message(self, msg_type, xid=None):
         ''' rpc_create_message creates a message to be sent to another node.
         If a transaction id is not specified then one is created.
         '''
         if not xid:
-            xid = random.randint(0,2**160)
+            xid = random.getrandbits(64)
             while xid in self.rpc_xids:
-                xid = random.randint(0,2**160)
+                xid = random.getrandbits(64)
 
         return {
             'source': [ self.node.addr, self.node.port, self.node.id ],
@@ -359,12 +800,14 @@ class Rpc_Client:
     def rpc_perform_ping(self, node, chan):
         ''' rpc_perform_ping sends 'PING' request to the given node '''
         m = self.rpc_create_message('PING')
-        self.send_rpc_message(node.addr, node.port, m, chan)
-        self.add_transaction(m['xid'], 'PING', node)
+        self.rpc_add_transaction(m['xid'], 'PING', node, chan)
+        self.rpc_send_message(node.addr, node.port, m)
 
-    def rpc_perform_store(self, node, key, value):
+    def rpc_perform_store(self, node, key, value, cache=False, chan=None):
         ''' rpc_perform_store sends a 'STORE' rpc to the
-        requested node '''
+        requested node, asking it only to cache the value if cache
+        is set. If there is a chan the node is asked to acknowledge
+        the STORE, which is tracked as a transaction. '''
 
         key_hash = long(hashlib.sha1(key).hexdigest(), 16)
 
@@ -374,77 +817,151 @@ class Rpc_Client:
             'key_hash': key_hash,
             'value': value
         }
+        if cache:
+            m['data']['cache'] = True
+        if chan is not None:
+            m['data']['ack'] = True
+            self.rpc_add_transaction(m['xid'], 'STORE', node, chan)
+        self.rpc_send_message(node.addr, node.port, m)
+
+    def rpc_perform_store_many(self, node, items):
+        ''' rpc_perform_store_many sends a 'STORE_MANY' rpc holding a
+        batch of (key, key_hash, value) items to the requested node '''
+        m = self.rpc_create_message('STORE_MANY')
+        m['data'] = [{ 'key' : key, 'key_hash' : key_hash, 'value' : value }
+                     for key, key_hash, value in items]
+        self.rpc_send_message(node.addr, node.port, m)
+
+    def rpc_perform_find_value_many(self, node, keys, chan):
+        ''' rpc_perform_find_value_many sends a 'FIND_VALUE_MANY' rpc for
+        a batch of (key, key_hash) keys to the requested node '''
+        m = self.rpc_create_message('FIND_VALUE_MANY')
+        m['data'] = [{ 'key' : key, 'key_hash' : key_hash } for key, key_hash in keys]
+        self.rpc_add_transaction(m['xid'], 'FIND_VALUE_MANY', node, chan)
         self.rpc_send_message(node.addr, node.port, m)
 
-    def rpc_handle_find_node(self, message):
+    def rpc_handle_find_node(self, message, source):
         ''' rpc_handle_find_node looks for a node_id in the 'data
         portion of the message. The client then returns upto k
         nodes from our routing tree which are closest to the
         requested node.
         '''
-        source = message['source']
         node_to_find = Node(None, None, message['data'])
         nodes = self.routing.findClosestNodes(node_to_find)
         m = self.rpc_create_message('RETURN_NODE', message['xid'])
         m['data'] = [(n.addr, n.port, n.id) for n in nodes]
         self.rpc_send_message(source.addr, source.port, m)
 
-    def rpc_handle_return_node(self, message):
+    def rpc_handle_return_node(self, message, source):
         ''' rpc_handle_return_node handles a 'RETURN_NODE' message,
         add all returned nodes to the routing tree
         if there is a channel associated with this request then
         send the node list back
         '''
-        if 'xid' in message and message['xid'] in self.rpc_xids:
+        transaction = self.rpc_end_transaction(message)
+        if transaction is not None:
             nodes = []
 
             for node in message['data']:
-                n = Node(node[0], node[1], node[2])
+                n = self.intern_node(node[0], node[1], node[2], False)
                 self.routing.addNode(n)
                 nodes.append(n)
 
-            if self.rpc_xids[message['xid']]['chan']:
-                m = { 'timeout' : False, 'nodes' : nodes }
-                self.rpc_xids[message['xid']]['chan'].put(m)
-
-            del self.rpc_xids[message['xid']]
+            if transaction['chan']:
+                m = { 'timeout' : False, 'nodes' : nodes, 'node' : source }
+                transaction['chan'].put(m)
 
-    def rpc_handle_ping(self, message):
+    def rpc_handle_ping(self, message, source):
         ''' rpc_handle_ping handles the rpc 'PING' message '''
-        source = message['source']
         m = self.rpc_create_message('PONG', message['xid'])
         self.rpc_send_message(source.addr, source.port, m)
 
-    def rpc_handle_pong(self, message):
+    def rpc_handle_pong(self, message, source):
         ''' rpc_handle_pong handles the rpc 'PONG' message '''
-        if 'xid' in message and message['xid'] in self.rpc_xids:
-            if self.rpc_xids[message['xid']]['chan']:
-                self.rpc_xids[message['xid']]['chan'].put(True)
-
-            del self.rpc_xids[message['xid']]
+        transaction = self.rpc_end_transaction(message)
+        if transaction is not None and transaction['chan']:
+            transaction['chan'].put(True)
 
-    def rpc_handle_store(self, message):
+    def rpc_handle_store(self, message, source):
         ''' rpc_handle_store handles the rpc 'STORE' which is to
-        store the requested key/value in our datastore '''
+        store the requested key/value in our datastore, replying with
+        a 'STORE_ACK' if asked to. The ack says whether the value was
+        stored, so a sender whose value we turned away can go straight
+        to another node rather than waiting for us to time out. '''
+        stored = self.store_item(message['data'])
+        if message['data'].get('ack'):
+            m = self.rpc_create_message('STORE_ACK', message['xid'])
+            m['data'] = { 'stored' : bool(stored) }
+            self.rpc_send_message(source.addr, source.port, m)
+
+    def rpc_handle_store_ack(self, message, source):
+        ''' rpc_handle_store_ack handles the rpc 'STORE_ACK' message, a
+        node which didn't store the value has still answered, so it isn't
+        treated as failed '''
+        transaction = self.rpc_end_transaction(message)
+        if transaction is not None and transaction['chan']:
+            transaction['chan'].put({ 'timeout' : False, 'node' : source,
+                                      'stored' : bool(message['data'].get('stored')) })
+
+    def rpc_handle_store_many(self, message, source):
+        ''' rpc_handle_store_many handles the rpc 'STORE_MANY', each item
+        is stored as if it had been sent in its own 'STORE' '''
+        for data in message['data']:
+            self.store_item(data)
+
+    def store_item(self, data):
+        ''' store_item stores a key/value sent to us. Values sent to be
+        cached go to the cache store, for no longer than its ttl, unless
+        we hold the value already. Returns False if the value wasn't
+        stored. '''
         required = ['key', 'key_hash', 'value']
-        data = message['data']
-        if all(k in data for k in required):
-            self.log('stored %s => %s' %(data['key'], data['value']))
-            self.data_store.store(data['key'], data['key_hash'], data['value'])
-
-    def rpc_handle_find_value(self, message):
+        if not all(k in data for k in required):
+            return False
+
+        ttl = self.store_ttl(data['key_hash'])
+        if data.get('cache'):
+            if self.data_store.contains(data['key_hash']):
+                return True
+            return self.cache_store.store(data['key'], data['key_hash'], data['value'],
+                                          min(ttl, self.cache_store.ttl))
+
+        self.log('stored %s => %s' %(data['key'], data['value']))
+        return self.data_store.store(data['key'], data['key_hash'], data['value'], ttl)
+
+    def store_ttl(self, key_hash):
+        ''' store_ttl returns how long a value stored with us should be
+        kept. If shrink_ttl is set and we know of at least k nodes closer
+        to the key than ourselves then we aren't one of the nodes that
+        should be holding the value, and the ttl halves for every further
+        closer node (as described in the kademlia paper), down to min_ttl.
+        '''
+        ttl = self.data_store.ttl
+        if not self.shrink_ttl:
+            return ttl
+
+        k = self.routing.k
+        distance = self.node.id ^ key_hash
+        closer = 0
+        for n in self.routing.findClosestNodes(Node(None, None, key_hash), 2 * k):
+            if n.id ^ key_hash >= distance:
+                break
+            closer += 1
+
+        if closer < k:
+            return ttl
+        return max(ttl / 2.0 ** (closer - k + 1), self.min_ttl)
+
+    def rpc_handle_find_value(self, message, source):
         ''' rpc_handle_find_value handles the rpc 'FIND_VALUE' message
         it either returns the value, if it is stored at this node or
         returns the closest k nodes to the requested key from our
         routing tree
         '''
-        key_hash = message['data']['key_hash']
-        source = message['source']
-        value = self.data_store.retrieve(key_hash)
+        value = self.retrieve_value(message['data']['key_hash'])
         if value is not None:
             response = { 'value' : value, 'found' : True }
         else:
-            node_to_find = Node(None, None, key_hash)
+            node_to_find = Node(None, None, message['data']['key_hash'])
             nodes = self.routing.findClosestNodes(node_to_find)
             nodes = [(n.addr, n.port, n.id) for n in nodes]
             response = { 'nodes' : nodes, 'found' : False }
@@ -453,24 +970,98 @@ class Rpc_Client:
         m['data'] = response
         self.rpc_send_message(source.addr, source.port, m)
 
-    def rpc_handle_return_value(self, message):
-        if 'xid' in message and message['xid'] in self.rpc_xids:
-            if self.rpc_xids[message['xid']]['chan']:
-                self.rpc_xids[message['xid']]['chan'].put(message['data'])
-            del self.rpc_xids[message['xid']]
+    def rpc_handle_find_value_many(self, message, source):
+        ''' rpc_handle_find_value_many handles the rpc 'FIND_VALUE_MANY'
+        message, returning the values we hold out of those requested.
+        Values past max_reply_bytes are left out, the requester treats
+        them as not found. '''
+        values = []
+        size = 0
+        for data in message['data']:
+            value = self.retrieve_value(data['key_hash'])
+            if value is not None and size + len(value) <= self.max_reply_bytes:
+                values.append({ 'key_hash' : data['key_hash'], 'value' : value })
+                size += len(value)
+
+        m = self.rpc_create_message('RETURN_VALUE_MANY', message['xid'])
+        m['data'] = values
+        self.rpc_send_message(source.addr, source.port, m)
+
+    def retrieve_value(self, key_hash):
+        ''' retrieve_value returns the value held under key_hash by either
+        of our datastores, or None '''
+        value = self.data_store.retrieve(key_hash)
+        if value is None:
+            value = self.cache_store.retrieve(key_hash)
+        return value
+
+    def rpc_handle_return_value(self, message, source):
+        ''' rpc_handle_return_value handles a 'RETURN_VALUE' message,
+        any returned nodes are added to the routing tree and passed
+        back as Node objects along with the value and the responding node '''
+        transaction = self.rpc_end_transaction(message)
+        if transaction is not None:
+            data = message['data']
+            if 'nodes' in data:
+                nodes = []
+                for node in data['nodes']:
+                    n = self.intern_node(node[0], node[1], node[2], False)
+                    self.routing.addNode(n)
+                    nodes.append(n)
+                data = { 'nodes' : nodes, 'found' : data['found'], 'node' : source }
+            else:
+                data = { 'value' : data['value'], 'found' : data['found'], 'node' : source }
+
+            if transaction['chan']:
+                transaction['chan'].put(data)
+
+    def rpc_handle_return_value_many(self, message, source):
+        ''' rpc_handle_return_value_many handles a 'RETURN_VALUE_MANY'
+        message, passing back the values found by key_hash along with the
+        responding node '''
+        transaction = self.rpc_end_transaction(message)
+        if transaction is not None and transaction['chan']:
+            values = dict((data['key_hash'], data['value']) for data in message['data'])
+            transaction['chan'].put({ 'timeout' : False, 'values' : values, 'node' : source })
 
     def rpc_handle_message(self, m):
         ''' rpc_handle_message is the initial handler for all rpc messages
-        the correct method will be called based on the message type
+        the correct method will be called based on the message type and
+        passed the message along with the sending node.
+
+        Requests over their source's rate limit are dropped before the
+        source is added to the routing tree. The limit is kept per (addr,
+        port) the message was received from, as reported by the transport
+        in 'peer' (the address the sender claims otherwise), so a sender
+        can't spend another's budget, while the many nodes which may share
+        an address each have their own. Responses aren't
+        limited, instead they are dropped unless they answer one of our
+        own requests to the node they claim to be from.
+
+        Messages may be shared with the sender and other receivers so
+        they must never be modified.
         '''
         if 'type' in m and m['type'] in self.rpc_actions:
+            limiter = self.rate_limits.get(m['type'])
+            if limiter is not None:
+                cost = 1
+                if m['type'].endswith('_MANY'):
+                    cost += len(m['data']) // self.batch_cost
+                peer = m.get('peer', m['source'])
+                if not limiter.allow((peer[0], peer[1]), cost):
+                    return
+            elif m['type'] in self.responses:
+                transaction = self.rpc_xids.get(m.get('xid'))
+                if transaction is None or transaction['dest'].id != m['source'][2]:
+                    # unsolicited, or too late
+                    return
+
             # add node into our routing tree
-            node = Node(m['source'][0], m['source'][1], m['source'][2])
+            node = self.intern_node(m['source'][0], m['source'][1], m['source'][2])
             self.routing.addNode(node)
-            m['source'] = node
 
             # handle message
-            self.rpc_actions[m['type']](m)
+            self.rpc_actions[m['type']](m, node)
         else:
             self.log("process_message malformed message: %s" % m)
 
@@ -479,47 +1070,85 @@ class Rpc_Client:
         #self.log('send_rpc_message => %s:%s %s' % (addr, port, message['type']))
         self.network.send(addr, port, message)
 
-    def int_handle_message(self, m):
-        ''' handle internal (non rpc) message '''
-        if 'type' in m and m['type'] in self.internal_actions:
-            self.internal_actions[m['type']](m)
+    def int_handle_message(self, command):
+        ''' handle internal (non rpc) command, a command which fails
+        passes the exception to anyone waiting for its reply '''
+        action = self.internal_actions.get(type(command))
+        if action is not None:
+            try:
+                action(command)
+            except Exception as e:
+                command.set_exception(e)
+                raise
         else:
-            self.log("int_handle_message: malformed: %s" % m)
+            self.log("int_handle_message: unknown command: %s" % command)
 
     def perform_refresh_buckets(self, force=False):
         ''' refresh buckets performs a find_node rpc against
         a node from each bucket which requires a refresh '''
         nodes = self.routing.fetchRefreshNodes(force)
         for node in nodes:
-            self.rpc_perform_find_node(self.node, node, None)
-
-    def run_events(self):
-        ''' run_events checks for any events which need to be run
-        periodically, such as:
-
-        * timing out rpc requests
-        * refreshing buckets
-        '''
+            self.rpc_perform_find_node(node, node, None)
+
+    def start_timer(self, seconds, action, *args):
+        ''' start_timer arranges for a timer action to be handled by
+        the main loop after a number of seconds, it's called with args '''
+        return clock.call_later(seconds, self.chan.put, 'timer', (action,) + args)
+
+    def timer_handle_timeouts(self, generation):
+        ''' timeout expired rpc requests and wait for the next deadline.
+        A TIMEOUTS message can be stale, left by a timer which has since
+        been replaced, so the timer is only forgotten if it's the one
+        which posted the message. '''
+        if generation == self.timeout_generation:
+            self.timeout_timer = None
         self.rpc_handle_timeouts()
+        self.rpc_schedule_timeouts()
+
+    def timer_handle_refresh(self):
+        ''' refresh any buckets which need it and wait for the next
+        refresh interval '''
         self.perform_refresh_buckets()
+        self.start_timer(self.refresh_interval, 'REFRESH')
+
+    def timer_handle_expire(self):
+        ''' remove expired values from the datastores '''
+        self.data_store.expire()
+        self.cache_store.expire()
+        self.start_timer(self.expire_interval, 'EXPIRE')
+
+    def handle_message(self, chan, message):
+        ''' handle_message handles a message from any channel '''
+        try:
+            if chan == 'rpc':
+                self.rpc_handle_message(message)
+            elif chan == 'int':
+                self.int_handle_message(message)
+            elif chan == 'timer':
+                self.timer_actions[message[0]](*message[1:])
+            else:
+                self.log('unhandled message: %s' % message)
+        except:
+            self.log('Client exception')
+            if self.debug:
+                traceback.print_exc()
 
     def main(self):
+        ''' main blocks until there are messages and then handles up to
+        batch of them before letting other greenlets run. Periodic work,
+        timing out rpc requests, refreshing buckets and expiring values, is done from
+        timers so an idle client isn't woken up. '''
+        self.start_timer(self.refresh_interval, 'REFRESH')
+        self.start_timer(self.expire_interval, 'EXPIRE')
         while True:
-            try:
-                chan, message = self.chan.get(block=True, timeout=2)
-                if chan == 'rpc':
-                    self.rpc_handle_message(message)
-                elif chan == 'int':
-                    self.int_handle_message(message)
-                else:
-                    self.log('unhandled message: %s' % message)
-            except Empty: pass
-            except:
-                self.log('Client exception')
-                if self.debug:
-                    traceback.print_exc()
-
-            self.run_events()
-
-            # allow other threads the chance to run
-            gevent.sleep()
+            chan, message = self.chan.get(block=True)
+            self.handle_message(chan, message)
+            for i in xrange(self.batch - 1):
+                try:
+                    chan, message = self.chan.get_nowait()
+                except Empty:
+                    break
+                self.handle_message(chan, message)
+            else:
+                # allow other threads the chance to run
+                clock.sleep()
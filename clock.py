@@ -0,0 +1,174 @@
+''' clock provides the time, sleeps, timeouts and timers used by the routing
+and client code. By default these are the system clock and gevent's
+timers, but a VirtualClock can be installed with set_clock to run a
+simulation in virtual time.
+
+    import clock
+    clock.time()
+    clock.sleep(5)
+    with clock.timeout(2, Empty):
+        ...
+'''
+import time as _time
+import heapq
+
+import gevent
+from gevent.event import Event
+
+class RealTimer:
+    ''' RealTimer calls a function after a delay using gevent's event loop '''
+    def __init__(self, seconds, callback, args):
+        self.timer = gevent.get_hub().loop.timer(max(seconds, 0))
+        self.timer.start(callback, *args)
+
+    def cancel(self):
+        self.timer.stop()
+
+class RealClock:
+    ''' RealClock uses the system clock and gevent's timers '''
+    def time(self):
+        return _time.time()
+
+    def sleep(self, seconds=0):
+        gevent.sleep(seconds)
+
+    def timeout(self, seconds, exception=None):
+        return gevent.Timeout(seconds, exception)
+
+    def call_later(self, seconds, callback, *args):
+        return RealTimer(seconds, callback, args)
+
+class VirtualTimer:
+    ''' VirtualTimer is an event scheduled on a VirtualClock '''
+    __slots__ = ('when', 'callback', 'args')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+
+    def cancel(self):
+        self.callback = None
+        self.args = None
+
+class VirtualTimeout(BaseException):
+    ''' VirtualTimeout behaves like gevent.Timeout but expires in virtual
+    time. When it expires the exception (or the timeout itself) is raised
+    in the greenlet which started it. '''
+    def __init__(self, clock, seconds, exception=None):
+        BaseException.__init__(self)
+        self.clock = clock
+        self.seconds = seconds
+        self.exception = exception
+        self.timer = None
+
+    def start(self):
+        if self.seconds is not None:
+            self.timer = self.clock.call_later(self.seconds, self._expire, gevent.getcurrent())
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def _expire(self, greenlet):
+        self.timer = None
+        exception = self.exception
+        if exception is None:
+            exception = self
+        # switch to the greenlet from the hub, as a gevent timer would
+        gevent.get_hub().loop.run_callback(greenlet.throw, exception)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, typ, value, tb):
+        self.cancel()
+        return value is self and self.exception is False
+
+    def __str__(self):
+        return '%s seconds' % self.seconds
+
+class VirtualClock:
+    ''' VirtualClock is a discrete event scheduler. Timers are held in a heap
+    ordered by their expiry time, ties are broken by the order in which they
+    were scheduled so that runs are deterministic.
+
+    Time only moves when run() is running and every greenlet is blocked,
+    the clock then jumps straight to the next timer, so a simulation runs as
+    fast as the cpu allows rather than in real time.
+    '''
+    def __init__(self, start=0.0):
+        self.now = start
+        self.events = []
+        self.seq = 0
+        self.processed = 0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds=0):
+        if seconds <= 0:
+            gevent.sleep()
+            return
+
+        wakeup = Event()
+        self.call_later(seconds, wakeup.set)
+        wakeup.wait()
+
+    def timeout(self, seconds, exception=None):
+        return VirtualTimeout(self, seconds, exception)
+
+    def call_later(self, seconds, callback, *args):
+        timer = VirtualTimer(self.now + max(seconds, 0), callback, args)
+        self.seq += 1
+        heapq.heappush(self.events, (timer.when, self.seq, timer))
+        return timer
+
+    def run(self, until=None):
+        ''' run processes events until there are none left or the virtual
+        time reaches 'until'. Between events every runnable greenlet is
+        allowed to run until it blocks. '''
+        while True:
+            gevent.idle()
+
+            if not self.events:
+                break
+
+            when, seq, timer = self.events[0]
+            if until is not None and when > until:
+                self.now = until
+                break
+
+            heapq.heappop(self.events)
+            if timer.callback is None:
+                continue
+
+            self.now = max(self.now, when)
+            callback, args = timer.callback, timer.args
+            timer.cancel()
+            self.processed += 1
+            callback(*args)
+
+_clock = RealClock()
+
+def set_clock(c):
+    ''' set_clock replaces the clock used by every module '''
+    global _clock
+    _clock = c
+
+def get_clock():
+    return _clock
+
+def time():
+    return _clock.time()
+
+def sleep(seconds=0):
+    _clock.sleep(seconds)
+
+def timeout(seconds, exception=None):
+    return _clock.timeout(seconds, exception)
+
+def call_later(seconds, callback, *args):
+    return _clock.call_later(seconds, callback, *args)
@@ -0,0 +1,147 @@
+import clock
+from datastore.simple import simple
+
+from collections import OrderedDict
+from heapq import heappush, heappop, heapify
+
+class LruPolicy:
+    ''' LruPolicy evicts the least recently stored or retrieved value '''
+    def __init__(self, node=None):
+        self.order = OrderedDict()
+
+    def stored(self, key_hash):
+        self.order.pop(key_hash, None)
+        self.order[key_hash] = None
+
+    def accessed(self, key_hash):
+        self.stored(key_hash)
+
+    def removed(self, key_hash):
+        self.order.pop(key_hash, None)
+
+    def victim(self):
+        return next(iter(self.order))
+
+    def prefer(self, key_hash, victim):
+        return True
+
+class DistancePolicy:
+    ''' DistancePolicy evicts the value whose key is furthest from our own
+    node id, keeping the values we are most responsible for. A new value
+    which would itself be the furthest is turned away instead. '''
+    def __init__(self, node):
+        self.node_id = node.id
+        self.heap = []          # heap of (-distance, key_hash)
+        self.present = set()
+
+    def stored(self, key_hash):
+        if key_hash not in self.present:
+            self.present.add(key_hash)
+            heappush(self.heap, (-(key_hash ^ self.node_id), key_hash))
+
+    def accessed(self, key_hash):
+        pass
+
+    def removed(self, key_hash):
+        self.present.discard(key_hash)
+        # removed keys are left in the heap until they reach the top,
+        # unless they come to outnumber the keys present
+        if len(self.heap) > 2 * len(self.present) + 64:
+            self.heap = [(-(k ^ self.node_id), k) for k in self.present]
+            heapify(self.heap)
+
+    def victim(self):
+        heap = self.heap
+        while heap[0][1] not in self.present:
+            heappop(heap)
+        return heap[0][1]
+
+    def prefer(self, key_hash, victim):
+        return key_hash ^ self.node_id < victim ^ self.node_id
+
+class bounded(simple):
+    ''' bounded is an in memory data store which holds at most max_bytes
+    of keys and values (values are strings, as they are sent on the
+    wire). When a new value doesn't fit, values are evicted in the order
+    given by the policy, LruPolicy or DistancePolicy. A value which can't
+    be made to fit is not stored.
+
+    Values expire as they do in simple, expired values are removed to make
+    room before any value is evicted.
+    '''
+    def __init__(self, node=None, ttl=86400, max_bytes=64 * 1024 * 1024, policy=LruPolicy):
+        simple.__init__(self, node, ttl)
+        self.max_bytes = max_bytes
+        self.policy = policy(node)
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rejected = 0
+
+    def store(self, key, key_hash, value, ttl=None):
+        ''' store a value, returns False if it couldn't be stored '''
+        size = len(key) + len(value)
+        if size > self.max_bytes:
+            self.rejected += 1
+            return False
+
+        old = None
+        if key_hash in self.hash_value:
+            old = (self.hash_key[key_hash], self.hash_value[key_hash],
+                   self.hash_expires[key_hash] - clock.time())
+            self.remove(key_hash)
+
+        if self.bytes + size > self.max_bytes:
+            # expired values go before any live value is evicted
+            self.expire()
+
+        while self.bytes + size > self.max_bytes:
+            victim = self.policy.victim()
+            if not self.policy.prefer(key_hash, victim):
+                self.rejected += 1
+                if old is not None and old[2] > 0:
+                    # put back the value we were replacing, it fits in
+                    # the space it was taking before
+                    key, value, ttl = old
+                    self.bytes += len(key) + len(value)
+                    self.policy.stored(key_hash)
+                    simple.store(self, key, key_hash, value, ttl)
+                return False
+
+            self.remove(victim)
+            self.evictions += 1
+
+        self.bytes += size
+        self.policy.stored(key_hash)
+        return simple.store(self, key, key_hash, value, ttl)
+
+    def retrieve(self, key_hash):
+        value = simple.retrieve(self, key_hash)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.policy.accessed(key_hash)
+        return value
+
+    def contains(self, key_hash):
+        ''' contains doesn't count as a hit or miss, or as a use of the
+        value by the policy '''
+        return simple.contains(self, key_hash)
+
+    def remove(self, key_hash):
+        if key_hash in self.hash_value:
+            self.bytes -= len(self.hash_key[key_hash]) + len(self.hash_value[key_hash])
+            self.policy.removed(key_hash)
+        simple.remove(self, key_hash)
+
+    def stats(self):
+        return { 'entries'   : len(self.hash_value),
+                 'bytes'     : self.bytes,
+                 'max_bytes' : self.max_bytes,
+                 'hits'      : self.hits,
+                 'misses'    : self.misses,
+                 'evictions' : self.evictions,
+                 'rejected'  : self.rejected }
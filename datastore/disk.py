@@ -0,0 +1,392 @@
+import clock
+
+import os
+import mmap
+import struct
+import zlib
+from binascii import unhexlify
+
+import gevent
+
+class DiskStoreError(Exception):
+    ''' DiskStoreError is raised when the files of a disk store can't be
+    used '''
+
+class disk:
+    ''' disk is a data store which keeps values on disk, so they survive a
+    restart, with the same interface as simple.
+
+    Values are appended to a log (data.log), a record is never changed
+    once written, removing a value appends a tombstone. The index
+    (data.idx) is a sorted array of (key_hash, log offset) entries which
+    is memory mapped and binary searched, so opening a store doesn't read
+    it. Changes since the index was written are held in a dict (the
+    delta), which is merged into a new index once it reaches max_delta
+    entries, and are replayed from the end of the log on open. Memory use
+    is therefore bounded by max_delta whatever the size of the data.
+
+    Overwritten, removed and expired records are garbage which is dropped
+    by compacting into a new log and index, in a background greenlet that
+    lets other greenlets run every yield_every records. The log and index
+    carry a generation number so that an index which doesn't belong to
+    the log (e.g. after a crash part way through swapping in compacted
+    files) is ignored and rebuilt from the log.
+    '''
+    log_magic = 'KADLOG01'
+    index_magic = 'KADIDX01'
+
+    log_header = struct.Struct('!8sQ')          # magic, generation
+    record = struct.Struct('!I20sdBHI')         # crc, key_hash, expires, removed,
+                                                # key length, value length
+    index_header = struct.Struct('!8sQQQQd')    # magic, generation, entries, log end,
+                                                # live bytes, earliest expiry
+    entry = struct.Struct('!20sQ')              # key_hash, log offset
+
+    def __init__(self, node=None, ttl=86400, path='data', max_delta=10000,
+                 min_garbage=1024 * 1024, compact_interval=3600, yield_every=256):
+        self.node = node
+        self.ttl = ttl
+        self.path = path
+        self.max_delta = max_delta
+        self.min_garbage = min_garbage
+        self.compact_interval = compact_interval
+        self.yield_every = yield_every
+
+        self.log_path = os.path.join(path, 'data.log')
+        self.index_path = os.path.join(path, 'data.idx')
+
+        self.compacting = None
+        self.compactions = 0
+        self.last_compaction = clock.time()
+        self.writer = self.reader = self.index = None
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._open()
+
+    def _pack(self, key_hash):
+        return unhexlify('%040x' % key_hash)
+
+    def _open(self):
+        ''' open the log and index, replaying any of the log which isn't
+        covered by the index '''
+        if not os.path.exists(self.log_path):
+            with open(self.log_path, 'wb') as f:
+                f.write(self.log_header.pack(self.log_magic, 1))
+
+        self.writer = open(self.log_path, 'ab')
+        self.reader = open(self.log_path, 'rb')
+        magic, self.generation = self.log_header.unpack(self.reader.read(self.log_header.size))
+        if magic != self.log_magic:
+            raise DiskStoreError('%s is not a log' % self.log_path)
+        self.end = os.fstat(self.writer.fileno()).st_size
+
+        self.delta = {}         # packed key_hash => offset, None once removed
+        if self._map_index():
+            start = self.log_end
+        else:
+            # no usable index, rebuild it from the whole log
+            self.count = 0
+            self.live = 0
+            self.min_expires = float('inf')
+            start = self.log_header.size
+
+        self._replay(start)
+        if start == self.log_header.size and self.end > start:
+            self.flush()
+
+    def _map_index(self):
+        ''' map the index if it exists and belongs to the log '''
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+        if not os.path.exists(self.index_path):
+            return False
+
+        with open(self.index_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < self.index_header.size:
+                return False
+            index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, generation, count, log_end, live, min_expires = \
+            self.index_header.unpack_from(index, 0)
+        if magic != self.index_magic or generation != self.generation or log_end > self.end:
+            index.close()
+            return False
+
+        self.index = index
+        self.count = count
+        self.log_end = log_end
+        self.live = live
+        self.min_expires = min_expires
+        return True
+
+    def _replay(self, start):
+        ''' apply the records from start to the end of the log, a partly
+        written or corrupt record ends the log. The delta is merged into
+        the index every max_delta records, so replaying a log without an
+        index takes no more memory than running does. '''
+        f = open(self.log_path, 'rb')
+        f.seek(start)
+        offset = start
+        while offset < self.end:
+            header = f.read(self.record.size)
+            if len(header) < self.record.size:
+                break
+            crc, key_hash, expires, removed, key_len, value_len = self.record.unpack(header)
+            body = f.read(key_len + value_len)
+            if len(body) < key_len + value_len or crc != zlib.crc32(header[4:] + body) & 0xffffffff:
+                break
+
+            size = self.record.size + key_len + value_len
+            self._apply(key_hash, offset, size, expires, removed)
+            offset += size
+            if len(self.delta) >= self.max_delta:
+                self.flush(offset)
+
+        f.close()
+        if offset < self.end:
+            self.writer.truncate(offset)
+            self.end = offset
+
+    def _apply(self, key_hash, offset, size, expires, removed):
+        old = self._lookup(key_hash)
+        if old is not None:
+            self.live -= self._record_size(old)
+
+        if removed:
+            self.delta[key_hash] = None
+        else:
+            self.delta[key_hash] = offset
+            self.live += size
+            self.min_expires = min(self.min_expires, expires)
+
+    def _read_header(self, offset):
+        self.reader.seek(offset)
+        return self.record.unpack(self.reader.read(self.record.size))
+
+    def _record_size(self, offset):
+        crc, key_hash, expires, removed, key_len, value_len = self._read_header(offset)
+        return self.record.size + key_len + value_len
+
+    def _entry_key(self, i):
+        start = self.index_header.size + i * self.entry.size
+        return self.index[start:start + 20]
+
+    def _bisect(self, key_hash, lo=0):
+        ''' the position of the first index entry >= key_hash, from lo '''
+        index, base, size = self.index, self.index_header.size, self.entry.size
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = base + mid * size
+            if index[start:start + 20] < key_hash:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _lookup(self, key_hash):
+        ''' the log offset of the current record for key_hash, or None '''
+        if key_hash in self.delta:
+            return self.delta[key_hash]
+        if self.index is None:
+            return None
+
+        i = self._bisect(key_hash)
+        if i < self.count and self._entry_key(i) == key_hash:
+            return self.entry.unpack_from(self.index, self.index_header.size + i * self.entry.size)[1]
+        return None
+
+    def _append(self, key_hash, expires, removed, key, value):
+        body = key + value
+        header = self.record.pack(0, key_hash, expires, removed, len(key), len(value))
+        crc = zlib.crc32(header[4:] + body) & 0xffffffff
+        offset = self.end
+        try:
+            self.writer.write(struct.pack('!I', crc) + header[4:] + body)
+            self.writer.flush()
+        except (IOError, OSError):
+            # drop any part of the record which was written
+            try:
+                self.writer.truncate(offset)
+            except (IOError, OSError):
+                pass
+            return False
+        size = len(header) + len(body)
+        self.end += size
+        self._apply(key_hash, offset, size, expires, removed)
+
+        if len(self.delta) >= self.max_delta and self.compacting is None:
+            self.flush()
+        if self.end - self.log_header.size - self.live > max(self.live, self.min_garbage):
+            self.compact()
+        return True
+
+    def store(self, key, key_hash, value, ttl=None):
+        ''' store a value, returns False if it couldn't be written '''
+        if ttl is None:
+            ttl = self.ttl
+        return self._append(self._pack(key_hash), clock.time() + ttl, 0, key, value)
+
+    def retrieve(self, key_hash):
+        offset = self._lookup(self._pack(key_hash))
+        if offset is None:
+            return None
+
+        crc, key_hash, expires, removed, key_len, value_len = self._read_header(offset)
+        if removed or expires <= clock.time():
+            return None
+        return self.reader.read(key_len + value_len)[key_len:]
+
+    def contains(self, key_hash):
+        offset = self._lookup(self._pack(key_hash))
+        if offset is None:
+            return False
+        crc, key_hash, expires, removed, key_len, value_len = self._read_header(offset)
+        return not removed and expires > clock.time()
+
+    def remove(self, key_hash):
+        key_hash = self._pack(key_hash)
+        if self._lookup(key_hash) is not None:
+            self._append(key_hash, 0, 1, '', '')
+
+    def expire(self, limit=None):
+        ''' expired values are dropped by compaction, expire starts a
+        compaction if a value has expired and there hasn't been one for
+        compact_interval seconds. Returns 0 as nothing is removed here. '''
+        now = clock.time()
+        if self.min_expires <= now and now - self.last_compaction >= self.compact_interval:
+            self.compact()
+        return 0
+
+    def flush(self, log_end=None):
+        ''' flush merges the delta into a new index, which covers the log
+        upto log_end (by default all of it) '''
+        if log_end is None:
+            log_end = self.end
+        items = sorted(self.delta.iteritems())
+        tmp_path = self.index_path + '.new'
+        count = 0
+        with open(tmp_path, 'wb') as f:
+            f.write('\0' * self.index_header.size)
+            i = 0
+            for key_hash, offset in items:
+                if self.index is not None:
+                    # copy the entries before this key as they are
+                    p = self._bisect(key_hash, i)
+                    if p > i:
+                        f.write(self.index[self.index_header.size + i * self.entry.size:
+                                           self.index_header.size + p * self.entry.size])
+                        count += p - i
+                    if p < self.count and self._entry_key(p) == key_hash:
+                        p += 1
+                    i = p
+                if offset is not None:
+                    f.write(self.entry.pack(key_hash, offset))
+                    count += 1
+
+            if self.index is not None and i < self.count:
+                f.write(self.index[self.index_header.size + i * self.entry.size:
+                                   self.index_header.size + self.count * self.entry.size])
+                count += self.count - i
+
+            f.seek(0)
+            f.write(self.index_header.pack(self.index_magic, self.generation, count,
+                                           log_end, self.live, self.min_expires))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(tmp_path, self.index_path)
+        self._map_index()
+        self.delta = {}
+
+    def compact(self):
+        ''' compact starts a background compaction if one isn't running '''
+        if self.compacting is None:
+            self.compacting = gevent.spawn(self._compact)
+        return self.compacting
+
+    def _compact(self):
+        ''' copy every live record into a new log with a new index. Records
+        written while this runs are copied across as they are at the end,
+        without letting other greenlets run, and replayed on reopening. '''
+        try:
+            self.flush()
+            index, count = self.index, self.count
+            now = clock.time()
+            log_tmp = self.log_path + '.new'
+            index_tmp = self.index_path + '.new'
+            generation = self.generation + 1
+
+            reader = open(self.log_path, 'rb')
+            log = open(log_tmp, 'wb')
+            log.write(self.log_header.pack(self.log_magic, generation))
+            idx = open(index_tmp, 'wb')
+            idx.write('\0' * self.index_header.size)
+
+            offset = self.log_header.size
+            live = 0
+            entries = 0
+            min_expires = float('inf')
+            for i in xrange(count):
+                key_hash, old = self.entry.unpack_from(index, self.index_header.size + i * self.entry.size)
+                reader.seek(old)
+                header = reader.read(self.record.size)
+                crc, k, expires, removed, key_len, value_len = self.record.unpack(header)
+                if not removed and expires > now:
+                    record = header + reader.read(key_len + value_len)
+                    log.write(record)
+                    idx.write(self.entry.pack(key_hash, offset))
+                    offset += len(record)
+                    live += len(record)
+                    entries += 1
+                    min_expires = min(min_expires, expires)
+
+                if i % self.yield_every == self.yield_every - 1:
+                    clock.sleep()
+
+            # bring across everything written since we started
+            reader.seek(self.log_end)
+            while True:
+                data = reader.read(1024 * 1024)
+                if not data:
+                    break
+                log.write(data)
+            reader.close()
+
+            idx.seek(0)
+            idx.write(self.index_header.pack(self.index_magic, generation, entries,
+                                             offset, live, min_expires))
+            for f in (log, idx):
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+
+            self._close_files()
+            os.rename(log_tmp, self.log_path)
+            os.rename(index_tmp, self.index_path)
+            self._open()
+            self.compactions += 1
+            self.last_compaction = clock.time()
+        finally:
+            self.compacting = None
+
+    def _close_files(self):
+        for f in (self.writer, self.reader, self.index):
+            if f is not None:
+                f.close()
+        self.writer = self.reader = self.index = None
+
+    def close(self):
+        ''' wait for any compaction and close the store's files '''
+        if self.compacting is not None:
+            self.compacting.join()
+        self._close_files()
+
+    def stats(self):
+        return { 'log_bytes'   : self.end,
+                 'live_bytes'  : self.live,
+                 'indexed'     : self.count,
+                 'delta'       : len(self.delta),
+                 'compactions' : self.compactions }
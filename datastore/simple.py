@@ -1,26 +1,84 @@
+import clock
+
+from heapq import heappush, heappop, heapify
+
 class simple:
     ''' simple is a very basic in memory data store
 
-    TODO: values expire unless they are refreshed.
+    Every value expires ttl seconds after it was last stored unless a
+    different ttl is given when it is stored. Expired values are never
+    returned, and are removed incrementally from a heap of expiry times:
+    each store removes a couple of expired values and expire() removes
+    every expired value without looking at any that haven't expired.
+
+    node is the Node of the client the store belongs to, simple doesn't
+    make use of it.
     '''
-    def __init__(self):
-        self.hash_value = {}
-        self.hash_key   = {}
+    def __init__(self, node=None, ttl=86400):
+        self.node = node
+        self.ttl = ttl
+        self.hash_value   = {}
+        self.hash_key     = {}
+        self.hash_expires = {}
+        self.deadlines    = []   # heap of (expires, key_hash)
+
+    def store(self, key, key_hash, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = clock.time() + ttl
 
+        self.hash_value[key_hash]   = value
+        self.hash_key[key_hash]     = key
+        self.hash_expires[key_hash] = expires
+        heappush(self.deadlines, (expires, key_hash))
+        self.expire(2)
 
-    def store(self, key, key_hash, value):
-        self.hash_value[key_hash] = value
-        self.hash_key[key_hash]   = key
+        # values stored again leave their old expiry behind, rebuild the
+        # heap if those have come to outnumber the live entries
+        if len(self.deadlines) > 2 * len(self.hash_expires) + 64:
+            self.deadlines = [(e, k) for k, e in self.hash_expires.iteritems()]
+            heapify(self.deadlines)
+        return True
 
     def retrieve(self, key_hash):
         if key_hash in self.hash_value:
+            if self.hash_expires[key_hash] <= clock.time():
+                self.remove(key_hash)
+                return None
             return self.hash_value[key_hash]
         else:
             return None
 
+    def contains(self, key_hash):
+        ''' contains is True if an unexpired value is held for key_hash,
+        unlike retrieve it never changes the store '''
+        return key_hash in self.hash_expires and self.hash_expires[key_hash] > clock.time()
+
     def remove(self, key_hash):
         if key_hash in self.hash_value:
             del self.hash_value[key_hash]
 
         if key_hash in self.hash_key:
             del self.hash_key[key_hash]
+
+        if key_hash in self.hash_expires:
+            del self.hash_expires[key_hash]
+
+    def expire(self, limit=None):
+        ''' expire removes upto limit (default all) expired values and
+        returns how many were removed. Heap entries left behind by values
+        which were stored again or removed are skipped. '''
+        now = clock.time()
+        deadlines = self.deadlines
+        removed = 0
+        while deadlines and deadlines[0][0] <= now:
+            if limit is not None and removed >= limit:
+                break
+            expires, key_hash = heappop(deadlines)
+            if self.hash_expires.get(key_hash) == expires:
+                self.remove(key_hash)
+                removed += 1
+        return removed
+
+    def __len__(self):
+        return len(self.hash_value)
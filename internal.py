@@ -0,0 +1,100 @@
+''' Commands are the internal messages a Kad_Client sends to its Rpc_Client
+on the 'int' channel. Each command is a small __slots__ class which the
+Rpc_Client dispatches on by type.
+
+A command which needs an answer carries a one shot reply (a gevent
+AsyncResult), queries whose responses arrive over time from the network
+carry the queue of the lookup which sent them instead.
+'''
+from gevent.event import AsyncResult
+
+class Command(object):
+    __slots__ = ('reply',)
+
+    def __init__(self):
+        self.reply = None
+
+    def expect_reply(self):
+        ''' expect_reply gives the command a reply for the Rpc_Client to
+        set, and returns it '''
+        self.reply = AsyncResult()
+        return self.reply
+
+    def set_reply(self, value):
+        if self.reply is not None:
+            self.reply.set(value)
+
+    def set_exception(self, exception):
+        ''' set_exception fails the reply, if there is one, with exception '''
+        if self.reply is not None:
+            self.reply.set_exception(exception)
+
+class AddNodes(Command):
+    ''' add nodes to the routing tree '''
+    __slots__ = ('nodes',)
+
+    def __init__(self, nodes):
+        Command.__init__(self)
+        self.nodes = nodes
+
+class RefreshBuckets(Command):
+    ''' refresh every bucket of the routing tree '''
+    __slots__ = ()
+
+class StoreValue(Command):
+    ''' send a STORE rpc to node, if cache is set the node is asked to
+    cache the value for a short time rather than hold it. If chan is
+    given the node is asked to acknowledge the STORE and the ack (or
+    timeout) is put on chan. '''
+    __slots__ = ('node', 'key', 'value', 'cache', 'chan')
+
+    def __init__(self, node, key, value, cache=False, chan=None):
+        Command.__init__(self)
+        self.node = node
+        self.key = key
+        self.value = value
+        self.cache = cache
+        self.chan = chan
+
+class SendFindNode(Command):
+    ''' send a FIND_NODE rpc for target to node, the response is put on
+    chan '''
+    __slots__ = ('node', 'target', 'chan')
+
+    def __init__(self, node, target, chan):
+        Command.__init__(self)
+        self.node = node
+        self.target = target
+        self.chan = chan
+
+class SendFindValue(Command):
+    ''' send a FIND_VALUE rpc for key to node, the response is put on
+    chan '''
+    __slots__ = ('node', 'key', 'chan')
+
+    def __init__(self, node, key, chan):
+        Command.__init__(self)
+        self.node = node
+        self.key = key
+        self.chan = chan
+
+class StoreMany(Command):
+    ''' send a STORE_MANY rpc to node, items is a list of
+    (key, key_hash, value) '''
+    __slots__ = ('node', 'items')
+
+    def __init__(self, node, items):
+        Command.__init__(self)
+        self.node = node
+        self.items = items
+
+class SendFindValueMany(Command):
+    ''' send a FIND_VALUE_MANY rpc to node, keys is a list of
+    (key, key_hash), the response is put on chan '''
+    __slots__ = ('node', 'keys', 'chan')
+
+    def __init__(self, node, keys, chan):
+        Command.__init__(self)
+        self.node = node
+        self.keys = keys
+        self.chan = chan
@@ -0,0 +1,178 @@
+from bisect import insort
+from collections import OrderedDict
+
+import clock
+
+class Shortlist:
+    ''' Shortlist holds the candidate nodes of an iterative lookup ordered
+    by xor distance to the target.
+
+    It is capped at 'size' entries, nodes further away than the furthest
+    entry of a full shortlist are ignored. Nodes which have ever been
+    added, queried or responded are tracked by id in sets so that none of
+    the bookkeeping needs to scan a list.
+    '''
+    def __init__(self, target, k, size=None):
+        self.target = target
+        self.k = k
+        if size is None:
+            size = 3 * k
+        self.size = max(size, k)
+
+        self.entries   = []    # sorted list of (distance, node)
+        self.seen      = set() # ids ever offered to the shortlist
+        self.queried   = set() # ids of nodes we have sent a query to
+        self.responded = set() # ids of nodes which have responded
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, nodes):
+        ''' add offers a list of nodes to the shortlist, nodes which have
+        been seen before are ignored '''
+        entries = self.entries
+        for node in nodes:
+            if node.id in self.seen:
+                continue
+            self.seen.add(node.id)
+
+            distance = node.id ^ self.target
+            if len(entries) >= self.size:
+                if distance >= entries[-1][0]:
+                    continue
+                entries.pop()
+            insort(entries, (distance, node))
+
+    def next(self):
+        ''' next returns the closest node which hasn't been queried, or
+        None if every node in the shortlist has been queried '''
+        queried = self.queried
+        for distance, node in self.entries:
+            if node.id not in queried:
+                return node
+        return None
+
+    def query(self, node):
+        ''' query records that a query has been sent to a node '''
+        self.queried.add(node.id)
+
+    def respond(self, node):
+        ''' respond records that a node has responded '''
+        self.responded.add(node.id)
+
+    def remove(self, node):
+        ''' remove drops a node, which will not be offered again '''
+        for i, (distance, n) in enumerate(self.entries):
+            if n.id == node.id:
+                del self.entries[i]
+                break
+
+    def complete(self):
+        ''' complete is True once the k closest nodes have all responded '''
+        responded = self.responded
+        for distance, node in self.entries[:self.k]:
+            if node.id not in responded:
+                return False
+        return True
+
+    def closest(self, count=None):
+        ''' closest returns the closest count (default k) nodes '''
+        if count is None:
+            count = self.k
+        return [node for distance, node in self.entries[:count]]
+
+class LookupStats(object):
+    ''' LookupStats counts what a lookup did, or added together, what a
+    number of lookups did.
+
+    hops is the longest chain of referrals followed to a node which
+    responded, the nodes from our own routing table being 1 hop away.
+    stalled counts queries which took longer than expected and had
+    another query sent alongside them. shared counts lookups which waited
+    for the same lookup already in progress instead of running.
+    '''
+    __slots__ = ('lookups', 'hops', 'messages', 'responses', 'timeouts',
+                 'stalled', 'alpha', 'shared')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def add(self, other):
+        for name in self.__slots__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def __repr__(self):
+        return 'LookupStats(%s)' % ', '.join(
+            '%s=%s' % (name, getattr(self, name)) for name in self.__slots__)
+
+class LookupCache:
+    ''' LookupCache remembers the k closest nodes found by recent lookups,
+    by target id, so that repeated operations on the same keys don't have
+    to look them up again.
+
+    Results are kept for ttl seconds and at most size of them are kept,
+    the least recently used result is forgotten to make room for a new
+    one. Every result containing a node is dropped when invalidate is
+    called for the node, e.g. when it fails to respond.
+    '''
+    def __init__(self, size=1024, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()    # target => (expires, nodes), LRU first
+        self.targets = {}               # node id => set of targets
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, target):
+        ''' get returns the nodes cached for target, or None '''
+        entry = self.entries.get(target)
+        if entry is not None and entry[0] <= clock.time():
+            self._remove(target)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+
+        # move to the most recently used end
+        del self.entries[target]
+        self.entries[target] = entry
+        self.hits += 1
+        return entry[1]
+
+    def put(self, target, nodes):
+        ''' put caches the result of a lookup for target '''
+        if target in self.entries:
+            self._remove(target)
+        elif len(self.entries) >= self.size:
+            self._remove(next(iter(self.entries)))
+
+        self.entries[target] = (clock.time() + self.ttl, list(nodes))
+        for node in nodes:
+            self.targets.setdefault(node.id, set()).add(target)
+
+    def invalidate(self, node):
+        ''' invalidate drops every result which contains node '''
+        for target in list(self.targets.get(node.id, ())):
+            self._remove(target)
+            self.invalidations += 1
+
+    def _remove(self, target):
+        expires, nodes = self.entries.pop(target)
+        for node in nodes:
+            targets = self.targets.get(node.id)
+            if targets is not None:
+                targets.discard(target)
+                if not targets:
+                    del self.targets[node.id]
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits) / total
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,299 @@
+import json
+import socket
+import struct
+from binascii import hexlify, unhexlify
+
+class CodecError(Exception):
+    ''' CodecError is raised when a message cannot be encoded or decoded '''
+
+class JsonCodec:
+    ''' JsonCodec encodes messages as JSON, this is the original wire format
+    and is kept for debugging and for comparison with BinaryCodec '''
+
+    def encode(self, message):
+        try:
+            return json.dumps(message)
+        except (TypeError, ValueError), e:
+            raise CodecError(str(e))
+
+    def decode(self, data):
+        try:
+            return json.loads(data)
+        except ValueError, e:
+            raise CodecError(str(e))
+
+class BinaryCodec:
+    ''' BinaryCodec encodes rpc messages in a fixed layout binary format.
+
+    Every message starts with a header:
+
+        type (1 byte) | xid (8 bytes) | addr (4 bytes) | port (2 bytes) | id (20 bytes)
+
+    which is followed by a payload specific to the message type. Node ids
+    and key hashes are always sent as 20 byte big endian strings, strings
+    are sent with a length prefix. All integers are in network byte order.
+    '''
+
+    header = struct.Struct('!BQ4sH20s')
+    count = struct.Struct('!H')
+    short_str = struct.Struct('!H')
+    long_str = struct.Struct('!I')
+    flag = struct.Struct('!B')
+
+    # STORE flags
+    store_cache = 1
+    store_ack = 2
+
+    def __init__(self, contact_cache_size=8192):
+        self.contact_lists = {}
+        self.contact_cache = {}
+        self.contact_cache_size = contact_cache_size
+
+        # message type => (tag, payload encoder, payload decoder)
+        self.types = {
+            'PING'              : (1, self._encode_empty, self._decode_empty),
+            'PONG'              : (2, self._encode_empty, self._decode_empty),
+            'STORE'             : (3, self._encode_store, self._decode_store),
+            'FIND_NODE'         : (4, self._encode_find_node, self._decode_find_node),
+            'RETURN_NODE'       : (5, self._encode_return_node, self._decode_return_node),
+            'FIND_VALUE'        : (6, self._encode_find_value, self._decode_find_value),
+            'RETURN_VALUE'      : (7, self._encode_return_value, self._decode_return_value),
+            'STORE_MANY'        : (8, self._encode_store_many, self._decode_store_many),
+            'FIND_VALUE_MANY'   : (9, self._encode_find_value_many, self._decode_find_value_many),
+            'RETURN_VALUE_MANY' : (10, self._encode_return_value_many, self._decode_return_value_many),
+            'STORE_ACK'         : (11, self._encode_store_ack, self._decode_store_ack)
+        }
+
+        self.tags = {}
+        for m_type, (tag, encoder, decoder) in self.types.items():
+            self.tags[tag] = (m_type, decoder)
+
+    def encode(self, message):
+        ''' encode returns the binary representation of an rpc message '''
+        try:
+            tag, encoder, decoder = self.types[message['type']]
+            addr, port, node_id = message['source']
+            parts = [self.header.pack(tag, message['xid'], socket.inet_aton(addr),
+                                      port, self._pack_id(node_id))]
+            encoder(message['data'], parts)
+            return ''.join(parts)
+        except (KeyError, TypeError, ValueError, struct.error, socket.error), e:
+            raise CodecError('unable to encode message: %s' % e)
+
+    def decode(self, data):
+        ''' decode returns the rpc message contained in data '''
+        try:
+            tag, xid, addr, port, node_id = self.header.unpack_from(data, 0)
+            m_type, decoder = self.tags[tag]
+            payload, offset = decoder(data, self.header.size)
+        except (KeyError, TypeError, ValueError, struct.error), e:
+            raise CodecError('unable to decode message: %s' % e)
+
+        if offset != len(data):
+            raise CodecError('trailing data in message')
+
+        return {
+            'source' : [socket.inet_ntoa(addr), port, self._unpack_id(node_id)],
+            'xid'    : xid,
+            'type'   : m_type,
+            'data'   : payload
+        }
+
+    def _pack_id(self, n):
+        ''' convert a 160 bit id to a 20 byte string '''
+        if n < 0 or n >= 2**160:
+            raise ValueError('id outside of key space')
+        return unhexlify('%040x' % n)
+
+    def _unpack_id(self, s):
+        ''' convert a 20 byte string to a 160 bit id '''
+        return long(hexlify(s), 16)
+
+    def _pack_str(self, s, fmt, parts):
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        parts.append(fmt.pack(len(s)))
+        parts.append(s)
+
+    def _unpack_str(self, data, offset, fmt):
+        length, = fmt.unpack_from(data, offset)
+        offset += fmt.size
+        s = data[offset:offset + length]
+        if len(s) != length:
+            raise ValueError('truncated string')
+        return s, offset + length
+
+    def _contacts_struct(self, count):
+        ''' return a struct for a list of count contacts, contact lists are
+        packed with a single call as they dominate RETURN_NODE messages '''
+        fmt = self.contact_lists.get(count)
+        if fmt is None:
+            fmt = struct.Struct('!' + '4sH20s' * count)
+            self.contact_lists[count] = fmt
+        return fmt
+
+    def _pack_contacts(self, nodes, parts):
+        cache = self.contact_cache
+        values = []
+        for contact in nodes:
+            if type(contact) is not tuple:
+                contact = tuple(contact)
+            packed = cache.get(contact)
+            if packed is None:
+                addr, port, node_id = contact
+                packed = (socket.inet_aton(addr), port, self._pack_id(node_id))
+                self._cache(contact, packed)
+            values.extend(packed)
+        parts.append(self.count.pack(len(nodes)))
+        parts.append(self._contacts_struct(len(nodes)).pack(*values))
+
+    def _unpack_contacts(self, data, offset):
+        count, = self.count.unpack_from(data, offset)
+        offset += self.count.size
+        fmt = self._contacts_struct(count)
+        values = fmt.unpack_from(data, offset)
+        cache = self.contact_cache
+        nodes = []
+        for i in xrange(0, len(values), 3):
+            packed = values[i:i + 3]
+            contact = cache.get(packed)
+            if contact is None:
+                contact = (socket.inet_ntoa(packed[0]), packed[1], self._unpack_id(packed[2]))
+                self._cache(packed, contact)
+            nodes.append(contact)
+        return nodes, offset + fmt.size
+
+    def _cache(self, key, value):
+        ''' contacts are sent over and over again so their packed forms are
+        cached, the cache is simply emptied when it fills up '''
+        if len(self.contact_cache) >= self.contact_cache_size:
+            self.contact_cache.clear()
+        self.contact_cache[key] = value
+
+    def _encode_empty(self, data, parts):
+        pass
+
+    def _decode_empty(self, data, offset):
+        return {}, offset
+
+    def _encode_find_node(self, data, parts):
+        parts.append(self._pack_id(data))
+
+    def _decode_find_node(self, data, offset):
+        node_id = data[offset:offset + 20]
+        if len(node_id) != 20:
+            raise ValueError('truncated id')
+        return self._unpack_id(node_id), offset + 20
+
+    def _encode_return_node(self, data, parts):
+        self._pack_contacts(data, parts)
+
+    def _decode_return_node(self, data, offset):
+        return self._unpack_contacts(data, offset)
+
+    def _encode_find_value(self, data, parts):
+        parts.append(self._pack_id(data['key_hash']))
+        self._pack_str(data['key'], self.short_str, parts)
+
+    def _decode_find_value(self, data, offset):
+        key_hash, offset = self._decode_find_node(data, offset)
+        key, offset = self._unpack_str(data, offset, self.short_str)
+        return { 'key' : key, 'key_hash' : key_hash }, offset
+
+    def _encode_return_value(self, data, parts):
+        if data['found']:
+            parts.append(self.flag.pack(1))
+            self._pack_str(data['value'], self.long_str, parts)
+        else:
+            parts.append(self.flag.pack(0))
+            self._pack_contacts(data['nodes'], parts)
+
+    def _decode_return_value(self, data, offset):
+        found, = self.flag.unpack_from(data, offset)
+        offset += self.flag.size
+        if found:
+            value, offset = self._unpack_str(data, offset, self.long_str)
+            return { 'value' : value, 'found' : True }, offset
+        else:
+            nodes, offset = self._unpack_contacts(data, offset)
+            return { 'nodes' : nodes, 'found' : False }, offset
+
+    def _encode_store(self, data, parts):
+        parts.append(self._pack_id(data['key_hash']))
+        self._pack_str(data['key'], self.short_str, parts)
+        self._pack_str(data['value'], self.long_str, parts)
+        flags = 0
+        if data.get('cache'):
+            flags |= self.store_cache
+        if data.get('ack'):
+            flags |= self.store_ack
+        parts.append(self.flag.pack(flags))
+
+    def _decode_store(self, data, offset):
+        key_hash, offset = self._decode_find_node(data, offset)
+        key, offset = self._unpack_str(data, offset, self.short_str)
+        value, offset = self._unpack_str(data, offset, self.long_str)
+        flags, = self.flag.unpack_from(data, offset)
+        offset += self.flag.size
+
+        store = { 'key' : key, 'key_hash' : key_hash, 'value' : value }
+        if flags & self.store_cache:
+            store['cache'] = True
+        if flags & self.store_ack:
+            store['ack'] = True
+        return store, offset
+
+    def _encode_store_ack(self, data, parts):
+        parts.append(self.flag.pack(1 if data.get('stored') else 0))
+
+    def _decode_store_ack(self, data, offset):
+        stored, = self.flag.unpack_from(data, offset)
+        return { 'stored' : stored == 1 }, offset + self.flag.size
+
+    def _encode_store_many(self, data, parts):
+        parts.append(self.count.pack(len(data)))
+        for item in data:
+            parts.append(self._pack_id(item['key_hash']))
+            self._pack_str(item['key'], self.short_str, parts)
+            self._pack_str(item['value'], self.long_str, parts)
+
+    def _decode_store_many(self, data, offset):
+        count, = self.count.unpack_from(data, offset)
+        offset += self.count.size
+        items = []
+        for i in xrange(count):
+            key_hash, offset = self._decode_find_node(data, offset)
+            key, offset = self._unpack_str(data, offset, self.short_str)
+            value, offset = self._unpack_str(data, offset, self.long_str)
+            items.append({ 'key' : key, 'key_hash' : key_hash, 'value' : value })
+        return items, offset
+
+    def _encode_find_value_many(self, data, parts):
+        parts.append(self.count.pack(len(data)))
+        for item in data:
+            self._encode_find_value(item, parts)
+
+    def _decode_find_value_many(self, data, offset):
+        count, = self.count.unpack_from(data, offset)
+        offset += self.count.size
+        items = []
+        for i in xrange(count):
+            item, offset = self._decode_find_value(data, offset)
+            items.append(item)
+        return items, offset
+
+    def _encode_return_value_many(self, data, parts):
+        parts.append(self.count.pack(len(data)))
+        for item in data:
+            parts.append(self._pack_id(item['key_hash']))
+            self._pack_str(item['value'], self.long_str, parts)
+
+    def _decode_return_value_many(self, data, offset):
+        count, = self.count.unpack_from(data, offset)
+        offset += self.count.size
+        items = []
+        for i in xrange(count):
+            key_hash, offset = self._decode_find_node(data, offset)
+            value, offset = self._unpack_str(data, offset, self.long_str)
+            items.append({ 'key_hash' : key_hash, 'value' : value })
+        return items, offset
@@ -1,7 +1,67 @@
 import random
 import socket
 import struct
-import json
+
+from network.codec import BinaryCodec
+import clock
+
+class LinkModel:
+    ''' LinkModel decides how long a message takes to travel between two
+    hosts and whether it is lost on the way. Every link uses the default
+    latency, jitter and loss unless it has been given its own with set_link.
+
+    * latency - seconds a message spends on the link
+    * jitter - a random extra delay of up to this many seconds
+    * loss - probability that a message is dropped
+    * seed - seed for the link's random number generator, a given seed
+      always produces the same delays and losses
+    '''
+    def __init__(self, latency=0.05, jitter=0.0, loss=0.0, seed=None):
+        self.default = (latency, jitter, loss)
+        self.links = {}
+        self.random = random.Random(seed)
+
+    def set_link(self, source, dest, latency=None, jitter=None, loss=None):
+        ''' set_link configures the link from source to dest, both are
+        (addr, port) tuples. Unspecified values use the defaults '''
+        d_latency, d_jitter, d_loss = self.default
+        self.links[(source, dest)] = (
+            d_latency if latency is None else latency,
+            d_jitter if jitter is None else jitter,
+            d_loss if loss is None else loss
+        )
+
+    def delay(self, source, dest):
+        ''' delay returns the time taken for a message to travel from
+        source to dest, or None if the message is lost '''
+        latency, jitter, loss = self.links.get((source, dest), self.default)
+        if loss and self.random.random() < loss:
+            return None
+        if jitter:
+            latency += self.random.uniform(0, jitter)
+        return latency
+
+class SharedMessageMutated(Exception):
+    ''' SharedMessageMutated is raised when a receiver tries to modify a
+    message which is shared with the sender and other receivers '''
+
+class FrozenDict(dict):
+    ''' FrozenDict is a dict which can't be modified '''
+    def _mutated(self, *args, **kwargs):
+        raise SharedMessageMutated('shared message modified')
+
+    __setitem__ = __delitem__ = _mutated
+    clear = pop = popitem = setdefault = update = _mutated
+
+def freeze(message):
+    ''' freeze returns a copy of a message built from FrozenDicts
+    and tuples '''
+    if isinstance(message, dict):
+        return FrozenDict((k, freeze(v)) for k, v in message.iteritems())
+    elif isinstance(message, (list, tuple)):
+        return tuple(freeze(v) for v in message)
+    else:
+        return message
 
 class Simulate:
     ''' Simulate is a network interface to a simulated ip network
@@ -10,10 +70,34 @@ class Simulate:
 
     The nodes can join the network by calling connect and send messages
     to other nodes by using 'send'
+
+    Every message is passed through the codec (encoded then decoded) so
+    that receivers never share a message with the sender and so that
+    messages are limited to what can be sent over a real network. The
+    codec is the binary wire format unless another is given, e.g.
+    codec=JsonCodec() to see messages as they are built when debugging.
+
+    If copy is False the codec is skipped and receivers are handed the
+    sender's message object itself, which is much cheaper but relies on
+    no one modifying a message once it has been sent. With check_shared
+    set messages are delivered frozen so that any receiver which tries to
+    modify one raises SharedMessageMutated.
+
+    Messages are delivered immediately unless a LinkModel is given, in
+    which case delivery is scheduled on the clock after the link's delay.
+    With a clock.VirtualClock this simulates a network in virtual time.
     '''
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, codec=None, links=None, copy=True, check_shared=False):
         self.queues = {}
         self.debug = debug
+        self.links = links
+        self.copy = copy
+        self.check_shared = check_shared
+        self.lost = 0
+
+        if codec is None:
+            codec = BinaryCodec()
+        self.codec = codec
 
     def log(self, message):
         if self.debug:
@@ -26,12 +110,36 @@ class Simulate:
         isn't connected to the network
         '''
         if (addr, port) in self.queues:
-            m = json.loads(json.dumps(message))
-            self.queues[(addr, port)].put(m, block=False)
-            self.log("%s => %s:%s" % (m, addr, port))
+            if self.copy:
+                m = self.codec.decode(self.codec.encode(message))
+            elif self.check_shared:
+                m = freeze(message)
+            else:
+                m = message
+
+            if self.links is None:
+                self._deliver(addr, port, m)
+                return
+
+            source = (message['source'][0], message['source'][1])
+            delay = self.links.delay(source, (addr, port))
+            if delay is None:
+                self.lost += 1
+                self.log("%s => %s:%s lost" % (m, addr, port))
+            else:
+                clock.call_later(delay, self._deliver, addr, port, m)
         else:
             self.log("%s:%s not on the network" % (addr, port))
 
+    def _deliver(self, addr, port, m):
+        ''' _deliver puts a message on the destination's queue, the
+        destination may have left the network while it was in flight '''
+        if (addr, port) in self.queues:
+            self.queues[(addr, port)].put(m, block=False)
+            if self.debug:
+                self.log("%s => %s:%s" % (m, addr, port))
+        else:
+            self.log("%s:%s not on the network" % (addr, port))
 
     def connect(self, queue, addr = None, port = None):
         ''' connect to simulated network, if addr
@@ -64,11 +172,11 @@ class Simulate:
         '''
 
         if addr is None:
-            addr = random.randint(0, 2**32)
+            addr = random.randint(0, 2**32 - 1)
             addr = self._long2ip(addr)
 
         if port is None:
-            port = random.randint(49152, 2**16)
+            port = random.randint(49152, 2**16 - 1)
 
         if (addr,port) in self.queues:
             raise Exception("%s:%s already in use" % (addr, port))
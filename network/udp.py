@@ -0,0 +1,159 @@
+import errno
+import socket
+
+import gevent
+from gevent.socket import wait_read
+
+from network.codec import BinaryCodec, CodecError
+
+class Udp:
+    ''' Udp is a network interface to a real ip network using UDP datagrams.
+    It has the same interface as Simulate so an Rpc_Client can use either.
+
+    A single instance can host many nodes, each call to connect binds a new
+    socket and starts a greenlet which reads datagrams from it. Messages are
+    sent from the socket belonging to the message's source where possible.
+
+    Sends never block, if the socket buffer is full the message is dropped
+    as it would be anywhere else on the network. The receiving greenlet
+    drains up to 'batch' datagrams from the socket each time it wakes.
+    Each received message is given the (addr, port) it arrived from as
+    'peer', which unlike its 'source' the sender can't choose.
+    '''
+    def __init__(self, host='127.0.0.1', codec=None, rcvbuf=None, sndbuf=None,
+                 batch=64, debug=False):
+        self.host = host
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+        self.batch = batch
+        self.debug = debug
+
+        if codec is None:
+            codec = BinaryCodec()
+        self.codec = codec
+
+        self.sockets = {}
+        self.send_sock = None
+
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+        self.malformed = 0
+
+    def log(self, message):
+        if self.debug:
+            print "network: %s" % message
+
+    def send(self, addr, port, message):
+        ''' send encodes and sends a single message to a remote host, the
+        message is silently dropped if it cannot be sent straight away '''
+        try:
+            data = self.codec.encode(message)
+        except CodecError, e:
+            self.dropped += 1
+            self.log("unable to send to %s:%s: %s" % (addr, port, e))
+            return
+
+        sock = self._send_socket(message)
+        try:
+            sock.sendto(data, (addr, port))
+            self.sent += 1
+        except socket.error, e:
+            self.dropped += 1
+            self.log("send to %s:%s failed: %s" % (addr, port, e))
+
+    def connect(self, queue, addr = None, port = None):
+        ''' connect binds a socket for a node, if addr or port are not
+        specified then the configured host and a free port are used.
+
+        queue is the queue which the client expects network messages
+        to be delivered to it on.
+
+        return addr, port
+        '''
+        if addr is None:
+            addr = self.host
+
+        if port is None:
+            port = 0
+
+        sock = self._socket()
+        sock.bind((addr, port))
+        addr, port = sock.getsockname()
+
+        reader = gevent.spawn(self._receive, sock, queue)
+        self.sockets[(addr, port)] = (sock, queue, reader)
+        self.log("%s:%s joined the network" % (addr, port))
+        return addr, port
+
+    def disconnect(self, addr, port, queue):
+        ''' disconnect stops receiving messages for a node and closes its
+        socket. The client's queue must also be passed to prevent
+        disconnecting other clients by accident '''
+        if (addr, port) in self.sockets and self.sockets[(addr, port)][1] == queue:
+            sock, queue, reader = self.sockets.pop((addr, port))
+            reader.kill()
+            sock.close()
+            self.log("%s:%s left the network" % (addr, port))
+        else:
+            raise Exception('Disconnection error')
+
+    def close(self):
+        ''' close disconnects every node and closes the send socket '''
+        for (addr, port), (sock, queue, reader) in self.sockets.items():
+            self.disconnect(addr, port, queue)
+
+        if self.send_sock is not None:
+            self.send_sock.close()
+            self.send_sock = None
+
+    def _socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(0)
+        if self.rcvbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        if self.sndbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        return sock
+
+    def _send_socket(self, message):
+        ''' return the socket bound to the message's source, or a shared
+        unbound socket if the source isn't connected through us '''
+        try:
+            return self.sockets[(message['source'][0], message['source'][1])][0]
+        except (KeyError, IndexError, TypeError):
+            pass
+
+        if self.send_sock is None:
+            self.send_sock = self._socket()
+        return self.send_sock
+
+    def _receive(self, sock, queue):
+        ''' _receive waits for the socket to become readable and then drains
+        it, handing each decoded message to the queue '''
+        fileno = sock.fileno()
+        while True:
+            wait_read(fileno)
+            for i in xrange(self.batch):
+                try:
+                    data, source = sock.recvfrom(65536)
+                except socket.error, e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                        break
+                    self.log("receive error: %s" % e)
+                    break
+
+                try:
+                    m = self.codec.decode(data)
+                except CodecError, e:
+                    self.malformed += 1
+                    self.log("malformed message from %s:%s: %s" % (source[0], source[1], e))
+                    continue
+
+                # where the message really came from, whatever it claims
+                m['peer'] = source
+                self.received += 1
+                queue.put(m, block=False)
+            else:
+                # the socket still has data, let other greenlets run first
+                gevent.sleep()
@@ -0,0 +1,68 @@
+from collections import OrderedDict
+
+import clock
+
+class TokenBucket(object):
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+class RateLimiter:
+    ''' RateLimiter keeps a token bucket per key (e.g. a source address).
+    Each bucket refills at 'rate' tokens a second upto 'burst' tokens and
+    a message is allowed if its cost can be taken from its bucket.
+
+    At most max_keys buckets are kept, the least recently used bucket is
+    forgotten to make room for a new key. A forgotten key starts again
+    with a full bucket, so max_keys should comfortably exceed the number
+    of peers expected to be active at once.
+    '''
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()    # key => TokenBucket, LRU first
+
+        self.allowed = 0
+        self.dropped = 0
+
+    def allow(self, key, cost=1):
+        ''' allow takes cost tokens from key's bucket, returning False if
+        there aren't enough '''
+        bucket = self._bucket(key)
+        if bucket.tokens >= cost:
+            bucket.tokens -= cost
+            self.allowed += 1
+            return True
+
+        self.dropped += 1
+        return False
+
+    def reserve(self, key, cost=1):
+        ''' reserve takes cost tokens from key's bucket even if there
+        aren't enough, leaving it owing, and returns how many seconds until
+        the tokens would have been there. It paces requests we send. '''
+        bucket = self._bucket(key)
+        bucket.tokens -= cost
+        if bucket.tokens >= 0:
+            return 0.0
+        return -bucket.tokens / self.rate
+
+    def _bucket(self, key):
+        ''' key's bucket, refilled upto now '''
+        now = clock.time()
+        bucket = self.buckets.pop(key, None)
+        if bucket is None:
+            bucket = TokenBucket(self.burst, now)
+            if len(self.buckets) >= self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+        self.buckets[key] = bucket
+        return bucket
+
+    def __len__(self):
+        return len(self.buckets)
@@ -1,18 +1,32 @@
-import time
+import clock
 from bisect import bisect_left
+from collections import OrderedDict
+from heapq import heappush, heapreplace
+from itertools import islice
 import random
 
-class Node:
-    ''' Node class contains information about a node in the k network '''
+class Node(object):
+    ''' Node class contains information about a node in the k network.
+
+    Nodes are compact (no instance __dict__) as a client may know about a
+    great many of them, and are hashed by id so they can be held in sets
+    and weak interning tables. srtt and rttvar hold the round trip time
+    estimate kept by rtt.RttEstimator.
+    '''
+    __slots__ = ('id', 'addr', 'port', 'last_seen', 'errors', 'srtt', 'rttvar',
+                 '__weakref__')
+
     def __init__(self, addr, port, id):
         self.id   = id
         self.addr = addr
         self.port = port
         self.last_seen = 0
         self.errors    = 0
+        self.srtt      = None
+        self.rttvar    = None
 
     def seen(self):
-        self.last_seen = time.time()
+        self.last_seen = clock.time()
         self.errors    = 0
 
     def error(self):
@@ -51,6 +65,9 @@ class Node:
             a = a.id
         return self.id >= a
 
+    def __hash__(self):
+        return hash(self.id)
+
     def __str__(self):
         return "Node %s:%s" % (self.addr, self.port)
 
@@ -64,9 +81,14 @@ class KbucketComparisonError(Exception):
     ''' KbucketComparisonError is raised when something other than a node
     is compared with a Kbucket '''
 
-class Kbucket:
+class Kbucket(object):
     ''' Kbucket represents a bucket of nodes within a specific range
-    within the k network '''
+    within the k network.
+
+    Nodes are held in an ordered map from node id to Node, ordered from
+    least to most recently seen, so that membership tests, moving a node
+    to the tail and finding the least recently seen node are all O(1).
+    '''
     def __init__(self, k, range_min, range_max, error_threshold, key_space):
         ''' * k is a kademilia defined constant which in this case indicates
               bucket size
@@ -82,7 +104,7 @@ class Kbucket:
         self.k = k
         self.error_threshold = error_threshold
         self.key_space = key_space
-        self.nodes  = []
+        self.contacts = OrderedDict()
 
         # sanity checks
         if self.range_min >= self.range_max:
@@ -94,23 +116,25 @@ class Kbucket:
         if self.range_max > ((2**self.key_space) - 1):
             raise KbucketWrong('range_max > key space')
 
+    @property
+    def nodes(self):
+        ''' nodes returns a list of the nodes in the bucket, least recently
+        seen first '''
+        return self.contacts.values()
+
     def updateRange(self, new_max):
         ''' updateRange is called when a bucket is split, a new max
         position is given and nodes which fall outside this are
         evicted from the bucket and returned to the caller '''
         self.range_max = new_max
-        evicted = []
-        for node in self.nodes:
-            if node.id >= new_max:
-                evicted.append(node)
-
+        evicted = [node for node in self.contacts.itervalues() if node.id > new_max]
         for node in evicted:
-            self.nodes.remove(node)
+            del self.contacts[node.id]
 
         return evicted
 
     def needsRefresh(self):
-        if (time.time() - self.last_lookup) > 3600:
+        if (clock.time() - self.last_lookup) > 3600:
             return True
         else:
             return False
@@ -118,25 +142,25 @@ class Kbucket:
     def performedLookup(self):
         ''' performedLookup is called by the client to indicate
         that a lookup has been performed on this bucket range '''
-        self.last_lookup = time.time()
+        self.last_lookup = clock.time()
 
     def addNode(self, node, updateSeen=True):
         ''' addNode adds a new node to the bucket, if the bucket is
         full then KbucketFull will be raised. If the node is already
         in the bucket then it will be moved to the end of the list '''
 
-        if self != node:
-        #if node.id > self.range_max or node.id < self.range_min:
+        if node.id > self.range_max or node.id < self.range_min:
             raise KbucketWrong("wrong kbucket for node %s > %s or %s < %s" % (node.id, self.range_max, node.id, self.range_min))
 
-        if node in self.nodes:
+        contacts = self.contacts
+        if node.id in contacts:
             # move node to list tail
-            self.nodes.remove(node)
-            self.nodes.append(node)
+            del contacts[node.id]
+            contacts[node.id] = node
             if updateSeen:
                 node.seen()
-        elif len(self.nodes) < self.k:
-            self.nodes.append(node)
+        elif len(contacts) < self.k:
+            contacts[node.id] = node
             if updateSeen:
                 node.seen()
         else:
@@ -146,55 +170,50 @@ class Kbucket:
         ''' getNode returns a node from the bucket, node can be a long
         or a Node object.
         '''
-        idx = self.nodes.index(node)
-        return self.nodes[idx]
+        if isinstance(node, Node):
+            node = node.id
+        try:
+            return self.contacts[node]
+        except KeyError:
+            raise ValueError('node not in bucket')
 
     def getRandomNode(self):
         ''' getRandomNode retuns a random node from the bucket '''
-        return random.choice(self.nodes)
+        return random.choice(self.contacts.values())
 
     def getNodes(self, count=None):
         ''' getNodes returns a fixed number of nodes from the bucket '''
-        if count == None:
-            count = len(self.nodes)
-
-        if count > self.k:
+        if count == None or count > self.k:
             count = self.k
 
-        return self.nodes[0:count]
+        return list(islice(self.contacts.itervalues(), count))
 
     def getLeastRecentlySeen(self):
         ''' the least recently seen node will be at the head of
         the list '''
-        if self.nodes:
-            return self.nodes[0]
-        else:
-            return None
+        return next(self.contacts.itervalues(), None)
 
     def getDepth(self):
-        format_str = "{0:0%sb}" % (self.key_space)
-        _max = format_str.format(self.range_max)
-        _min = format_str.format(self.range_min)
-        depth = 0
-        for i in xrange(0,self.key_space):
-            if _max[i] != _min[i]:
-                return depth
-            depth += 1
-
-        return depth
+        ''' getDepth returns the length of the prefix shared by every id
+        in the bucket's range '''
+        return self.key_space - (self.range_max ^ self.range_min).bit_length()
 
     def removeContact(self, node):
-        self.nodes.remove(node)
+        node = self.getNode(node)
+        del self.contacts[node.id]
 
     def errorNode(self, node):
         ''' errorNode incremements the error count for a node
         if it exceeds the error count then the node is removed
         from the bucket '''
-        index = self.nodes.index(node)
-        num_errors = self.nodes[index].error()
+        node = self.getNode(node)
+        num_errors = node.error()
         if num_errors > self.error_threshold:
             self.removeContact(node)
 
+    def __len__(self):
+        return len(self.contacts)
+
     def __eq__(self, a):
         if isinstance(a, Node):
             if a.id >= self.range_min and a.id <= self.range_max:
@@ -256,7 +275,12 @@ class InvalidNodeId(Exception):
 
 class RoutingTree:
     ''' RoutingTree represents the collection of buckets which contain
-    all nodes an individual node knows about '''
+    all nodes an individual node knows about.
+
+    The buckets are kept sorted by range, alongside a list of each bucket's
+    range_max so that the bucket for an id can be found by bisecting a list
+    of ints.
+    '''
     def __init__(self, node, k=20, error_threshold=5, b=5, key_space=160):
         self.k       = k
         self.error_threshold = error_threshold
@@ -264,14 +288,18 @@ class RoutingTree:
         self.key_space = key_space
         self.node    = node
         self.buckets = []
+        self.bounds  = []
         self.max_key = (2**self.key_space) - 1
         self.buckets.append(Kbucket(k, 0, self.max_key, self.error_threshold, self.key_space))
+        self.bounds.append(self.max_key)
         self.addNode(self.node)
 
     def bucketIndex(self, n):
-        if not isinstance(n, Node):
-            n = None(None, None, n)
-        return bisect_left(self.buckets, n)
+        ''' bucketIndex returns the index of the bucket containing n,
+        n can be a long or a Node object '''
+        if isinstance(n, Node):
+            n = n.id
+        return bisect_left(self.bounds, n)
 
     def addNode(self, node):
         ''' addNode adds a Node object into the correct bucket in the tree
@@ -289,31 +317,35 @@ class RoutingTree:
         if node.id > self.max_key or node.id < 0:
             raise InvalidNodeId('Node id outside of key space')
 
-        index = self.bucketIndex(node)
+        index = self.bucketIndex(node.id)
+        bucket = self.buckets[index]
         try:
-            self.buckets[index].addNode(node)
+            bucket.addNode(node)
         except KbucketFull:
-            if self.buckets[index].range_min <= self.node < self.buckets[index].range_max:
+            if bucket.range_min <= self.node.id <= bucket.range_max:
                 # our node is in this bucket, split it
-                self._splitBucket(self.buckets[index])
+                self._splitBucket(index)
                 return self.addNode(node)
-            elif self.buckets[index].getDepth() < self.b:
+            elif bucket.getDepth() < self.b:
                 # depth of bucket (depth is the length of the prefix shared
                 # by all nodes in the k-bucket's range
-                self._splitBucket(self.buckets[index])
+                self._splitBucket(index)
                 return self.addNode(node)
             else:
-                return self.buckets[index].getLeastRecentlySeen()
+                return bucket.getLeastRecentlySeen()
 
         return None
 
-    def _splitBucket(self, bucket):
-        ''' _splitBucket splits two buckets within the tree into two separate
+    def _splitBucket(self, index):
+        ''' _splitBucket splits the bucket at index into two separate
         buckets dividing the contents between them '''
+        bucket = self.buckets[index]
         diff = (bucket.range_max - bucket.range_min) / 2
         new  = Kbucket(self.k, bucket.range_max - diff, bucket.range_max, self.error_threshold, self.key_space)
-        self.buckets.insert(self.buckets.index(bucket) + 1, new)
+        self.buckets.insert(index + 1, new)
+        self.bounds.insert(index + 1, new.range_max)
         evicted = bucket.updateRange((bucket.range_max - diff) - 1)
+        self.bounds[index] = bucket.range_max
         for node in evicted:
             new.addNode(node, updateSeen=False)
 
@@ -324,55 +356,75 @@ class RoutingTree:
         self.buckets[index].removeContact(remove)
         self.buckets[index].addNode(new)
 
-    def findClosestNodes(self, node):
-        ''' findClosestNodes returns the closest nodes this node
-        knows about to the target node (node_id). If we know if the
-        target node then return a list containing only that.
+    def findClosestNodes(self, node, count=None):
+        ''' findClosestNodes returns upto count (default k) of the nodes
+        this node knows about which are closest to the target node, sorted
+        by xor distance. Our own node is never returned.
+
+        Buckets are visited outwards from the target's bucket keeping the
+        best nodes in a bounded heap. Every id on the far side of a bucket
+        boundary differs from the target in a bit at least as high as the
+        highest bit in which the boundary and the target differ, so once
+        that bound can't beat the current worst node there is no need to
+        look any further in that direction.
         '''
-        index = self.bucketIndex(node)
+        if count is None:
+            count = self.k
 
-        # fetch all nodes from the nearest bucket
-        nodes = self.buckets[index].getNodes()
+        target = node.id
+        own = self.node.id
+        buckets = self.buckets
+        index = self.bucketIndex(node)
 
-        # remove our node from the list (may be in this bucket)
-        try:
-            nodes.remove(self.node)
-        except ValueError:
-            pass
-
-        # if we don't have enough nodes try and return as many as possible
-        min_index = index - 1
-        max_index = index + 1
-        while len(nodes) < self.k:
-            if min_index >= 0:
-                nodes = nodes + self.buckets[min_index].getNodes()
-                min_index = min_index - 1
-            if max_index < len(self.buckets):
-                nodes = nodes + self.buckets[max_index].getNodes()
-                max_index = max_index + 1
-
-            if min_index < 0 and max_index > len(self.buckets):
-                break
+        # max heap (by distance) of the closest nodes found so far
+        heap = []
+
+        def consider(bucket):
+            for n in bucket.contacts.itervalues():
+                if n.id == own:
+                    continue
+                distance = n.id ^ target
+                if len(heap) < count:
+                    heappush(heap, (-distance, n))
+                elif distance < -heap[0][0]:
+                    heapreplace(heap, (-distance, n))
+
+        consider(buckets[index])
+
+        low = index - 1
+        high = index + 1
+        while low >= 0 or high < len(buckets):
+            if len(heap) < count:
+                worst = None
             else:
-                min_index = min_index - 1
-                max_index = max_index + 1
-
-        # remove our node from the list (may have been in another bucket)
-        try:
-            nodes.remove(self.node)
-        except ValueError:
-            pass
-
-        # sort nodes using xor to determine distance
-        nodes.sort(lambda a, b, num=node.id: cmp(num ^ a.id, num ^ b.id))
-
-        # return at most self.k nodes
-        return nodes[:self.k]
+                worst = -heap[0][0]
+
+            if low >= 0:
+                bound = 1 << ((buckets[low].range_max ^ target).bit_length() - 1)
+                if worst is not None and bound >= worst:
+                    low = -1
+                else:
+                    consider(buckets[low])
+                    low -= 1
+
+            if high < len(buckets):
+                bound = 1 << ((buckets[high].range_min ^ target).bit_length() - 1)
+                if worst is not None and bound >= worst:
+                    high = len(buckets)
+                else:
+                    consider(buckets[high])
+                    high += 1
+
+        heap.sort(reverse=True)
+        return [n for distance, n in heap]
 
     def fetchRefreshNodes(self, force=False):
         nodes = []
         for bucket in self.buckets:
-            if force:
+            if not len(bucket):
+                # nothing to refresh from
+                continue
+            elif force:
                 nodes.append(bucket.getRandomNode())
             elif bucket.needsRefresh():
                 nodes.append(bucket.getRandomNode())
@@ -397,3 +449,5 @@ class RoutingTree:
 
         for bucket in self.buckets:
             s['total_nodes'] += len(bucket)
+
+        return s
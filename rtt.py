@@ -0,0 +1,64 @@
+class RttEstimator:
+    ''' RttEstimator derives rpc timeouts from measured round trip times
+    using the Jacobson/Karels estimator (as TCP does, RFC 6298).
+
+    Each Node carries its own smoothed round trip time (srtt) and round
+    trip variance (rttvar). Every sample also feeds a global estimate which
+    is used for nodes we haven't had a response from yet. Timeouts are
+    srtt + k * rttvar, clamped between min_rto and max_rto. A lookup treats
+    a query as stalled after the shorter srtt + stall_k * rttvar.
+    '''
+    def __init__(self, min_rto=0.05, max_rto=2.0, alpha=0.125, beta=0.25,
+                 k=4, stall_k=1, granularity=0.01):
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.alpha = alpha
+        self.beta = beta
+        self.k = k
+        self.stall_k = stall_k
+        self.granularity = granularity
+
+        # global estimate
+        self.srtt = None
+        self.rttvar = None
+
+    def _update(self, est, rtt):
+        if est.srtt is None:
+            est.srtt = rtt
+            est.rttvar = rtt / 2.0
+        else:
+            est.rttvar += self.beta * (abs(est.srtt - rtt) - est.rttvar)
+            est.srtt += self.alpha * (rtt - est.srtt)
+
+    def _rto(self, est, k):
+        rto = est.srtt + max(self.granularity, k * est.rttvar)
+        return min(max(rto, self.min_rto), self.max_rto)
+
+    def _estimate(self, node, k):
+        if node is not None and node.srtt is not None:
+            return self._rto(node, k)
+        if self.srtt is not None:
+            return self._rto(self, k)
+        return self.max_rto
+
+    def sample(self, node, rtt):
+        ''' sample records a round trip time measured to node '''
+        self._update(node, rtt)
+        self._update(self, rtt)
+
+    def timeout(self, node=None):
+        ''' timeout returns how long to wait for a response from node '''
+        return self._estimate(node, self.k)
+
+    def stall_timeout(self, node=None):
+        ''' stall_timeout returns how long a response from node would
+        usually take at most, a query taking longer is probably slow or
+        lost even though it hasn't timed out yet '''
+        return self._estimate(node, self.stall_k)
+
+    def backoff(self, node):
+        ''' backoff doubles the timeout of a node which failed to respond
+        in time, so that a late responder isn't timed out forever '''
+        if node.srtt is not None:
+            rto = min(2 * self._rto(node, self.k), self.max_rto)
+            node.rttvar = max(rto - node.srtt, 0) / float(self.k)
@@ -4,6 +4,19 @@ import unittest
 from tests.testNode import TestNode
 from tests.testKbucket import TestKbucket
 from tests.testRoutingTree import TestRoutingTree
+from tests.testCodec import TestBinaryCodec, TestJsonCodec
+from tests.testUdp import TestUdp
+from tests.testClock import TestVirtualClock, TestLinkModel
+from tests.testSimulate import TestSimulate
+from tests.testTrie import TestTrieRoutingTree
+from tests.testRpcClient import TestRpcClient
+from tests.testKadClient import TestKadClient
+from tests.testShortlist import TestShortlist, TestLookupStats, TestLookupCache
+from tests.testRtt import TestRttEstimator
+from tests.testChan import TestSelectChan
+from tests.testRateLimit import TestRateLimiter
+from tests.testDatastore import TestSimple, TestBounded
+from tests.testDiskStore import TestDiskStore
 
 if __name__ == '__main__':
     unittest.main()
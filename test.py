@@ -1,32 +1,45 @@
 from client import Rpc_Client, Kad_Client
-from network.simulate import Simulate
+from network.simulate import Simulate, LinkModel
+from network.codec import JsonCodec
+from chan import SelectChan
+from lookup import LookupStats
+import clock
 
-from gevent import pool, queue
+from gevent import pool
 
-import gevent
+import argparse
 import random
+import time
+
+results = { 'stored' : 0, 'found' : 0, 'failed' : 0 }
+lookup_stats = LookupStats()
+lookup_options = {}
+lookup_caches = []
 
 def client_actions(client, nodes):
     count =  0
     stored = {}
-    gevent.sleep(random.randint(0,1))
+    clock.sleep(random.randint(0,1))
     client._join_network(nodes)
 
     while True:
-        gevent.sleep(5)
+        clock.sleep(5)
         if random.random() < 0.25:
             key = '%s_%s' % (client.node.id, count)
             value = str(count)
             client._store_value(key, value)
             stored[key] = value
+            results['stored'] += 1
             count += 1
         elif random.random() < 0.25 and stored:
             key = random.choice(stored.keys())
             print "looking up %s, expecting %s" % (key, stored[key])
             value = client._fetch_value(key)
             if value == stored[key]:
+                results['found'] += 1
                 print 'ok good job'
             else:
+                results['failed'] += 1
                 print 'failed, expected %s, found %s' % (stored[key], value)
 
 def client_summary(clients):
@@ -45,36 +58,92 @@ def client_summary(clients):
 
     print "client_summary"
     while True:
-        gevent.sleep(5)
+        clock.sleep(5)
         bmax, bmin = bucket_stats(clients)
         print "client_summary, watching %s clients" % (len(clients))
         print "min_buckets: %s, max_buckets %s" % (bmin, bmax)
 
-def spawn_clients(pool, network, n):
+def spawn_clients(pool, network, n, debug):
     clients = []
-    last, kad_client = spawn_client(pool, network)
+    last, kad_client = spawn_client(pool, network, None, debug)
     clients.append(kad_client)
     for i in xrange(0,n-1):
-        last, kad_client = spawn_client(pool, network, last)
+        last, kad_client = spawn_client(pool, network, last, debug)
         clients.append(kad_client)
 
     print "test: spawned %s nodes" % n
     pool.spawn(client_summary, clients)
 
-def spawn_client(pool, network, initial_node=None):
+def spawn_client(pool, network, initial_node=None, debug=True):
     if initial_node is None:
         nodes = []
     else:
         nodes = [initial_node]
 
-    rpc_chan  = queue.Queue()
-    rpc_client = Rpc_Client(network, rpc_chan)
+    chan = SelectChan()
+    rpc_client = Rpc_Client(network, chan)
     node = rpc_client.return_node()
-    kad_client = Kad_Client(pool, rpc_client, rpc_chan)
+    kad_client = Kad_Client(pool, rpc_client, chan.fetch_chan('int'), **lookup_options)
+    kad_client.stats = lookup_stats
+    lookup_caches.append(kad_client.lookup_cache)
+    rpc_client.debug = debug
+    kad_client.debug = debug
     pool.spawn(client_actions, kad_client, nodes)
     return node, kad_client
 
-p = pool.Pool(100000)
-network = Simulate(False)
-p.spawn(spawn_clients, p, network, 50)
-p.join()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run a simulated kad network')
+    parser.add_argument('--nodes', type=int, default=50)
+    parser.add_argument('--virtual', type=float, metavar='SECONDS',
+                        help='run for SECONDS of virtual time as fast as possible')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed, a virtual run is repeatable for a given seed')
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--shared', action='store_true',
+                        help='deliver messages without copying them')
+    parser.add_argument('--check-shared', action='store_true',
+                        help='detect receivers modifying shared messages')
+    parser.add_argument('--json', action='store_true',
+                        help='copy messages through the json codec, for debugging')
+    parser.add_argument('--alpha-min', type=int, default=3)
+    parser.add_argument('--alpha-max', type=int, default=8)
+    parser.add_argument('--quiet', action='store_true')
+    args = parser.parse_args()
+    lookup_options['alpha_min'] = args.alpha_min
+    lookup_options['alpha_max'] = args.alpha_max
+
+    codec = JsonCodec() if args.json else None
+    p = pool.Pool(100000)
+    if args.virtual is None:
+        network = Simulate(False, codec=codec, copy=not args.shared,
+                           check_shared=args.check_shared)
+        p.spawn(spawn_clients, p, network, args.nodes, not args.quiet)
+        p.join()
+    else:
+        random.seed(args.seed)
+        clock.set_clock(clock.VirtualClock())
+        links = LinkModel(args.latency, args.jitter, args.loss, seed=args.seed)
+        network = Simulate(False, codec=codec, links=links, copy=not args.shared,
+                           check_shared=args.check_shared)
+        p.spawn(spawn_clients, p, network, args.nodes, not args.quiet)
+
+        start = time.time()
+        clock.get_clock().run(until=args.virtual)
+        elapsed = time.time() - start
+        print "simulated %.0fs with %s nodes in %.2fs (%s events, %s lost messages)" % (
+            args.virtual, args.nodes, elapsed, clock.get_clock().processed, network.lost)
+        print "stored: %(stored)s, found: %(found)s, failed: %(failed)s" % results
+        s = lookup_stats
+        if s.lookups:
+            print "lookups: %s (%s shared), per lookup: hops %.2f, messages %.1f, stalled %.2f, timeouts %.2f, alpha %.2f" % (
+                s.lookups, s.shared, float(s.hops) / s.lookups, float(s.messages) / s.lookups,
+                float(s.stalled) / s.lookups, float(s.timeouts) / s.lookups,
+                float(s.alpha) / s.lookups)
+        hits = sum(c.hits for c in lookup_caches)
+        misses = sum(c.misses for c in lookup_caches)
+        if hits + misses:
+            print "lookup cache: %s hits, %s misses (%.1f%%), %s invalidated" % (
+                hits, misses, 100.0 * hits / (hits + misses),
+                sum(c.invalidations for c in lookup_caches))
@@ -0,0 +1,87 @@
+import unittest
+import gevent
+from gevent.queue import Empty, Full
+from chan import SelectChan, Channel
+import clock
+
+class TestSelectChan(unittest.TestCase):
+
+    def drain(self, chan):
+        out = []
+        while True:
+            try:
+                out.append(chan.get_nowait())
+            except Empty:
+                return out
+
+    def test_round_robin(self):
+        chan = SelectChan()
+        for i in xrange(3):
+            chan.put('rpc', i)
+        chan.put('int', 'a')
+        chan.put('timer', 't')
+        chan.put('int', 'b')
+        self.assertEqual(self.drain(chan),
+                         [('rpc', 0), ('int', 'a'), ('timer', 't'),
+                          ('rpc', 1), ('int', 'b'), ('rpc', 2)])
+
+    def test_weights(self):
+        chan = SelectChan([Channel('a', weight=3), Channel('b')])
+        for i in xrange(4):
+            chan.put('a', i)
+            chan.put('b', i)
+        self.assertEqual([c for c, m in self.drain(chan)],
+                         ['a', 'a', 'a', 'b', 'a', 'b', 'b', 'b'])
+
+    def test_drop_new(self):
+        chan = SelectChan([Channel('rpc', maxsize=2, policy='drop_new')])
+        for i in xrange(4):
+            chan.put('rpc', i)
+        self.assertEqual(self.drain(chan), [('rpc', 0), ('rpc', 1)])
+        self.assertEqual(chan.stats()['rpc'],
+                         { 'depth' : 0, 'max_depth' : 2, 'received' : 2, 'dropped' : 2 })
+
+    def test_drop_old(self):
+        chan = SelectChan([Channel('rpc', maxsize=2, policy='drop_old')])
+        for i in xrange(4):
+            chan.fetch_chan('rpc').put(i, block=False)
+        self.assertEqual(chan.depth('rpc'), 2)
+        self.assertEqual(self.drain(chan), [('rpc', 2), ('rpc', 3)])
+        self.assertEqual(chan.stats()['rpc']['dropped'], 2)
+
+    def test_block(self):
+        chan = SelectChan([Channel('int', maxsize=1)])
+        chan.put('int', 1)
+        self.assertRaises(Full, chan.put, 'int', 2, False)
+
+        g = gevent.spawn(chan.put, 'int', 2)
+        gevent.sleep()
+        self.assertFalse(g.ready())
+        self.assertEqual(chan.get(), ('int', 1))
+        g.join()
+        self.assertEqual(chan.get(), ('int', 2))
+
+    def test_get_waits(self):
+        chan = SelectChan()
+        gevent.spawn_later(0.01, chan.put, 'int', 'x')
+        self.assertEqual(chan.get(), ('int', 'x'))
+        self.assertRaises(Empty, chan.get, False)
+
+    def test_get_timeout(self):
+        clock.set_clock(clock.VirtualClock())
+        try:
+            chan = SelectChan()
+            result = []
+            def get():
+                try:
+                    chan.get(timeout=5)
+                except Empty:
+                    result.append(clock.time())
+            gevent.spawn(get)
+            clock.get_clock().run(until=10)
+            self.assertEqual(result, [5])
+        finally:
+            clock.set_clock(clock.RealClock())
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, Channel, 'rpc', 10, 1, 'drop_all')
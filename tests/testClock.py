@@ -0,0 +1,82 @@
+import unittest
+import gevent
+from gevent.queue import Queue, Empty
+from clock import VirtualClock
+from network.simulate import LinkModel
+
+class TestVirtualClock(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = VirtualClock()
+
+    def test_call_later_order(self):
+        fired = []
+        self.clock.call_later(2, fired.append, 'b')
+        self.clock.call_later(1, fired.append, 'a')
+        self.clock.call_later(2, fired.append, 'c')
+        self.clock.run()
+        self.assertEqual(fired, ['a', 'b', 'c'])
+        self.assertEqual(self.clock.time(), 2)
+
+    def test_cancel(self):
+        fired = []
+        timer = self.clock.call_later(1, fired.append, 'a')
+        timer.cancel()
+        self.clock.run()
+        self.assertEqual(fired, [])
+
+    def test_sleep(self):
+        woke = []
+        def sleeper(seconds):
+            self.clock.sleep(seconds)
+            woke.append((seconds, self.clock.time()))
+        gevent.spawn(sleeper, 10)
+        gevent.spawn(sleeper, 5)
+        self.clock.run()
+        self.assertEqual(woke, [(5, 5), (10, 10)])
+
+    def test_timeout(self):
+        result = []
+        def waiter():
+            try:
+                with self.clock.timeout(3, Empty):
+                    Queue().get()
+            except Empty:
+                result.append(self.clock.time())
+        gevent.spawn(waiter)
+        self.clock.run()
+        self.assertEqual(result, [3])
+
+    def test_timeout_cancelled(self):
+        q = Queue()
+        result = []
+        def waiter():
+            with self.clock.timeout(3, Empty):
+                result.append(q.get())
+        gevent.spawn(waiter)
+        self.clock.call_later(1, q.put, 'x')
+        self.clock.run()
+        self.assertEqual(result, ['x'])
+        self.assertEqual(self.clock.time(), 1)
+
+    def test_run_until(self):
+        fired = []
+        self.clock.call_later(5, fired.append, 'a')
+        self.clock.run(until=4)
+        self.assertEqual(fired, [])
+        self.assertEqual(self.clock.time(), 4)
+
+class TestLinkModel(unittest.TestCase):
+
+    def test_deterministic(self):
+        a = LinkModel(0.05, 0.01, 0.1, seed=1)
+        b = LinkModel(0.05, 0.01, 0.1, seed=1)
+        link = (('10.0.0.1', 1), ('10.0.0.2', 2))
+        self.assertEqual([a.delay(*link) for i in xrange(100)],
+                         [b.delay(*link) for i in xrange(100)])
+
+    def test_set_link(self):
+        links = LinkModel(0.05)
+        links.set_link(('10.0.0.1', 1), ('10.0.0.2', 2), latency=1, loss=1)
+        self.assertEqual(links.delay(('10.0.0.1', 1), ('10.0.0.2', 2)), None)
+        self.assertEqual(links.delay(('10.0.0.2', 2), ('10.0.0.1', 1)), 0.05)
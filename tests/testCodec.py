@@ -0,0 +1,95 @@
+import unittest
+from network.codec import BinaryCodec, JsonCodec, CodecError
+
+class TestBinaryCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.codec = BinaryCodec()
+        self.source = ['10.0.0.1', 50000, 2**160 - 1]
+        self.nodes = [('10.0.0.2', 50001, 0), ('10.0.0.3', 65535, 12345)]
+
+    def message(self, m_type, data):
+        return {
+            'source' : self.source,
+            'xid'    : 2**64 - 1,
+            'type'   : m_type,
+            'data'   : data
+        }
+
+    def roundtrip(self, m):
+        return self.codec.decode(self.codec.encode(m))
+
+    def test_ping(self):
+        m = self.message('PING', {})
+        self.assertEqual(self.roundtrip(m), m)
+
+    def test_find_node(self):
+        m = self.message('FIND_NODE', 2**159 + 7)
+        self.assertEqual(self.roundtrip(m), m)
+
+    def test_return_node(self):
+        m = self.message('RETURN_NODE', self.nodes)
+        self.assertEqual(self.roundtrip(m), m)
+
+        m = self.message('RETURN_NODE', [])
+        self.assertEqual(self.roundtrip(m), m)
+
+    def test_find_value(self):
+        m = self.message('FIND_VALUE', { 'key' : 'a key', 'key_hash' : 42 })
+        self.assertEqual(self.roundtrip(m), m)
+
+    def test_return_value(self):
+        m = self.message('RETURN_VALUE', { 'value' : 'x' * 1000, 'found' : True })
+        self.assertEqual(self.roundtrip(m), m)
+
+        m = self.message('RETURN_VALUE', { 'nodes' : self.nodes, 'found' : False })
+        self.assertEqual(self.roundtrip(m), m)
+
+    def test_store(self):
+        m = self.message('STORE', { 'key' : 'k', 'key_hash' : 1, 'value' : u'v' })
+        self.assertEqual(self.roundtrip(m), m)
+
+        m = self.message('STORE', { 'key' : 'k', 'key_hash' : 1, 'value' : u'v', 'cache' : True })
+        self.assertEqual(self.roundtrip(m), m)
+
+        m = self.message('STORE', { 'key' : 'k', 'key_hash' : 1, 'value' : 'v', 'ack' : True })
+        self.assertEqual(self.roundtrip(m), m)
+
+        for stored in (True, False):
+            m = self.message('STORE_ACK', { 'stored' : stored })
+            self.assertEqual(self.roundtrip(m), m)
+
+    def test_batched(self):
+        m = self.message('STORE_MANY', [{ 'key' : 'k%s' % i, 'key_hash' : i, 'value' : 'v' * i }
+                                        for i in xrange(3)])
+        self.assertEqual(self.roundtrip(m), m)
+
+        m = self.message('FIND_VALUE_MANY', [{ 'key' : 'k%s' % i, 'key_hash' : i } for i in xrange(3)])
+        self.assertEqual(self.roundtrip(m), m)
+
+        m = self.message('RETURN_VALUE_MANY', [{ 'key_hash' : 2**160 - 1, 'value' : 'x' * 1000 }])
+        self.assertEqual(self.roundtrip(m), m)
+
+        m = self.message('RETURN_VALUE_MANY', [])
+        self.assertEqual(self.roundtrip(m), m)
+
+    def test_header_size(self):
+        m = self.message('PING', {})
+        self.assertEqual(len(self.codec.encode(m)), 35)
+
+    def test_bad_messages(self):
+        self.assertRaises(CodecError, self.codec.encode, self.message('UNKNOWN', {}))
+        self.assertRaises(CodecError, self.codec.encode, self.message('FIND_NODE', 2**160))
+        self.assertRaises(CodecError, self.codec.decode, '')
+
+        data = self.codec.encode(self.message('RETURN_NODE', self.nodes))
+        self.assertRaises(CodecError, self.codec.decode, data[:-1])
+        self.assertRaises(CodecError, self.codec.decode, data + 'x')
+
+class TestJsonCodec(unittest.TestCase):
+
+    def test_roundtrip(self):
+        codec = JsonCodec()
+        m = { 'source' : ['10.0.0.1', 1, 2], 'xid' : 3, 'type' : 'PING', 'data' : {} }
+        self.assertEqual(codec.decode(codec.encode(m)), m)
+        self.assertRaises(CodecError, codec.decode, '{')
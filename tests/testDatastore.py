@@ -0,0 +1,163 @@
+import unittest
+from datastore.simple import simple
+from datastore.bounded import bounded, LruPolicy, DistancePolicy
+from routing import Node
+import clock
+
+class TestSimple(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = clock.VirtualClock()
+        clock.set_clock(self.clock)
+
+    def tearDown(self):
+        clock.set_clock(clock.RealClock())
+
+    def test_store_retrieve(self):
+        store = simple()
+        store.store('a', 1, 'x')
+        self.assertEqual(store.retrieve(1), 'x')
+        self.assertEqual(store.retrieve(2), None)
+        store.remove(1)
+        self.assertEqual(store.retrieve(1), None)
+
+    def test_contains(self):
+        store = simple(ttl=10)
+        store.store('a', 1, 'x')
+        self.assertTrue(store.contains(1))
+        self.assertFalse(store.contains(2))
+        self.clock.now = 10
+        self.assertFalse(store.contains(1))
+        # an expired value is only removed by retrieve or expire
+        self.assertEqual(len(store), 1)
+
+    def test_expires(self):
+        store = simple(ttl=10)
+        store.store('a', 1, 'x')
+        store.store('b', 2, 'y', ttl=5)
+        self.clock.now = 5
+        self.assertEqual(store.retrieve(2), None)
+        self.assertEqual(store.retrieve(1), 'x')
+        self.clock.now = 10
+        self.assertEqual(store.retrieve(1), None)
+        self.assertEqual(len(store), 0)
+
+    def test_refresh(self):
+        store = simple(ttl=10)
+        store.store('a', 1, 'x')
+        self.clock.now = 8
+        store.store('a', 1, 'x')
+        self.clock.now = 12
+        self.assertEqual(store.expire(), 0)
+        self.assertEqual(store.retrieve(1), 'x')
+        self.clock.now = 18
+        self.assertEqual(store.expire(), 1)
+        self.assertEqual(store.deadlines, [])
+
+    def test_expire_incremental(self):
+        store = simple(ttl=10)
+        for i in xrange(10):
+            store.store(str(i), i, i)
+        self.clock.now = 10
+        self.assertEqual(store.expire(3), 3)
+        self.assertEqual(len(store), 7)
+        # storing clears up a couple of expired values as it goes
+        store.store('new', 100, 'new')
+        self.assertEqual(len(store), 6)
+        self.assertEqual(store.expire(), 5)
+        self.assertEqual(len(store), 1)
+
+    def test_heap_rebuilt(self):
+        store = simple(ttl=10)
+        for i in xrange(1000):
+            store.store('a', 1, i)
+        self.assertTrue(len(store.deadlines) <= 66)
+        self.assertEqual(store.retrieve(1), 999)
+
+class TestBounded(unittest.TestCase):
+
+    def test_accounting(self):
+        store = bounded(max_bytes=100)
+        self.assertTrue(store.store('ab', 1, 'cdef'))
+        self.assertTrue(store.store('gh', 2, 'ij'))
+        self.assertEqual(store.bytes, 10)
+        store.store('ab', 1, 'c')
+        self.assertEqual(store.bytes, 7)
+        store.remove(2)
+        self.assertEqual(store.bytes, 3)
+
+    def test_lru(self):
+        store = bounded(max_bytes=30)
+        for i in xrange(3):
+            store.store('k%s' % i, i, 'v' * 8)
+        store.retrieve(0)
+        store.store('k3', 3, 'v' * 8)
+        self.assertEqual(sorted(store.hash_value), [0, 2, 3])
+        self.assertEqual(store.retrieve(1), None)
+        self.assertEqual(store.stats(),
+                         { 'entries' : 3, 'bytes' : 30, 'max_bytes' : 30,
+                           'hits' : 1, 'misses' : 1, 'evictions' : 1, 'rejected' : 0 })
+
+    def test_contains(self):
+        store = bounded(max_bytes=20)
+        store.store('a', 1, 'x' * 8)
+        store.store('b', 2, 'x' * 8)
+        self.assertTrue(store.contains(1))
+        self.assertFalse(store.contains(3))
+        # not a use of 1, so it's still the one evicted
+        store.store('c', 3, 'x' * 8)
+        self.assertEqual(sorted(store.hash_value), [2, 3])
+        self.assertEqual((store.hits, store.misses), (0, 0))
+
+    def test_distance(self):
+        store = bounded(Node(None, None, 0), max_bytes=20, policy=DistancePolicy)
+        store.store('a', 8, 'x' * 9)
+        store.store('b', 2, 'x' * 9)
+        # further than everything held
+        self.assertFalse(store.store('c', 9, 'x' * 9))
+        self.assertTrue(store.store('d', 4, 'x' * 9))
+        self.assertEqual(sorted(store.hash_value), [2, 4])
+        self.assertEqual((store.evictions, store.rejected), (1, 1))
+
+    def test_rejected_overwrite(self):
+        store = bounded(Node(None, None, 0), max_bytes=20, policy=DistancePolicy)
+        store.store('a', 2, 'x' * 9)
+        store.store('b', 4, 'y' * 9)
+        # the new value for 4 would need 2 evicted, which is closer
+        self.assertFalse(store.store('b', 4, 'z' * 11))
+        self.assertEqual(store.retrieve(4), 'y' * 9)
+        self.assertEqual(store.retrieve(2), 'x' * 9)
+        self.assertEqual(store.bytes, 20)
+        self.assertEqual(store.policy.victim(), 4)
+
+    def test_expired_reclaimed(self):
+        clock.set_clock(clock.VirtualClock())
+        try:
+            store = bounded(Node(None, None, 0), max_bytes=4, policy=DistancePolicy)
+            store.store('a', 1, 'xyz', ttl=10)
+            clock.get_clock().now = 10
+            # the expired close value makes way for a far one
+            self.assertTrue(store.store('b', 8, 'xyz'))
+            self.assertEqual((store.rejected, store.evictions, store.bytes), (0, 0, 4))
+            self.assertEqual(store.retrieve(8), 'xyz')
+        finally:
+            clock.set_clock(clock.RealClock())
+
+    def test_too_large(self):
+        store = bounded(max_bytes=10)
+        store.store('a', 1, 'x')
+        self.assertFalse(store.store('b', 2, 'x' * 10))
+        self.assertEqual(store.retrieve(1), 'x')
+        self.assertEqual(store.bytes, 2)
+
+    def test_expiry_accounted(self):
+        clock.set_clock(clock.VirtualClock())
+        try:
+            store = bounded(max_bytes=100, ttl=10)
+            store.store('a', 1, 'xyz')
+            clock.get_clock().now = 10
+            store.expire()
+            self.assertEqual(store.bytes, 0)
+            self.assertEqual(len(store.policy.order), 0)
+        finally:
+            clock.set_clock(clock.RealClock())
@@ -0,0 +1,155 @@
+import unittest
+import os
+import shutil
+import tempfile
+from datastore.disk import disk
+import clock
+
+class TestDiskStore(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        shutil.rmtree(self.path)
+
+    def open(self, **kwargs):
+        store = disk(path=self.path, **kwargs)
+        self.stores.append(store)
+        return store
+
+    def test_store_retrieve_remove(self):
+        store = self.open()
+        store.store('a', 1, 'x')
+        store.store('b', 2**160 - 1, 'y' * 1000)
+        self.assertEqual(store.retrieve(1), 'x')
+        self.assertEqual(store.retrieve(2**160 - 1), 'y' * 1000)
+        self.assertEqual(store.retrieve(3), None)
+        self.assertTrue(store.contains(2**160 - 1))
+        self.assertFalse(store.contains(3))
+
+        store.store('a', 1, 'z')
+        self.assertEqual(store.retrieve(1), 'z')
+        store.remove(1)
+        self.assertEqual(store.retrieve(1), None)
+        self.assertFalse(store.contains(1))
+
+    def test_failed_write(self):
+        store = self.open()
+        self.assertTrue(store.store('a', 1, 'x'))
+        writer = store.writer
+        store.writer = open(store.log_path, 'rb')
+        try:
+            self.assertFalse(store.store('a', 1, 'y'))
+        finally:
+            store.writer.close()
+            store.writer = writer
+        self.assertEqual(store.retrieve(1), 'x')
+
+    def test_reopen(self):
+        store = self.open(max_delta=3)
+        for i in xrange(10):
+            store.store(str(i), i, 'v%s' % i)
+        store.remove(4)
+        self.assertTrue(store.count > 0)
+        store.close()
+
+        store = self.open()
+        self.assertEqual([store.retrieve(i) for i in xrange(10)],
+                         ['v0', 'v1', 'v2', 'v3', None, 'v5', 'v6', 'v7', 'v8', 'v9'])
+
+    def test_rebuild_index(self):
+        store = self.open(max_delta=3)
+        for i in xrange(10):
+            store.store(str(i), i, 'v%s' % i)
+        store.close()
+        os.remove(store.index_path)
+
+        store = self.open()
+        self.assertEqual(store.count, 10)
+        self.assertEqual(store.retrieve(7), 'v7')
+
+    def test_rebuild_bounded(self):
+        store = self.open(max_delta=1000)
+        for i in xrange(50):
+            store.store(str(i), i, 'v%s' % i)
+        store.remove(7)
+        store.close()
+        # nothing was flushed, so the whole log is replayed
+        self.assertFalse(os.path.exists(store.index_path))
+
+        peak = []
+        class watched(disk):
+            def _apply(self, *args):
+                disk._apply(self, *args)
+                peak.append(len(self.delta))
+
+        store = watched(path=self.path, max_delta=8)
+        self.stores.append(store)
+        self.assertTrue(max(peak) <= 8)
+        self.assertEqual(store.count, 49)
+        self.assertEqual(store.log_end, store.end)
+        self.assertEqual(store.retrieve(7), None)
+        self.assertEqual(store.retrieve(42), 'v42')
+
+    def test_torn_write(self):
+        store = self.open()
+        store.store('a', 1, 'x')
+        store.store('b', 2, 'y')
+        store.close()
+        with open(store.log_path, 'r+b') as f:
+            f.truncate(os.path.getsize(store.log_path) - 1)
+
+        store = self.open()
+        self.assertEqual(store.retrieve(1), 'x')
+        self.assertEqual(store.retrieve(2), None)
+        store.store('c', 3, 'z')
+        self.assertEqual(store.retrieve(3), 'z')
+
+    def test_compact(self):
+        store = self.open(min_garbage=0, yield_every=2)
+        for i in xrange(20):
+            store.store(str(i), i, 'v' * 100)
+        for i in xrange(0, 20, 2):
+            store.remove(i)
+        store.compact().join()
+        self.assertEqual(store.compactions, 1)
+        self.assertEqual(store.live, store.end - store.log_header.size)
+        self.assertEqual([store.retrieve(i) for i in xrange(4)], [None, 'v' * 100, None, 'v' * 100])
+        store.close()
+
+        store = self.open()
+        self.assertEqual(store.generation, 2)
+        self.assertEqual(store.retrieve(19), 'v' * 100)
+
+    def test_write_during_compaction(self):
+        store = self.open(min_garbage=0, yield_every=1)
+        for i in xrange(10):
+            store.store(str(i), i, 'a')
+        g = store.compact()
+        clock.sleep()
+        store.store('0', 0, 'b')
+        store.remove(1)
+        store.store('new', 100, 'c')
+        g.join()
+        self.assertEqual([store.retrieve(i) for i in (0, 1, 2, 100)], ['b', None, 'a', 'c'])
+
+    def test_expiry(self):
+        clock.set_clock(clock.VirtualClock())
+        try:
+            store = self.open(compact_interval=0)
+            store.store('a', 1, 'x', ttl=10)
+            store.store('b', 2, 'y', ttl=100)
+            clock.get_clock().now = 10
+            self.assertEqual(store.retrieve(1), None)
+            self.assertFalse(store.contains(1))
+            store.expire()
+            store.compacting.join()
+            self.assertEqual(store.count, 1)
+            self.assertEqual(store.min_expires, 100)
+            self.assertEqual(store.retrieve(2), 'y')
+        finally:
+            clock.set_clock(clock.RealClock())
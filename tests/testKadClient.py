@@ -0,0 +1,218 @@
+import unittest
+from client import Rpc_Client, Kad_Client
+from chan import SelectChan
+from network.simulate import Simulate
+from routing import Node
+import clock
+import internal
+
+import gevent
+from gevent import pool
+
+class TestKadClient(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = pool.Pool()
+        chan = SelectChan()
+        rpc_client = Rpc_Client(Simulate(copy=False), chan, Node(None, None, 2**159))
+        rpc_client.debug = False
+        self.client = Kad_Client(self.pool, rpc_client, chan.fetch_chan('int'))
+        self.client.debug = False
+
+        self.calls = []
+        self.use_cache = []
+        self.client._iterative_lookup = self.lookup
+
+    def tearDown(self):
+        self.pool.kill()
+
+    def lookup(self, node, key=None, stats=None, use_cache=True):
+        self.calls.append((node.id, key))
+        self.use_cache.append(use_cache)
+        clock.sleep(0.01)
+        if key == 'missing':
+            raise KeyError(key)
+        if key == None:
+            return [Node(None, None, node.id + 1)]
+        return 'value of %s' % key
+
+    def test_single_flight(self):
+        target = Node(None, None, 5)
+        node_lookups = [gevent.spawn(self.client._node_lookup, target) for i in xrange(3)]
+        value_lookups = [gevent.spawn(self.client._node_lookup, target, 'k') for i in xrange(3)]
+        gevent.joinall(node_lookups + value_lookups)
+
+        self.assertEqual(sorted(self.calls), [(5, None), (5, 'k')])
+        for g in node_lookups:
+            self.assertEqual([n.id for n in g.value], [6])
+        self.assertIsNot(node_lookups[0].value, node_lookups[1].value)
+        for g in value_lookups:
+            self.assertEqual(g.value, 'value of k')
+        self.assertEqual(self.client.stats.shared, 4)
+        self.assertEqual(self.client.lookups, {})
+
+        # a finished lookup isn't shared
+        self.client._node_lookup(target, 'k')
+        self.assertEqual(len(self.calls), 3)
+
+    def test_uncached_not_shared(self):
+        target = Node(None, None, 5)
+        cached = gevent.spawn(self.client._node_lookup, target)
+        uncached = gevent.spawn(self.client._node_lookup, target, use_cache=False)
+        gevent.joinall([cached, uncached])
+        self.assertEqual(self.calls, [(5, None), (5, None)])
+        self.assertEqual(self.use_cache, [True, False])
+        self.assertEqual(self.client.stats.shared, 0)
+
+    def test_exception_shared(self):
+        def fetch():
+            try:
+                return self.client._node_lookup(Node(None, None, 5), 'missing')
+            except KeyError as e:
+                return e
+
+        lookups = [gevent.spawn(fetch) for i in xrange(2)]
+        gevent.joinall(lookups)
+        self.assertEqual(len(self.calls), 1)
+        for g in lookups:
+            self.assertIsInstance(g.value, KeyError)
+        self.assertEqual(self.client.lookups, {})
+
+    def test_killed_owner(self):
+        target = Node(None, None, 5)
+        owner = gevent.spawn(self.client._node_lookup, target, 'k')
+        waiter = gevent.spawn(self.client._node_lookup, target, 'k')
+        gevent.sleep(0)
+        owner.kill()
+        waiter.join()
+        self.assertEqual(waiter.value, 'value of k')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_group_keys(self):
+        self.client._node_lookup = lambda node: [Node(None, None, node.id ^ 1),
+                                                 Node(None, None, node.id ^ 0b110)]
+        hashed = [(0b1000, 'a'), (0b1010, 'b'), (0b1111, 'c'), (0b10000, 'd')]
+        groups = [[key for key_hash, key in run] for nodes, run in self.client._group_keys(hashed)]
+        self.assertEqual(groups, [['a', 'b'], ['c'], ['d']])
+
+    def test_store_many(self):
+        nodes = [Node(None, None, 1), Node(None, None, 2**160 - 1)]
+        self.client._node_lookup = lambda node: nodes
+        sent = []
+        self.client.send_message = sent.append
+        self.client.batch_keys = 2
+
+        items = dict(('k%s' % i, 'v%s' % i) for i in xrange(3))
+        self.client._store_many(items)
+        for node in nodes:
+            batches = [c.items for c in sent if c.node is node]
+            self.assertTrue(all(len(batch) <= 2 for batch in batches))
+            stored = dict((key, value) for batch in batches for key, key_hash, value in batch)
+            self.assertEqual(stored, items)
+
+    def test_store_many_paced(self):
+        clock.set_clock(clock.VirtualClock())
+        try:
+            nodes = [Node(None, None, 1), Node(None, None, 2)]
+            self.client._node_lookup = lambda node: nodes
+            # each node's rate limit, as it would be applied by the node
+            rpc_client = self.client.rpc_client
+            limiter = rpc_client.rate_limits['STORE_MANY']
+            stored = []
+            def send_message(command):
+                if limiter.allow(command.node.id, 1 + len(command.items) // rpc_client.batch_cost):
+                    stored.extend(command.items)
+            self.client.send_message = send_message
+
+            items = dict(('k%s' % i, 'v') for i in xrange(2000))
+            g = gevent.spawn(self.client._store_many, items)
+            clock.get_clock().run(until=100)
+            self.assertTrue(g.ready())
+            self.assertEqual(limiter.dropped, 0)
+            self.assertEqual(len(stored), 2 * len(items))
+        finally:
+            clock.set_clock(clock.RealClock())
+
+    def test_fetch_many_paced(self):
+        clock.set_clock(clock.VirtualClock())
+        try:
+            nodes = [Node(None, None, 1), Node(None, None, 2**160 - 1)]
+            self.client._node_lookup = lambda node: nodes
+            rpc_client = self.client.rpc_client
+            limiter = rpc_client.rate_limits['FIND_VALUE_MANY']
+            inflight = [0, 0]
+            def reply(chan, m):
+                inflight[0] -= 1
+                chan.put(m)
+            def send_message(command):
+                inflight[0] += 1
+                inflight[1] = max(inflight)
+                m = { 'timeout' : True, 'node' : command.node }
+                if limiter.allow(command.node.id, 1 + len(command.keys) // rpc_client.batch_cost):
+                    m = { 'timeout' : False, 'node' : command.node,
+                          'values' : dict((key_hash, 'v') for key, key_hash in command.keys) }
+                clock.call_later(0.1, reply, command.chan, m)
+            self.client.send_message = send_message
+            fallback = []
+            self.client._fetch_value = lambda key: fallback.append(key)
+
+            keys = ['k%s' % i for i in xrange(2000)]
+            g = gevent.spawn(self.client._fetch_many, keys)
+            clock.get_clock().run(until=100)
+            self.assertEqual(g.value, dict.fromkeys(keys, 'v'))
+            self.assertEqual((limiter.dropped, fallback), (0, []))
+            self.assertTrue(inflight[1] <= self.client.fetch_inflight)
+        finally:
+            clock.set_clock(clock.RealClock())
+
+    def test_batches(self):
+        self.client.batch_bytes = 70
+        items = [('a', 1, 'x' * 20), ('b', 2, 'y' * 20), ('c', 3)]
+        self.assertEqual(list(self.client._batches(items)), [items[:1], items[1:]])
+
+    def test_fetch_many(self):
+        a, b = Node(None, None, 1), Node(None, None, 2**160 - 1)
+        self.client._node_lookup = lambda node: [a, b]
+        held = { 'a' : 'va', 'b' : 'vb' }
+        asked = []
+        def send_message(command):
+            asked.append(command.node)
+            if command.node is b and asked.count(b) == 1:
+                # b doesn't answer at first, its keys are asked of a
+                command.chan.put({ 'timeout' : True, 'node' : b })
+                return
+            values = dict((key_hash, held[key]) for key, key_hash in command.keys if key in held)
+            command.chan.put({ 'timeout' : False, 'values' : values, 'node' : command.node })
+        self.client.send_message = send_message
+        fallback = []
+        self.client._fetch_value = lambda key: fallback.append(key) or 'found later'
+
+        values = self.client._fetch_many(['a', 'b', 'c'])
+        self.assertEqual(values, { 'a' : 'va', 'b' : 'vb', 'c' : 'found later' })
+        self.assertEqual(fallback, ['c'])
+        # every key is asked of two nodes at most, one batch each time
+        self.assertTrue(len(asked) <= 4)
+
+    def test_store_quorum(self):
+        nodes = [Node(None, None, 2**159 + i) for i in xrange(5)]
+        self.client._node_lookup = lambda node: nodes
+        sent = []
+        def send_message(command):
+            sent.append(command.node)
+            if command.node is nodes[0]:
+                command.chan.put({ 'timeout' : True, 'node' : command.node })
+            elif command.node is nodes[2]:
+                command.chan.put({ 'timeout' : False, 'node' : command.node, 'stored' : False })
+            elif command.node is not nodes[1]:
+                command.chan.put({ 'timeout' : False, 'node' : command.node, 'stored' : True })
+        self.client.send_message = send_message
+        self.client.rpc_client.rtt.sample(nodes[1], 0.01)
+
+        # the failed, slow and refusing nodes are replaced by the next closest
+        self.assertTrue(self.client._store_value('k', 'v', w=2, timeout=1))
+        self.assertEqual(set(sent), set(nodes))
+
+        # there aren't three nodes which acknowledge
+        sent[:] = []
+        self.assertFalse(self.client._store_value('k', 'v', w=3, timeout=0.05))
+        self.assertEqual(set(sent), set(nodes))
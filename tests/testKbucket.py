@@ -145,3 +145,38 @@ class TestKbucket(unittest.TestCase):
 
         n = Node(None, None, -1)
         self.assertFalse(a <= n)
+
+    def test_contacts_keyed_by_id(self):
+        for n in self.nodes:
+            self.bucket.addNode(n)
+
+        # a new object with a known id replaces the old one at the tail
+        n = Node('127.0.0.1', 5000, 25)
+        self.bucket.addNode(n)
+        self.assertEqual(len(self.bucket), 5)
+        self.assertIs(self.bucket.getNode(25), n)
+        self.assertIs(self.bucket.getNodes()[-1], n)
+        self.assertEqual([x.id for x in self.bucket.getNodes(2)], [0, 50])
+
+    def test_remove_contact(self):
+        for n in self.nodes:
+            self.bucket.addNode(n)
+
+        self.bucket.removeContact(self.nodes[0])
+        self.assertEqual(len(self.bucket), 4)
+        self.assertEqual(self.bucket.getLeastRecentlySeen(), self.nodes[1])
+        self.assertRaises(ValueError, self.bucket.getNode, self.nodes[0])
+        self.assertRaises(ValueError, self.bucket.removeContact, self.nodes[0])
+
+    def test_error_node(self):
+        self.bucket.addNode(self.nodes[0])
+        for i in xrange(5):
+            self.bucket.errorNode(self.nodes[0])
+        self.assertEqual(len(self.bucket), 1)
+        self.bucket.errorNode(self.nodes[0])
+        self.assertEqual(len(self.bucket), 0)
+        self.assertEqual(self.bucket.getLeastRecentlySeen(), None)
+
+    def test_depth_single_id(self):
+        a = Kbucket(20,64,65,5,7)
+        self.assertEquals(a.getDepth(), 6)
@@ -29,9 +29,15 @@ class TestNode(unittest.TestCase):
         b = Node('127.0.0.1',5000,500)
         self.assertTrue(a < b)
 
-    @patch('routing.time')
-    def test_seen(self,time_mock):
-        time_mock.time.return_value = 1000
+    def test_hash(self):
+        a = Node('127.0.0.1',5000,100)
+        b = Node('127.0.0.2',5001,100)
+        self.assertEqual(len(set([a, b])), 1)
+        self.assertFalse(hasattr(a, '__dict__'))
+
+    @patch('routing.clock')
+    def test_seen(self,clock_mock):
+        clock_mock.time.return_value = 1000
         n = Node('127.0.0.1',5000,100)
         n.error()
         self.assertEquals(n.errors, 1)
@@ -0,0 +1,57 @@
+import unittest
+from ratelimit import RateLimiter
+import clock
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = clock.VirtualClock()
+        clock.set_clock(self.clock)
+
+    def tearDown(self):
+        clock.set_clock(clock.RealClock())
+
+    def test_burst_then_rate(self):
+        limiter = RateLimiter(rate=2, burst=3)
+        self.assertEqual([limiter.allow('a') for i in xrange(4)],
+                         [True, True, True, False])
+
+        self.clock.now = 0.5
+        self.assertTrue(limiter.allow('a'))
+        self.assertFalse(limiter.allow('a'))
+
+        # never refills past the burst
+        self.clock.now = 100
+        self.assertEqual([limiter.allow('a') for i in xrange(4)],
+                         [True, True, True, False])
+        self.assertEqual((limiter.allowed, limiter.dropped), (7, 3))
+
+    def test_cost(self):
+        limiter = RateLimiter(rate=1, burst=5)
+        self.assertTrue(limiter.allow('a', 4))
+        self.assertFalse(limiter.allow('a', 2))
+        self.assertTrue(limiter.allow('a', 1))
+
+    def test_reserve(self):
+        limiter = RateLimiter(rate=2, burst=3)
+        self.assertEqual(limiter.reserve('a', 3), 0)
+        self.assertEqual(limiter.reserve('a'), 0.5)
+        self.assertEqual(limiter.reserve('a'), 1.0)
+        self.clock.now = 1.0
+        self.assertEqual(limiter.reserve('a'), 0.5)
+        self.assertFalse(limiter.allow('a'))
+
+    def test_keys_independent(self):
+        limiter = RateLimiter(rate=1, burst=1)
+        self.assertTrue(limiter.allow('a'))
+        self.assertFalse(limiter.allow('a'))
+        self.assertTrue(limiter.allow('b'))
+
+    def test_bounded(self):
+        limiter = RateLimiter(rate=1, burst=1, max_keys=2)
+        limiter.allow('a')
+        limiter.allow('b')
+        limiter.allow('a')
+        limiter.allow('c')
+        self.assertEqual(len(limiter), 2)
+        self.assertEqual(limiter.buckets.keys(), ['a', 'c'])
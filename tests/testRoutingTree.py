@@ -1,4 +1,5 @@
 import unittest
+import random
 from routing import  Node, RoutingTree
 
 class TestRoutingTree(unittest.TestCase):
@@ -43,3 +44,33 @@ class TestRoutingTree(unittest.TestCase):
             self.assertEqual(bucket.range_max, mx)
             for j in zip(bucket.nodes, nodes):
                 self.assertEqual(j[0].id, j[1])
+
+    def test_find_closest_nodes(self):
+        rand = random.Random(1)
+        for key_space in (8, 160):
+            this = Node(None, None, rand.randint(0, 2**key_space - 1))
+            r = RoutingTree(this, 4, 5, 2, key_space)
+            for i in xrange(200):
+                r.addNode(Node(None, None, rand.randint(0, 2**key_space - 1)))
+
+            known = [n for bucket in r.buckets for n in bucket.nodes if n.id != this.id]
+            for i in xrange(50):
+                target = rand.randint(0, 2**key_space - 1)
+                expected = sorted(known, key=lambda n: n.id ^ target)[:4]
+                found = r.findClosestNodes(Node(None, None, target))
+                self.assertEqual([n.id for n in found], [n.id for n in expected])
+
+            self.assertEqual(len(r.findClosestNodes(this, 1000)), len(known))
+            self.assertNotIn(this, r.findClosestNodes(this))
+
+    def test_bucket_index(self):
+        this = Node(None, None, 100)
+        r = RoutingTree(this, 2, 5, 5, 8)
+        for i in (0, 25, 30, 50, 200, 255, 230, 127, 128):
+            r.addNode(Node(None, None, i))
+
+        self.assertEqual(r.bounds, [b.range_max for b in r.buckets])
+        for i in xrange(256):
+            index = r.bucketIndex(i)
+            self.assertTrue(r.buckets[index].range_min <= i <= r.buckets[index].range_max)
+            self.assertEqual(index, r.bucketIndex(Node(None, None, i)))
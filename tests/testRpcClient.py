@@ -0,0 +1,368 @@
+import unittest
+from client import Rpc_Client
+from chan import SelectChan
+from network.simulate import Simulate
+from routing import Node, InvalidNodeId
+from datastore.bounded import bounded
+import clock
+import internal
+
+from gevent.queue import Queue, Empty
+
+class TestRpcClient(unittest.TestCase):
+
+    def setUp(self):
+        self.network = Simulate(copy=False)
+        self.client = Rpc_Client(self.network, SelectChan(), Node(None, None, 2**159))
+        self.client.debug = False
+
+    def message(self, m_type, data, source=('10.0.0.1', 50000, 2**158), xid=1):
+        return {
+            'source' : list(source),
+            'xid'    : xid,
+            'type'   : m_type,
+            'data'   : data
+        }
+
+    def test_intern_node(self):
+        a = self.client.intern_node('10.0.0.1', 1, 5)
+        b = self.client.intern_node('10.0.0.2', 2, 5)
+        self.assertIs(a, b)
+        self.assertEqual((a.addr, a.port), ('10.0.0.2', 2))
+
+        # third party reports don't move a known node
+        c = self.client.intern_node('10.0.0.3', 3, 5, False)
+        self.assertIs(a, c)
+        self.assertEqual((a.addr, a.port), ('10.0.0.2', 2))
+
+        # our own node is never moved
+        own = self.client.intern_node('10.0.0.4', 4, self.client.node.id)
+        self.assertIs(own, self.client.node)
+        self.assertNotEqual(own.addr, '10.0.0.4')
+
+    def test_sightings_share_one_node(self):
+        self.client.rpc_handle_message(self.message('PING', {}))
+        node = self.client.routing.findClosestNodes(Node(None, None, 2**158))[0]
+        self.client.rpc_handle_message(self.message('PING', {}, xid=2))
+        self.assertIs(self.client.routing.findClosestNodes(Node(None, None, 2**158))[0], node)
+        self.assertIs(self.client.contacts[2**158], node)
+
+    def test_timeout_fails_transaction(self):
+        clock.set_clock(clock.VirtualClock())
+        try:
+            self.client.rpc_handle_message(self.message('PING', {}))
+            node = self.client.contacts[2**158]
+            answered, silent = Queue(), Queue()
+            failed = []
+            self.client.failure_listeners.append(failed.append)
+            self.client.rpc_add_transaction(1, 'FIND_NODE', node, answered, 1)
+            self.client.rpc_add_transaction(2, 'FIND_NODE', node, silent, 2)
+
+            self.client.rpc_handle_message(self.message('RETURN_NODE', [], xid=1))
+            self.assertEqual(answered.get_nowait()['node'], node)
+
+            clock.get_clock().now = 1.5
+            self.client.rpc_handle_timeouts()
+            self.assertIn(2, self.client.rpc_xids)
+            self.assertEqual(node.errors, 0)
+            self.assertEqual(failed, [])
+
+            clock.get_clock().now = 2.5
+            self.client.rpc_handle_timeouts()
+            self.assertEqual(silent.get_nowait(), { 'timeout' : True, 'node' : node })
+            self.assertEqual(self.client.rpc_xids, {})
+            self.assertEqual(self.client.rpc_deadlines, [])
+            self.assertEqual(node.errors, 1)
+            self.assertEqual(failed, [node])
+            self.assertTrue(answered.empty())
+        finally:
+            clock.set_clock(clock.RealClock())
+
+    def test_response_samples_rtt(self):
+        clock.set_clock(clock.VirtualClock())
+        try:
+            self.client.rpc_handle_message(self.message('PING', {}))
+            node = self.client.contacts[2**158]
+            self.assertEqual(self.client.rtt.timeout(node), self.client.rtt.max_rto)
+
+            self.client.rpc_perform_ping(node, None)
+            xid = self.client.rpc_xids.keys()[0]
+            self.assertEqual(self.client.rpc_xids[xid]['timeout'], self.client.rtt.max_rto)
+
+            clock.get_clock().now = 0.1
+            self.client.rpc_handle_message(self.message('PONG', {}, xid=xid))
+            self.assertEqual(self.client.rpc_xids, {})
+            self.assertEqual(node.srtt, 0.1)
+
+            self.client.rpc_perform_ping(node, None)
+            xid = self.client.rpc_xids.keys()[0]
+            self.assertAlmostEqual(self.client.rpc_xids[xid]['timeout'], 0.3)
+        finally:
+            clock.set_clock(clock.RealClock())
+
+    def test_timeout_timer(self):
+        clock.set_clock(clock.VirtualClock())
+        try:
+            node = self.client.intern_node('10.0.0.1', 50000, 2**158)
+            chan = Queue()
+            self.client.rpc_add_transaction(1, 'FIND_NODE', node, chan, 2)
+            self.client.rpc_add_transaction(2, 'FIND_NODE', node, chan, 1)
+            self.assertEqual(self.client.timeout_at, 1)
+
+            clock.get_clock().run(until=1.5)
+            self.assertEqual(self.client.chan.get_nowait(), ('timer', ('TIMEOUTS', 2)))
+            self.client.handle_message('timer', ('TIMEOUTS', 2))
+            self.assertEqual(chan.get_nowait()['timeout'], True)
+            self.assertEqual(self.client.rpc_xids.keys(), [1])
+            self.assertEqual(self.client.timeout_at, 2)
+
+            # an answered transaction doesn't wake the client
+            self.client.rpc_handle_message(self.message('RETURN_NODE', [], xid=1))
+            self.client.rpc_add_transaction(3, 'FIND_NODE', node, chan, 5)
+            clock.get_clock().run(until=2.5)
+            self.client.handle_message('timer', ('TIMEOUTS', 3))
+            self.assertEqual(self.client.timeout_at, 6.5)
+            self.assertEqual(len(self.client.rpc_deadlines), 1)
+
+            # a stale wakeup leaves the pending timer alone
+            timer = self.client.timeout_timer
+            self.client.handle_message('timer', ('TIMEOUTS', 3))
+            self.assertIs(self.client.timeout_timer, timer)
+            while True:
+                try:
+                    self.client.chan.get_nowait()
+                except Empty:
+                    break
+            clock.get_clock().run(until=7)
+            self.assertEqual(self.client.chan.depth('timer'), 1)
+        finally:
+            clock.set_clock(clock.RealClock())
+
+    def test_timeout_clock_stepped_back(self):
+        clock.set_clock(clock.VirtualClock())
+        try:
+            node = self.client.intern_node('10.0.0.1', 50000, 2**158)
+            chan = Queue()
+            self.client.rpc_add_transaction(1, 'FIND_NODE', node, chan, 1)
+            clock.get_clock().run(until=1.5)
+            chan_name, message = self.client.chan.get_nowait()
+
+            # the wall clock goes back after the timer went off
+            clock.get_clock().now = 0.5
+            self.client.handle_message(chan_name, message)
+            self.assertTrue(chan.empty())
+            self.assertIsNot(self.client.timeout_timer, None)
+
+            clock.get_clock().run(until=2)
+            self.client.handle_message(*self.client.chan.get_nowait())
+            self.assertEqual(chan.get_nowait()['timeout'], True)
+            self.assertIs(self.client.timeout_timer, None)
+        finally:
+            clock.set_clock(clock.RealClock())
+
+    def test_commands(self):
+        nodes = [Node('10.0.0.%s' % i, 50000, 2**158 + i) for i in xrange(3)]
+        command = internal.AddNodes(nodes)
+        reply = command.expect_reply()
+        self.client.handle_message('int', command)
+        self.assertEqual(reply.get(block=False), True)
+
+        closest = self.client.find_closest_nodes(Node(None, None, 2**158), 2)
+        self.assertEqual([n.id for n in closest], [2**158, 2**158 + 1])
+        self.assertIs(closest[0], self.client.contacts[2**158])
+
+        chan = Queue()
+        self.client.handle_message('int', internal.SendFindNode(closest[0], self.client.node, chan))
+        transaction = self.client.rpc_xids.values()[0]
+        self.assertEqual(transaction['type'], 'FIND_NODE')
+        self.assertIs(transaction['chan'], chan)
+
+    def test_command_fails(self):
+        command = internal.AddNodes([Node('10.0.0.1', 50000, 2**160)])
+        reply = command.expect_reply()
+        self.client.handle_message('int', command)
+        self.assertRaises(InvalidNodeId, reply.get, block=False)
+
+    def test_rate_limited(self):
+        clock.set_clock(clock.VirtualClock())
+        try:
+            limiter = self.client.rate_limits['FIND_NODE']
+            for i in xrange(100):
+                self.client.rpc_handle_message(
+                    self.message('FIND_NODE', 2**158, source=('10.0.0.1', 50000, i + 1), xid=i))
+            self.assertEqual(limiter.dropped, 100 - limiter.burst)
+            self.assertFalse(100 in self.client.contacts)
+
+            # other sources and cheap requests have their own budget
+            self.client.rpc_handle_message(self.message('FIND_NODE', 2**158, source=('10.0.0.2', 50000, 1000)))
+            self.client.rpc_handle_message(self.message('PING', {}, source=('10.0.0.1', 50000, 1001)))
+            self.assertEqual(limiter.dropped, 100 - limiter.burst)
+            self.assertEqual(self.client.rate_limits['PING'].dropped, 0)
+        finally:
+            clock.set_clock(clock.RealClock())
+
+    def test_store_ttl(self):
+        ttl = self.client.data_store.ttl
+        k = self.client.routing.k
+        key = 2**159 + 2**150
+        self.assertEqual(self.client.store_ttl(key), ttl)
+
+        # nodes closer to the key than us
+        nodes = [Node('10.0.0.1', i, key + i + 1) for i in xrange(k)]
+        for n in nodes[:-1]:
+            self.client.routing.addNode(n)
+        self.assertEqual(self.client.store_ttl(key), ttl)
+        self.client.routing.addNode(nodes[-1])
+        self.assertEqual(self.client.store_ttl(key), ttl / 2.0)
+
+        self.client.shrink_ttl = False
+        self.assertEqual(self.client.store_ttl(key), ttl)
+
+    def test_cache_store(self):
+        key_hash = 2**159 + 5
+        store = { 'key' : 'k', 'key_hash' : key_hash, 'value' : 'v', 'cache' : True }
+        self.client.rpc_handle_message(self.message('STORE', store))
+        self.assertEqual(self.client.data_store.retrieve(key_hash), None)
+        self.assertEqual(self.client.cache_store.retrieve(key_hash), 'v')
+        self.assertTrue(self.client.cache_store.hash_expires[key_hash] <=
+                        clock.time() + self.client.cache_store.ttl)
+
+        # cached values are returned by FIND_VALUE
+        sent = []
+        self.client.rpc_send_message = lambda addr, port, m: sent.append(m)
+        self.client.rpc_handle_message(self.message('FIND_VALUE', { 'key' : 'k', 'key_hash' : key_hash }, xid=2))
+        self.assertEqual(sent[0]['data'], { 'value' : 'v', 'found' : True })
+
+        # a value we hold isn't cached as well
+        key_hash += 1
+        store = { 'key' : 'k2', 'key_hash' : key_hash, 'value' : 'v2' }
+        self.client.rpc_handle_message(self.message('STORE', store, xid=3))
+        store['cache'] = True
+        self.client.rpc_handle_message(self.message('STORE', store, xid=4))
+        self.assertEqual(self.client.data_store.retrieve(key_hash), 'v2')
+        self.assertEqual(self.client.cache_store.retrieve(key_hash), None)
+
+    def test_batched(self):
+        sent = []
+        self.client.rpc_send_message = lambda addr, port, m: sent.append(m)
+        items = [{ 'key' : 'k%s' % i, 'key_hash' : 2**159 + i, 'value' : 'v%s' % i } for i in xrange(3)]
+        self.client.rpc_handle_message(self.message('STORE_MANY', items))
+        for i in xrange(3):
+            self.assertEqual(self.client.data_store.retrieve(2**159 + i), 'v%s' % i)
+
+        keys = [{ 'key' : 'k%s' % i, 'key_hash' : 2**159 + i } for i in xrange(2, 5)]
+        self.client.rpc_handle_message(self.message('FIND_VALUE_MANY', keys, xid=2))
+        self.assertEqual(sent[0]['type'], 'RETURN_VALUE_MANY')
+        self.assertEqual(sent[0]['data'], [{ 'key_hash' : 2**159 + 2, 'value' : 'v2' }])
+
+    def test_rate_limit_by_peer(self):
+        clock.set_clock(clock.VirtualClock())
+        try:
+            limiter = self.client.rate_limits['FIND_NODE']
+            # nodes sharing an address each have their own budget
+            for i in xrange(100):
+                self.client.rpc_handle_message(
+                    self.message('FIND_NODE', 2**158, source=('10.0.0.1', 1000 + i, i + 1), xid=i))
+            self.assertEqual(limiter.dropped, 0)
+            for i in xrange(100):
+                self.client.rpc_handle_message(
+                    self.message('FIND_NODE', 2**158, source=('10.0.0.1', 1000, 1), xid=i))
+            self.assertEqual(limiter.dropped, 101 - limiter.burst)
+
+            # the address a message was received from counts, not its claimed source
+            m = self.message('FIND_NODE', 2**158, source=('10.0.0.2', 50000, 1000))
+            m['peer'] = ('10.0.0.1', 1000)
+            self.client.rpc_handle_message(m)
+            self.assertEqual(limiter.dropped, 102 - limiter.burst)
+            self.assertFalse(1000 in self.client.contacts)
+        finally:
+            clock.set_clock(clock.RealClock())
+
+    def test_unsolicited_response(self):
+        self.client.rpc_handle_message(self.message('PONG', {}, source=('10.0.0.1', 50000, 5)))
+        self.assertFalse(5 in self.client.contacts)
+
+        # a response must come from the node the request was sent to
+        node = self.client.intern_node('10.0.0.2', 50000, 6)
+        chan = Queue()
+        self.client.rpc_perform_ping(node, chan)
+        xid = self.client.rpc_xids.keys()[0]
+        self.client.rpc_handle_message(self.message('PONG', {}, source=('10.0.0.1', 50000, 5), xid=xid))
+        self.assertFalse(5 in self.client.contacts)
+        self.assertTrue(chan.empty())
+
+        self.client.rpc_handle_message(self.message('PONG', {}, source=('10.0.0.2', 50000, 6), xid=xid))
+        self.assertEqual(chan.get_nowait(), True)
+        self.assertIs(self.client.routing.findClosestNodes(node, 1)[0], node)
+
+    def test_batch_cost(self):
+        clock.set_clock(clock.VirtualClock())
+        try:
+            # a batch costs more of the rate limit than a single request
+            limiter = self.client.rate_limits['STORE_MANY']
+            items = [{ 'key' : 'k', 'key_hash' : 2**158 + i, 'value' : 'v' } for i in xrange(48)]
+            self.client.rpc_handle_message(self.message('STORE_MANY', items[:3]))
+            self.assertEqual(limiter.buckets[('10.0.0.1', 50000)].tokens, limiter.burst - 1)
+            self.client.rpc_handle_message(self.message('STORE_MANY', items, xid=2))
+            self.assertEqual(limiter.buckets[('10.0.0.1', 50000)].tokens, limiter.burst - 5)
+        finally:
+            clock.set_clock(clock.RealClock())
+
+    def test_store_rejected(self):
+        sent = []
+        self.client.rpc_send_message = lambda addr, port, m: sent.append(m)
+        self.client.data_store = bounded(self.client.node, max_bytes=10)
+        store = { 'key' : 'k', 'key_hash' : 2**159 + 1, 'value' : 'v' * 10, 'ack' : True }
+        self.client.rpc_handle_message(self.message('STORE', store))
+        # too large for the store, so the ack says it wasn't stored
+        self.assertEqual(self.client.data_store.rejected, 1)
+        self.client.rpc_handle_message(self.message('STORE', { 'key' : 'k', 'ack' : True }, xid=2))
+        self.client.rpc_handle_message(self.message('STORE', dict(store, value='v'), xid=3))
+        self.assertEqual([(m['type'], m['xid'], m['data']) for m in sent],
+                         [('STORE_ACK', 1, { 'stored' : False }),
+                          ('STORE_ACK', 2, { 'stored' : False }),
+                          ('STORE_ACK', 3, { 'stored' : True })])
+
+    def test_store_refused(self):
+        # a node which turns a value away has answered, it isn't failed
+        failed = []
+        self.client.failure_listeners.append(failed.append)
+        chan = Queue()
+        node = self.client.intern_node('10.0.0.1', 50000, 2**158)
+        self.client.routing.addNode(node)
+        self.client.rpc_send_message = lambda addr, port, m: None
+        self.client.rpc_perform_store(node, 'k', 'v', chan=chan)
+        xid = self.client.rpc_xids.keys()[0]
+        self.client.rpc_handle_message(self.message('STORE_ACK', { 'stored' : False }, xid=xid))
+        self.assertEqual(chan.get_nowait(), { 'timeout' : False, 'node' : node, 'stored' : False })
+        self.assertEqual((self.client.rpc_xids, failed), ({}, []))
+        self.assertIs(self.client.routing.findClosestNodes(node, 1)[0], node)
+
+    def test_batched_response(self):
+        chan = Queue()
+        node = Node('10.0.0.1', 50000, 2**158)
+        self.client.rpc_perform_find_value_many(node, [('k', 5), ('j', 6)], chan)
+        xid = self.client.rpc_xids.keys()[0]
+        self.client.rpc_handle_message(self.message('RETURN_VALUE_MANY', [{ 'key_hash' : 5, 'value' : 'v' }], xid=xid))
+        m = chan.get_nowait()
+        self.assertEqual(m['values'], { 5 : 'v' })
+        self.assertEqual(m['node'].id, 2**158)
+
+    def test_store_ack(self):
+        sent = []
+        self.client.rpc_send_message = lambda addr, port, m: sent.append(m)
+        store = { 'key' : 'k', 'key_hash' : 2**159 + 1, 'value' : 'v' }
+        self.client.rpc_handle_message(self.message('STORE', store))
+        self.assertEqual(sent, [])
+        self.client.rpc_handle_message(self.message('STORE', dict(store, ack=True), xid=2))
+        self.assertEqual((sent[0]['type'], sent[0]['xid']), ('STORE_ACK', 2))
+
+        # an acknowledged store is a transaction
+        chan = Queue()
+        node = self.client.contacts[2**158]
+        self.client.rpc_perform_store(node, 'k', 'v', chan=chan)
+        self.assertTrue(sent[1]['data']['ack'])
+        self.assertEqual(self.client.rpc_xids[sent[1]['xid']]['type'], 'STORE')
+        self.client.rpc_handle_message(self.message('STORE_ACK', { 'stored' : True }, xid=sent[1]['xid']))
+        self.assertEqual(chan.get_nowait(), { 'timeout' : False, 'node' : node, 'stored' : True })
+        self.assertEqual(self.client.rpc_xids, {})
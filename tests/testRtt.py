@@ -0,0 +1,59 @@
+import unittest
+from routing import Node
+from rtt import RttEstimator
+
+class TestRttEstimator(unittest.TestCase):
+
+    def setUp(self):
+        self.rtt = RttEstimator(min_rto=0.05, max_rto=2.0)
+        self.node = Node(None, None, 1)
+
+    def test_unknown_uses_max(self):
+        self.assertEqual(self.rtt.timeout(), 2.0)
+        self.assertEqual(self.rtt.timeout(self.node), 2.0)
+
+    def test_first_sample(self):
+        self.rtt.sample(self.node, 0.1)
+        self.assertEqual(self.node.srtt, 0.1)
+        self.assertEqual(self.node.rttvar, 0.05)
+        self.assertAlmostEqual(self.rtt.timeout(self.node), 0.3)
+
+    def test_smoothing(self):
+        self.rtt.sample(self.node, 0.1)
+        self.rtt.sample(self.node, 0.2)
+        self.assertAlmostEqual(self.node.rttvar, 0.05 + 0.25 * (0.1 - 0.05))
+        self.assertAlmostEqual(self.node.srtt, 0.1 + 0.125 * 0.1)
+
+    def test_stall_timeout(self):
+        self.assertEqual(self.rtt.stall_timeout(self.node), 2.0)
+        self.rtt.sample(self.node, 0.1)
+        self.assertAlmostEqual(self.rtt.stall_timeout(self.node), 0.15)
+        self.assertTrue(self.rtt.stall_timeout(self.node) < self.rtt.timeout(self.node))
+
+    def test_global_fallback(self):
+        other = Node(None, None, 2)
+        self.rtt.sample(other, 0.4)
+        self.assertAlmostEqual(self.rtt.timeout(self.node), 1.2)
+        self.assertIsNone(self.node.srtt)
+
+    def test_clamped(self):
+        for i in xrange(50):
+            self.rtt.sample(self.node, 0.001)
+        self.assertEqual(self.rtt.timeout(self.node), 0.05)
+        self.rtt.sample(self.node, 10)
+        self.assertEqual(self.rtt.timeout(self.node), 2.0)
+
+    def test_backoff(self):
+        for i in xrange(50):
+            self.rtt.sample(self.node, 0.1)
+        rto = self.rtt.timeout(self.node)
+        self.rtt.backoff(self.node)
+        self.assertAlmostEqual(self.rtt.timeout(self.node), 2 * rto)
+        for i in xrange(10):
+            self.rtt.backoff(self.node)
+        self.assertAlmostEqual(self.rtt.timeout(self.node), 2.0)
+
+        # nothing to back off from
+        other = Node(None, None, 2)
+        self.rtt.backoff(other)
+        self.assertIsNone(other.srtt)
@@ -0,0 +1,137 @@
+import unittest
+import random
+from routing import Node
+from lookup import Shortlist, LookupStats, LookupCache
+import clock
+
+class TestShortlist(unittest.TestCase):
+
+    def nodes(self, ids):
+        return [Node(None, None, i) for i in ids]
+
+    def test_ordered_by_distance(self):
+        s = Shortlist(0b1000, 3, 10)
+        s.add(self.nodes([0b0001, 0b1111, 0b1001, 0b0111, 0b1010]))
+        self.assertEqual([n.id for n in s.closest(5)],
+                         [0b1001, 0b1010, 0b1111, 0b0001, 0b0111])
+        self.assertEqual([n.id for n in s.closest()], [0b1001, 0b1010, 0b1111])
+
+    def test_seen_ignored(self):
+        s = Shortlist(0, 2, 4)
+        s.add(self.nodes([1, 2]))
+        s.add(self.nodes([2, 1, 3]))
+        self.assertEqual([n.id for n in s.closest(4)], [1, 2, 3])
+
+    def test_capped(self):
+        s = Shortlist(0, 2, 3)
+        s.add(self.nodes([8, 4, 6, 2]))
+        self.assertEqual([n.id for n in s.closest(4)], [2, 4, 6])
+        s.add(self.nodes([7, 1]))
+        self.assertEqual([n.id for n in s.closest(4)], [1, 2, 4])
+
+    def test_size_at_least_k(self):
+        s = Shortlist(0, 4, 2)
+        self.assertEqual(s.size, 4)
+        self.assertEqual(Shortlist(0, 4).size, 12)
+
+    def test_next_and_complete(self):
+        s = Shortlist(0, 2, 4)
+        s.add(self.nodes([3, 1, 2]))
+        self.assertFalse(s.complete())
+
+        n = s.next()
+        self.assertEqual(n.id, 1)
+        s.query(n)
+        self.assertEqual(s.next().id, 2)
+        s.query(s.next())
+        s.respond(n)
+        self.assertFalse(s.complete())
+
+        s.respond(Node(None, None, 2))
+        self.assertTrue(s.complete())
+        self.assertEqual(s.next().id, 3)
+
+        # a closer node arriving means the lookup is no longer complete
+        s.add(self.nodes([0]))
+        self.assertFalse(s.complete())
+
+    def test_remove(self):
+        s = Shortlist(0, 2, 4)
+        s.add(self.nodes([1, 2, 3]))
+        s.remove(Node(None, None, 1))
+        self.assertEqual([n.id for n in s.closest()], [2, 3])
+        s.add(self.nodes([1]))
+        self.assertEqual([n.id for n in s.closest()], [2, 3])
+
+    def test_matches_sort(self):
+        rand = random.Random(5)
+        target = rand.getrandbits(160)
+        ids = [rand.getrandbits(160) for i in xrange(500)]
+        s = Shortlist(target, 20)
+        for i in xrange(0, len(ids), 20):
+            s.add(self.nodes(ids[i:i + 20]))
+        expected = sorted(ids, key=lambda i: i ^ target)[:60]
+        self.assertEqual([n.id for n in s.closest(60)], expected)
+
+class TestLookupStats(unittest.TestCase):
+
+    def test_add(self):
+        total = LookupStats()
+        a = LookupStats()
+        a.lookups, a.hops, a.messages, a.stalled = 1, 3, 12, 2
+        b = LookupStats()
+        b.lookups, b.hops, b.messages, b.timeouts = 1, 2, 9, 1
+        total.add(a)
+        total.add(b)
+        self.assertEqual((total.lookups, total.hops, total.messages,
+                          total.stalled, total.timeouts, total.responses),
+                         (2, 5, 21, 2, 1, 0))
+
+class TestLookupCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = clock.VirtualClock()
+        clock.set_clock(self.clock)
+
+    def tearDown(self):
+        clock.set_clock(clock.RealClock())
+
+    def nodes(self, ids):
+        return [Node(None, None, i) for i in ids]
+
+    def test_get_put(self):
+        cache = LookupCache(ttl=10)
+        self.assertEqual(cache.get(1), None)
+        cache.put(1, self.nodes([2, 3]))
+        self.assertEqual([n.id for n in cache.get(1)], [2, 3])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.hit_rate(), 0.5)
+
+        self.clock.now = 10
+        self.assertEqual(cache.get(1), None)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.targets, {})
+
+    def test_size(self):
+        cache = LookupCache(size=2)
+        cache.put(1, self.nodes([10]))
+        cache.put(2, self.nodes([10]))
+        cache.get(1)
+        cache.put(3, self.nodes([11]))
+        self.assertEqual(cache.entries.keys(), [1, 3])
+        self.assertEqual(cache.targets, { 10 : set([1]), 11 : set([3]) })
+
+    def test_invalidate(self):
+        cache = LookupCache()
+        cache.put(1, self.nodes([10, 11]))
+        cache.put(2, self.nodes([11, 12]))
+        cache.put(3, self.nodes([12, 13]))
+        cache.invalidate(Node(None, None, 11))
+        self.assertEqual(cache.entries.keys(), [3])
+        self.assertEqual(cache.invalidations, 2)
+        self.assertEqual(sorted(cache.targets), [12, 13])
+
+        # storing a result again forgets its old nodes
+        cache.put(3, self.nodes([14]))
+        cache.invalidate(Node(None, None, 12))
+        self.assertEqual(cache.entries.keys(), [3])
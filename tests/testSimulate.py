@@ -0,0 +1,42 @@
+import unittest
+from gevent.queue import Queue
+from network.simulate import Simulate, SharedMessageMutated
+from network.codec import JsonCodec
+
+class TestSimulate(unittest.TestCase):
+
+    def message(self):
+        return {
+            'source' : ['10.0.0.1', 50000, 1],
+            'xid'    : 1,
+            'type'   : 'RETURN_NODE',
+            'data'   : [('10.0.0.2', 50001, 2)]
+        }
+
+    def deliver(self, network):
+        q = Queue()
+        addr, port = network.connect(q)
+        m = self.message()
+        network.send(addr, port, m)
+        return m, q.get(block=False)
+
+    def test_copy(self):
+        for network in [Simulate(), Simulate(codec=JsonCodec())]:
+            sent, received = self.deliver(network)
+            self.assertIsNot(sent, received)
+            self.assertEqual(received['xid'], sent['xid'])
+
+    def test_shared(self):
+        sent, received = self.deliver(Simulate(copy=False))
+        self.assertIs(sent, received)
+
+    def test_check_shared(self):
+        sent, received = self.deliver(Simulate(copy=False, check_shared=True))
+        self.assertEqual(received['xid'], sent['xid'])
+        self.assertRaises(SharedMessageMutated, received.__setitem__, 'source', None)
+        self.assertRaises(SharedMessageMutated, received.pop, 'xid')
+        self.assertIsInstance(received["data"], tuple)
+
+    def test_not_connected(self):
+        network = Simulate()
+        network.send('10.0.0.1', 1, self.message())
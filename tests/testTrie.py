@@ -0,0 +1,56 @@
+import unittest
+import random
+from routing import Node, RoutingTree
+from trie import TrieRoutingTree
+
+class TestTrieRoutingTree(unittest.TestCase):
+
+    def build(self, cls, this, ids, k=2, key_space=8):
+        tree = cls(Node(None, None, this), k, 5, 5, key_space)
+        for i in ids:
+            tree.addNode(Node(None, None, i))
+        return tree
+
+    def test_split_bucket(self):
+        ids = [0, 25, 30, 50, 200, 255, 230]
+        r = self.build(TrieRoutingTree, 100, ids)
+
+        expected = [(0,15,[0]),(16,31,[25,30]),(32,63,[50]),
+                    (64,127,[100]),(128,191,[]),(192,223,[200]),
+                    (224,255,[255,230])]
+
+        self.assertEqual(len(r.buckets), len(expected))
+        for bucket, (mi, mx, nodes) in zip(r.buckets, expected):
+            self.assertEqual(bucket.range_min, mi)
+            self.assertEqual(bucket.range_max, mx)
+            self.assertEqual([n.id for n in bucket.nodes], nodes)
+
+    def test_matches_routing_tree(self):
+        rand = random.Random(3)
+        for key_space in (8, 160):
+            this = rand.randint(0, 2**key_space - 1)
+            ids = [rand.randint(0, 2**key_space - 1) for i in xrange(300)]
+            tree = self.build(RoutingTree, this, ids, 4, key_space)
+            trie = self.build(TrieRoutingTree, this, ids, 4, key_space)
+
+            self.assertEqual([(b.range_min, b.range_max, [n.id for n in b.nodes]) for b in tree.buckets],
+                             [(b.range_min, b.range_max, [n.id for n in b.nodes]) for b in trie.buckets])
+            self.assertEqual(tree.returnStats(), trie.returnStats())
+
+            for i in xrange(50):
+                target = Node(None, None, rand.randint(0, 2**key_space - 1))
+                self.assertEqual([n.id for n in tree.findClosestNodes(target, 7)],
+                                 [n.id for n in trie.findClosestNodes(target, 7)])
+
+    def test_full_bucket_returns_stale_node(self):
+        # bucket 128-255 is at depth 1 and can't be split with b=1
+        trie = TrieRoutingTree(Node(None, None, 1), 2, 5, 1, 8)
+        for i in (200, 201):
+            self.assertEqual(trie.addNode(Node(None, None, i)), None)
+        self.assertEqual(trie.addNode(Node(None, None, 202)).id, 200)
+
+    def test_error_node(self):
+        trie = self.build(TrieRoutingTree, 100, [25])
+        for i in xrange(6):
+            trie.errorNode(Node(None, None, 25))
+        self.assertEqual(trie.returnStats()['total_nodes'], 1)
@@ -0,0 +1,86 @@
+import unittest
+from gevent.queue import Queue, Empty
+from gevent import pool
+from network.udp import Udp
+from client import Rpc_Client
+from chan import SelectChan
+from routing import Node
+
+class TestUdp(unittest.TestCase):
+
+    def setUp(self):
+        self.network = Udp(rcvbuf=65536, sndbuf=65536)
+
+    def tearDown(self):
+        self.network.close()
+
+    def message(self, addr, port):
+        return {
+            'source' : [addr, port, 1],
+            'xid'    : 7,
+            'type'   : 'FIND_NODE',
+            'data'   : 99
+        }
+
+    def test_send_receive(self):
+        qa, qb = Queue(), Queue()
+        a_addr, a_port = self.network.connect(qa)
+        b_addr, b_port = self.network.connect(qb)
+        self.assertNotEqual(a_port, b_port)
+
+        m = self.message(a_addr, a_port)
+        self.network.send(b_addr, b_port, m)
+        received = qb.get(timeout=2)
+        self.assertEqual(received.pop('peer'), (a_addr, a_port))
+        self.assertEqual(received, m)
+        self.assertEqual(self.network.sent, 1)
+        self.assertEqual(self.network.received, 1)
+
+    def test_batch_receive(self):
+        qa, qb = Queue(), Queue()
+        a_addr, a_port = self.network.connect(qa)
+        b_addr, b_port = self.network.connect(qb)
+
+        for i in xrange(100):
+            self.network.send(b_addr, b_port, self.message(a_addr, a_port))
+
+        for i in xrange(100):
+            qb.get(timeout=2)
+        self.assertTrue(qa.empty())
+
+    def test_unencodable_message_dropped(self):
+        q = Queue()
+        addr, port = self.network.connect(q)
+        m = self.message(addr, port)
+        m['type'] = 'UNKNOWN'
+        self.network.send(addr, port, m)
+        self.assertEqual(self.network.dropped, 1)
+        self.assertRaises(Empty, q.get, timeout=0.1)
+
+    def test_disconnect(self):
+        q = Queue()
+        addr, port = self.network.connect(q)
+        self.assertRaises(Exception, self.network.disconnect, addr, port, Queue())
+        self.network.disconnect(addr, port, q)
+        self.assertEqual(self.network.sockets, {})
+
+    def test_nodes_on_one_address(self):
+        # every node is on 127.0.0.1, as when running many in one process
+        clients = pool.Pool()
+        nodes = []
+        for i in xrange(61):
+            client = Rpc_Client(self.network, SelectChan(), Node(None, None, i + 1))
+            client.debug = False
+            clients.spawn(client.main)
+            nodes.append(client)
+        try:
+            bootstrap = nodes[0]
+            replies = Queue()
+            for client in nodes[1:]:
+                client.rpc_perform_find_node(bootstrap.return_node(), client.return_node(), replies)
+
+            answered = [replies.get(timeout=5) for client in nodes[1:]]
+            self.assertFalse(any(m['timeout'] for m in answered))
+            self.assertEqual(bootstrap.rate_limits['FIND_NODE'].dropped, 0)
+        finally:
+            clients.kill()
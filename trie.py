@@ -0,0 +1,187 @@
+from routing import Node, Kbucket, KbucketFull, InvalidNodeId
+from heapq import heappush, heapreplace
+
+class TrieNode(object):
+    ''' TrieNode is a node in the routing trie. Leaves hold a Kbucket for
+    the ids sharing the node's prefix, inner nodes hold two children for
+    the ids whose next bit (given by 'bit') is 0 and 1 respectively. '''
+    __slots__ = ('depth', 'bit', 'bucket', 'zero', 'one')
+
+    def __init__(self, depth, bit, bucket):
+        self.depth = depth
+        self.bit = bit
+        self.bucket = bucket
+        self.zero = None
+        self.one = None
+
+class TrieRoutingTree:
+    ''' TrieRoutingTree is a routing table with the same interface as
+    routing.RoutingTree which keeps its buckets at the leaves of a binary
+    trie over the bits of the node ids.
+
+    Finding the bucket for an id, splitting a bucket and walking to the
+    closest nodes all cost O(depth) and never shift a list of buckets.
+    The same relaxed splitting rules apply: a full bucket is split if it
+    contains our own node or its depth is less than b.
+    '''
+    def __init__(self, node, k=20, error_threshold=5, b=5, key_space=160):
+        self.k       = k
+        self.error_threshold = error_threshold
+        self.b       = b
+        self.key_space = key_space
+        self.node    = node
+        self.max_key = (2**self.key_space) - 1
+        self.root    = TrieNode(0, 1 << (key_space - 1),
+                                Kbucket(k, 0, self.max_key, self.error_threshold, self.key_space))
+        self.addNode(self.node)
+
+    @property
+    def buckets(self):
+        ''' buckets returns a list of every bucket, ordered by range '''
+        buckets = []
+        stack = [self.root]
+        while stack:
+            t = stack.pop()
+            if t.bucket is not None:
+                buckets.append(t.bucket)
+            else:
+                stack.append(t.one)
+                stack.append(t.zero)
+        return buckets
+
+    def _leaf(self, n):
+        ''' _leaf returns the trie leaf containing n, n can be a long
+        or a Node object '''
+        if isinstance(n, Node):
+            n = n.id
+        t = self.root
+        while t.bucket is None:
+            if n & t.bit:
+                t = t.one
+            else:
+                t = t.zero
+        return t
+
+    def getBucket(self, n):
+        ''' getBucket returns the bucket containing n '''
+        return self._leaf(n).bucket
+
+    def addNode(self, node):
+        ''' addNode adds a Node object into the correct bucket in the trie,
+        following the same rules as RoutingTree.addNode. If the node can't
+        be added the least recently seen node of its bucket is returned. '''
+        if node.id > self.max_key or node.id < 0:
+            raise InvalidNodeId('Node id outside of key space')
+
+        leaf = self._leaf(node.id)
+        while True:
+            bucket = leaf.bucket
+            try:
+                bucket.addNode(node)
+                return None
+            except KbucketFull:
+                if bucket.range_min <= self.node.id <= bucket.range_max or leaf.depth < self.b:
+                    self._splitLeaf(leaf)
+                    if node.id & leaf.bit:
+                        leaf = leaf.one
+                    else:
+                        leaf = leaf.zero
+                else:
+                    return bucket.getLeastRecentlySeen()
+
+    def _splitLeaf(self, leaf):
+        ''' _splitLeaf turns a leaf into an inner node with two leaves,
+        dividing the bucket's contents between them '''
+        bucket = leaf.bucket
+        mid = bucket.range_min + leaf.bit
+        low = Kbucket(self.k, bucket.range_min, mid - 1, self.error_threshold, self.key_space)
+        high = Kbucket(self.k, mid, bucket.range_max, self.error_threshold, self.key_space)
+
+        for node in bucket.contacts.itervalues():
+            if node.id < mid:
+                low.addNode(node, updateSeen=False)
+            else:
+                high.addNode(node, updateSeen=False)
+
+        low.last_lookup = high.last_lookup = bucket.last_lookup
+        leaf.zero = TrieNode(leaf.depth + 1, leaf.bit >> 1, low)
+        leaf.one = TrieNode(leaf.depth + 1, leaf.bit >> 1, high)
+        leaf.bucket = None
+
+    def replaceStaleNode(self, remove, new):
+        ''' replaceStaleNode is to be called when a node must be removed from
+        the tree with a new node seen '''
+        bucket = self.getBucket(remove)
+        bucket.removeContact(remove)
+        bucket.addNode(new)
+
+    def findClosestNodes(self, node, count=None):
+        ''' findClosestNodes returns upto count (default k) of the nodes
+        this node knows about which are closest to the target node, sorted
+        by xor distance. Our own node is never returned.
+
+        The trie is walked depth first taking the target's side of each
+        branch first. Every id on the other side of a branch at depth d is
+        at least 2**(key_space - 1 - d) from the target, so that side is
+        skipped once it can't beat the current worst node.
+        '''
+        if count is None:
+            count = self.k
+
+        target = node.id
+        own = self.node.id
+        heap = []
+
+        # stack of (trie node, lower bound on the distance of its ids)
+        stack = [(self.root, 0)]
+        while stack:
+            t, bound = stack.pop()
+            if len(heap) >= count and bound >= -heap[0][0]:
+                continue
+
+            if t.bucket is None:
+                if target & t.bit:
+                    near, far = t.one, t.zero
+                else:
+                    near, far = t.zero, t.one
+                stack.append((far, bound | t.bit))
+                stack.append((near, bound))
+                continue
+
+            for n in t.bucket.contacts.itervalues():
+                if n.id == own:
+                    continue
+                distance = n.id ^ target
+                if len(heap) < count:
+                    heappush(heap, (-distance, n))
+                elif distance < -heap[0][0]:
+                    heapreplace(heap, (-distance, n))
+
+        heap.sort(reverse=True)
+        return [n for distance, n in heap]
+
+    def fetchRefreshNodes(self, force=False):
+        nodes = []
+        for bucket in self.buckets:
+            if not len(bucket):
+                # nothing to refresh from
+                continue
+            elif force or bucket.needsRefresh():
+                nodes.append(bucket.getRandomNode())
+
+        return nodes
+
+    def performedLookup(self, node):
+        self.getBucket(node).performedLookup()
+
+    def errorNode(self, node):
+        ''' indicate that a node has not responded to a request of some
+        kind '''
+        self.getBucket(node).errorNode(node)
+
+    def returnStats(self):
+        ''' return some statistics about the routing trie
+        '''
+        buckets = self.buckets
+        return { 'buckets' : len(buckets),
+                 'total_nodes' : sum(len(bucket) for bucket in buckets) }